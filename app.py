@@ -1,44 +1,996 @@
 # File: backend/app.py (Flask Backend)
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+import base64
+import bisect
+import hashlib
+import instrumentation
+import json
 import libvirt
+import os
+import queue
+import random
+import threading
+import time
 import xml.etree.ElementTree as ET
+from urllib.parse import urlparse
 
 app = Flask(__name__)
 
-# Connect to the hypervisor
-def get_conn():
-    return libvirt.open("qemu+tcp://192.168.64.2/system")
+LIBVIRT_URI = os.environ.get('LIBVIRT_URI', "qemu+tcp://192.168.64.2/system")
 
-# List all VMs
+# Hypervisors served by this backend (comma-separated); the first one is the
+# default for requests that do not name a host
+LIBVIRT_URIS = [uri.strip() for uri in os.environ.get('LIBVIRT_URIS', LIBVIRT_URI).split(',')
+                if uri.strip()]
+
+# Longest an aggregated GET /vms waits for a host's scan before serving that
+# host's previous snapshot (or nothing) instead
+HOST_WAIT = float(os.environ.get('HOST_WAIT', '2'))
+
+# Connection pool settings
+POOL_SIZE = int(os.environ.get('LIBVIRT_POOL_SIZE', '4'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('LIBVIRT_POOL_TIMEOUT', '30'))
+KEEPALIVE_INTERVAL = 5  # seconds between keepalive probes
+KEEPALIVE_COUNT = 3     # unanswered probes before the connection is closed
+
+# Reconnect backoff after a host becomes unreachable: the delay doubles from
+# RECONNECT_MIN_DELAY up to RECONNECT_MAX_DELAY seconds, with jitter. Until
+# it expires requests fail fast instead of blocking on a dead TCP connect.
+RECONNECT_MIN_DELAY = float(os.environ.get('RECONNECT_MIN_DELAY', '1'))
+RECONNECT_MAX_DELAY = float(os.environ.get('RECONNECT_MAX_DELAY', '60'))
+
+# Concurrent workers for batch lifecycle requests (each holds a pooled connection)
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(POOL_SIZE)))
+
+# Shared inventory snapshot behind GET /vms
+INVENTORY_INTERVAL = float(os.environ.get('INVENTORY_INTERVAL', '5'))  # seconds between scans
+INVENTORY_MAX_AGE = int(os.environ.get('INVENTORY_MAX_AGE', '5'))      # Cache-Control max-age
+
+# Stats groups collected in a single getAllDomainStats call per scan
+INVENTORY_STATS = (libvirt.VIR_DOMAIN_STATS_STATE |
+                   libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                   libvirt.VIR_DOMAIN_STATS_BALLOON |
+                   libvirt.VIR_DOMAIN_STATS_VCPU)
+
+# Query options for GET /vms
+VM_FIELDS = ('name', 'id', 'isActive', 'state', 'uuid', 'memory', 'vcpus', 'cpu_time', 'host')
+DEFAULT_FIELDS = ('name', 'id', 'isActive')
+AGGREGATE_FIELDS = DEFAULT_FIELDS + ('host',)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+DOMAIN_STATES = {
+    libvirt.VIR_DOMAIN_NOSTATE: 'nostate',
+    libvirt.VIR_DOMAIN_RUNNING: 'running',
+    libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
+    libvirt.VIR_DOMAIN_PAUSED: 'paused',
+    libvirt.VIR_DOMAIN_SHUTDOWN: 'shutdown',
+    libvirt.VIR_DOMAIN_SHUTOFF: 'shutoff',
+    libvirt.VIR_DOMAIN_CRASHED: 'crashed',
+    libvirt.VIR_DOMAIN_PMSUSPENDED: 'pmsuspended',
+}
+
+# Server-Sent Events settings
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', '100'))  # per subscriber
+SSE_HEARTBEAT = 15  # seconds between keepalive comments on idle streams
+
+LIFECYCLE_EVENTS = {
+    libvirt.VIR_DOMAIN_EVENT_DEFINED: 'defined',
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED: 'undefined',
+    libvirt.VIR_DOMAIN_EVENT_STARTED: 'started',
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: 'suspended',
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: 'resumed',
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: 'stopped',
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: 'shutdown',
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: 'pmsuspended',
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: 'crashed',
+}
+
+# Reasons passed to a libvirt connection close callback
+CLOSE_REASONS = {
+    libvirt.VIR_CONNECT_CLOSE_REASON_ERROR: 'error',
+    libvirt.VIR_CONNECT_CLOSE_REASON_EOF: 'eof',
+    libvirt.VIR_CONNECT_CLOSE_REASON_KEEPALIVE: 'keepalive',
+    libvirt.VIR_CONNECT_CLOSE_REASON_CLIENT: 'client',
+}
+
+# Lifecycle actions accepted by POST /vms/batch
+BATCH_ACTIONS = {
+    'start': lambda domain: domain.create(),
+    'shutdown': lambda domain: domain.shutdown(),
+    'destroy': lambda domain: domain.destroy(),
+    'reboot': lambda domain: domain.reboot(0),
+    'suspend': lambda domain: domain.suspend(),
+    'resume': lambda domain: domain.resume(),
+}
+
+
+_event_loop_thread = None
+
+def start_event_loop():
+    """Run the default libvirt event loop (needed for keepalive) in a thread."""
+    global _event_loop_thread
+    if _event_loop_thread is not None:
+        return
+
+    def run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    libvirt.virEventRegisterDefaultImpl()
+    _event_loop_thread = threading.Thread(target=run, name='libvirt-events', daemon=True)
+    _event_loop_thread.start()
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class HostUnavailable(PoolExhausted):
+    """The host failed recently and its reconnect backoff has not expired."""
+
+
+class UnknownHost(Exception):
+    pass
+
+
+class Backoff:
+    """Exponential reconnect delay with jitter (each delay is drawn from [d/2, d])."""
+
+    def __init__(self, minimum=RECONNECT_MIN_DELAY, maximum=RECONNECT_MAX_DELAY):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def failed(self):
+        with self._lock:
+            delay = min(self.maximum, self.minimum * 2 ** self.attempts)
+            self.attempts += 1
+            self._retry_at = time.monotonic() + random.uniform(delay / 2, delay)
+
+    def succeeded(self):
+        with self._lock:
+            self.attempts = 0
+            self._retry_at = 0.0
+
+    def remaining(self):
+        """Seconds until the next attempt is allowed (0 when it is)."""
+        with self._lock:
+            return max(0.0, self._retry_at - time.monotonic())
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent libvirt connections.
+
+    Connections are opened lazily up to `size`, kept alive with libvirt
+    keepalive probes and checked with isAlive() before being handed out;
+    dead ones are dropped and replaced with a fresh connection.
+    """
+
+    def __init__(self, uri, size=POOL_SIZE, timeout=POOL_ACQUIRE_TIMEOUT, name=None):
+        self.uri = uri
+        self.name = name or uri  # host label of the connection metrics
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.backoff = Backoff()
+        self.in_use = 0
+        self.created = 0
+        self.failed = 0
+
+    def _open(self):
+        wait = self.backoff.remaining()
+        if wait:
+            raise HostUnavailable(f"{self.uri} is unreachable; reconnecting in {wait:.1f}s")
+        try:
+            conn = instrumentation.open_connection(self.uri, self.name)
+        except libvirt.libvirtError:
+            with self._lock:
+                self.failed += 1
+            self.backoff.failed()
+            raise
+        self.backoff.succeeded()
+        try:
+            conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+        except libvirt.libvirtError as e:
+            print(f"Keepalive not enabled for {self.uri}: {e}")
+        with self._lock:
+            self.created += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhausted(f"No libvirt connection available after {self.timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    conn = self._open()
+                    break
+                if conn.isAlive():
+                    break
+                self._close(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+        return conn
+
+    def release(self, conn, broken=False):
+        with self._lock:
+            self.in_use -= 1
+            if not broken:
+                self._idle.append(conn)
+        if broken:
+            self._close(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except libvirt.libvirtError:
+            broken = not conn.isAlive()
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def run(self, func):
+        """
+        Call func(conn) with a pooled connection. If the connection turns out
+        to be dead, retry once on a fresh one.
+        """
+        for attempt in (1, 2):
+            conn = self.acquire()
+            alive = True
+            try:
+                return func(conn)
+            except libvirt.libvirtError:
+                alive = conn.isAlive()
+                if alive or attempt == 2:
+                    raise
+            finally:
+                self.release(conn, broken=not alive)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'uri': self.uri,
+                'size': self.size,
+                'in_use': self.in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'failed': self.failed,
+                'reconnect_attempts': self.backoff.attempts,
+                'reconnect_in': round(self.backoff.remaining(), 1),
+            }
+
+
+class EventBroadcaster:
+    """
+    Single libvirt lifecycle subscription fanned out to many listeners.
+
+    Each subscriber gets a bounded queue. When a queue is full its pending
+    events are dropped and replaced by a 'resync' marker, so a slow client
+    never blocks the event loop or other clients; it must re-read /vms.
+    """
+
+    RESYNC = {'type': 'resync'}
+
+    def __init__(self, uri, queue_size=SSE_QUEUE_SIZE, name=None):
+        self.uri = uri
+        self.name = name or uri
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._setup_lock = threading.Lock()  # held while (re)opening the connection
+        self._send_lock = threading.Lock()   # held while fanning out one message
+        self._conn = None
+        self._callback_id = None
+        self._seq = 0
+        self._listeners = []
+        self._lost = False  # a connection existed and was closed
+        self.backoff = Backoff()
+        self.dropped = 0
+
+    def ensure_subscription(self):
+        """
+        (Re)open the event connection if it is missing or dead. While the
+        reconnect backoff runs this fails fast with a libvirtError. Setup is
+        serialized, so concurrent requests share one connection.
+        """
+        with self._setup_lock:
+            with self._lock:
+                if self._conn is not None and self._conn.isAlive():
+                    return
+                reconnecting = self._conn is not None or self._lost
+                self._conn = None
+            wait = self.backoff.remaining()
+            if wait:
+                raise libvirt.libvirtError(f"event connection to {self.uri} is down; "
+                                           f"reconnecting in {wait:.1f}s")
+            try:
+                conn = instrumentation.open_connection(self.uri, self.name)
+            except libvirt.libvirtError:
+                self.backoff.failed()
+                raise
+            self.backoff.succeeded()
+            try:
+                conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+                conn.registerCloseCallback(self._on_close, None)
+            except libvirt.libvirtError as e:
+                print(f"Keepalive not enabled for event connection: {e}")
+            try:
+                callback_id = conn.domainEventRegisterAny(
+                    None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle, None)
+            except libvirt.libvirtError:
+                try:
+                    conn.close()
+                except libvirt.libvirtError:
+                    pass
+                raise
+            with self._lock:
+                self._conn, self._callback_id = conn, callback_id
+                self._lost = False
+        if reconnecting:
+            # Events may have been lost while the connection was down
+            self._broadcast(self.RESYNC)
+
+    def _on_close(self, conn, reason, opaque):
+        """Close callback (event loop thread): tell listeners the stream went stale."""
+        with self._lock:
+            if conn is not self._conn:
+                return
+            self._conn = None
+            self._lost = True
+        self._broadcast({'type': 'disconnected', 'reason': CLOSE_REASONS.get(reason, str(reason)),
+                         'timestamp': time.time()})
+
+    def subscribe(self):
+        self.ensure_subscription()
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def add_listener(self, callback):
+        """Call callback(message) in the event thread for every broadcast."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _on_lifecycle(self, conn, dom, event, detail, opaque):
+        self._broadcast({
+            'type': 'lifecycle',
+            'name': dom.name(),
+            'uuid': dom.UUIDString(),
+            'event': LIFECYCLE_EVENTS.get(event, str(event)),
+            'detail': detail,
+            'timestamp': time.time(),
+        })
+
+    def _broadcast(self, message):
+        # The event thread and request threads (resync) both broadcast: one
+        # at a time, so ids stay ordered and a drained queue has room left
+        with self._send_lock:
+            with self._lock:
+                self._seq += 1
+                message = dict(message, id=self._seq)
+                subscribers = list(self._subscribers)
+                listeners = list(self._listeners)
+            for listener in listeners:
+                listener(message)
+            for subscriber in subscribers:
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    # Slow client: discard its backlog and ask it to resync
+                    try:
+                        while True:
+                            subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+                    subscriber.put_nowait(dict(self.RESYNC, id=message['id']))
+                    with self._lock:
+                        self.dropped += 1
+
+
+InventorySnapshot = namedtuple('InventorySnapshot', 'vms body etag taken_at index')
+
+
+class QueryError(Exception):
+    pass
+
+
+class InventoryIndex:
+    """
+    Read-only lookup structures over one inventory snapshot.
+
+    Sorted orders are built on first use, for the whole fleet or for one
+    state, and reused until the next snapshot, so a state filter only walks
+    that state's records. A name prefix is a bisect range of the name
+    order; with another sort only the matching records are sorted.
+    """
+
+    def __init__(self, vms):
+        self._vms = vms
+        self._by_state = {}
+        for vm in vms:
+            self._by_state.setdefault(vm['state'], []).append(vm)
+        self._orders = {}  # (state or None, field) -> (keys, records)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sorted(vms, field):
+        ordered = sorted(vms, key=lambda vm: (vm[field], vm['name']))
+        return [(vm[field], vm['name']) for vm in ordered], ordered
+
+    def _order(self, field, state=None):
+        with self._lock:
+            order = self._orders.get((state, field))
+            if order is None:
+                vms = self._vms if state is None else self._by_state.get(state, [])
+                order = self._orders[(state, field)] = self._sorted(vms, field)
+            return order
+
+    def query(self, state=None, name_prefix=None, sort='name', limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """Return (page, next_cursor); cursor is the sort key of the last item."""
+        descending = sort.startswith('-')
+        field = sort.lstrip('-')
+        if field not in VM_FIELDS:
+            raise QueryError(f'cannot sort by {field!r}')
+
+        if name_prefix:
+            keys, vms = self._order('name', state)
+            low = bisect.bisect_left(keys, (name_prefix,))
+            high = bisect.bisect_left(keys, (name_prefix + '\U0010ffff',))
+            if field == 'name':
+                keys, vms = keys[low:high], vms[low:high]
+            else:
+                keys, vms = self._sorted(vms[low:high], field)
+        else:
+            keys, vms = self._order(field, state)
+
+        if descending:
+            end = len(keys) if cursor is None else bisect.bisect_left(keys, cursor)
+            page = vms[max(0, end - limit - 1):end][::-1]
+        else:
+            start = 0 if cursor is None else bisect.bisect_right(keys, cursor)
+            page = vms[start:start + limit + 1]
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = [page[-1][field], page[-1]['name']]
+        return page, next_cursor
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(sort value, name) from a next_cursor; QueryError if it is not one"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise QueryError('invalid cursor')
+    if (not isinstance(key, list) or len(key) != 2 or not isinstance(key[1], str)
+            or isinstance(key[0], (list, dict))):
+        raise QueryError('invalid cursor')
+    return tuple(key)
+
+
+def project(vm, fields):
+    return {field: vm[field] for field in fields}
+
+
+class InventoryCache:
+    """
+    Shared, serialized snapshot of the VM list.
+
+    One background thread rescans libvirt every `interval` seconds, or as
+    soon as a lifecycle event arrives, so any number of GET /vms pollers
+    cost a single scan per interval. The body is kept pre-serialized with
+    a content-hash ETag.
+    """
+
+    def __init__(self, conn_pool, events, interval=INVENTORY_INTERVAL, host=None):
+        self.pool = conn_pool
+        self.events = events
+        self.interval = interval
+        self.host = host
+        self.scans = 0
+        self.last_scan_ms = None  # duration of the last successful scan
+        self.last_error = None    # message of the last failed scan, cleared on success
+        self._snapshot = None  # InventorySnapshot
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _record(self, domain, state, memory_kib, vcpus, cpu_time_ns):
+        return {
+            'name': domain.name(),
+            'id': domain.ID(),
+            'isActive': int(state not in (libvirt.VIR_DOMAIN_NOSTATE, libvirt.VIR_DOMAIN_SHUTOFF)),
+            'state': DOMAIN_STATES.get(state, 'unknown'),
+            'uuid': domain.UUIDString(),
+            'memory': memory_kib // 1024,
+            'vcpus': vcpus,
+            'cpu_time': round(cpu_time_ns / 1e9, 2),
+            'host': self.host,
+        }
+
+    def _scan(self):
+        def fetch(conn):
+            try:
+                stats = conn.getAllDomainStats(INVENTORY_STATS)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() not in (libvirt.VIR_ERR_NO_SUPPORT, libvirt.VIR_ERR_RPC):
+                    raise
+                # Older daemon: one info() call per domain
+                records = []
+                for d in conn.listAllDomains():
+                    info = d.info()
+                    records.append(self._record(d, info[0], info[1], info[3], info[4]))
+                return records
+            return [self._record(d, st.get('state.state', libvirt.VIR_DOMAIN_NOSTATE),
+                                 st.get('balloon.maximum', 0), st.get('vcpu.current', 0),
+                                 st.get('cpu.time', 0))
+                    for d, st in stats]
+        return self.pool.run(fetch)
+
+    def refresh(self, newer_than=None):
+        """
+        Rescan libvirt. Concurrent callers share one scan: if a snapshot
+        newer than `newer_than` appeared while waiting, it is reused.
+        """
+        with self._refresh_lock:
+            current = self._snapshot
+            if newer_than is not None and current is not None and current.taken_at >= newer_than:
+                return current
+            started = time.monotonic()
+            try:
+                vms = self._scan()
+            except (libvirt.libvirtError, PoolExhausted) as e:
+                self.last_error = str(e)
+                raise
+            elapsed = time.monotonic() - started
+            instrumentation.registry.observe('inventory_refresh', elapsed, self.host or '')
+            self.last_scan_ms = round(elapsed * 1000, 1)
+            self.last_error = None
+            body = json.dumps([project(vm, DEFAULT_FIELDS) for vm in vms], sort_keys=True)
+            etag = '"%s"' % hashlib.sha1(body.encode()).hexdigest()
+            snapshot = InventorySnapshot(vms, body, etag, time.monotonic(), InventoryIndex(vms))
+            with self._lock:
+                self._snapshot = snapshot
+                self.scans += 1
+            return snapshot
+
+    def get(self, max_age=None):
+        """
+        Current snapshot; rescans first if older than max_age seconds. If the
+        host is unreachable the last good snapshot is served (see stale_hosts).
+        """
+        self._start()
+        with self._lock:
+            snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is None or (max_age is not None and now - snapshot.taken_at > max_age):
+            try:
+                snapshot = self.refresh(newer_than=now - (max_age or 0))
+            except (libvirt.libvirtError, PoolExhausted):
+                if snapshot is None:
+                    raise
+        return snapshot
+
+    def stale_hosts(self):
+        """Hosts whose data in get() is not current (this one, if its last scan failed)."""
+        return [self.host or self.pool.uri] if self.last_error is not None else []
+
+    def current(self):
+        """Latest snapshot without scanning (None before the first scan)."""
+        with self._lock:
+            return self._snapshot
+
+    def invalidate(self):
+        """Ask the background thread for a rescan (e.g. after an action)."""
+        self._wakeup.set()
+
+    def _on_event(self, message):
+        self.invalidate()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            name = f'inventory-{self.host}' if self.host else 'inventory'
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.events.add_listener(self._on_event)
+        try:
+            self.events.ensure_subscription()
+        except libvirt.libvirtError as e:
+            print(f"Inventory falls back to periodic scans only: {e}")
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.refresh()
+            except (libvirt.libvirtError, PoolExhausted) as e:
+                print(f"Inventory refresh failed for {self.host or self.pool.uri}: {e}")
+                continue
+            try:
+                # Back to event-driven rescans once the host is reachable again
+                self.events.ensure_subscription()
+            except libvirt.libvirtError:
+                pass  # periodic scans cover the gap; retried after the backoff
+
+
+# One hypervisor: its own connection pool, event subscription and inventory
+# thread, so hosts are scanned concurrently and independently
+Host = namedtuple('Host', 'name uri pool events inventory')
+
+
+def host_name(uri):
+    """Short name of a libvirt URI's host (the URI itself for local ones)."""
+    return urlparse(uri).hostname or uri
+
+
+def make_hosts(uris):
+    hosts = {}
+    for uri in uris:
+        name = host_name(uri)
+        if name in hosts:
+            name = uri
+        conn_pool = ConnectionPool(uri, name=name)
+        events = EventBroadcaster(uri, name=name)
+        hosts[name] = Host(name, uri, conn_pool, events,
+                           InventoryCache(conn_pool, events, host=name))
+    return hosts
+
+
+class AggregateInventory:
+    """
+    Merged inventory of every host for GET /vms.
+
+    Each host is asked for its snapshot in parallel, with at most one
+    outstanding request per host. A host that has not answered within
+    HOST_WAIT seconds contributes its previous snapshot (or nothing), so
+    a dead hypervisor never delays the others. The merged snapshot is
+    rebuilt only when some host's snapshot changed.
+    """
+
+    def __init__(self, hosts, wait_timeout=HOST_WAIT):
+        self.hosts = hosts
+        self.wait_timeout = wait_timeout
+        self._executor = ThreadPoolExecutor(max_workers=len(hosts), thread_name_prefix='host')
+        self._pending = {}  # host name -> Future of InventoryCache.get
+        self._merged = None  # (per-host snapshots it was built from, InventorySnapshot)
+        self._lock = threading.Lock()
+
+    def _request(self, host, max_age):
+        with self._lock:
+            future = self._pending.get(host.name)
+            if future is None or future.done():
+                future = self._pending[host.name] = self._executor.submit(
+                    host.inventory.get, max_age)
+            return future
+
+    def get(self, max_age=None):
+        futures = [(host, self._request(host, max_age)) for host in self.hosts.values()]
+        wait([future for _, future in futures], timeout=self.wait_timeout)
+
+        parts = []
+        for host, future in futures:
+            if future.done() and future.exception() is None:
+                parts.append(future.result())
+            else:
+                parts.append(host.inventory.current())
+        # Reuse the merge only while every host serves the very same snapshot:
+        # host etags cover just the default fields, not state, memory or cpu_time
+        with self._lock:
+            if self._merged is not None and all(
+                    old is new for old, new in zip(self._merged[0], parts)):
+                return self._merged[1]
+
+        vms = [vm for part in parts if part is not None for vm in part.vms]
+        body = json.dumps([project(vm, AGGREGATE_FIELDS) for vm in vms], sort_keys=True)
+        etag = '"%s"' % hashlib.sha1(body.encode()).hexdigest()
+        taken_at = min((part.taken_at for part in parts if part is not None), default=time.monotonic())
+        snapshot = InventorySnapshot(vms, body, etag, taken_at, InventoryIndex(vms))
+        with self._lock:
+            self._merged = (tuple(parts), snapshot)
+        return snapshot
+
+    def invalidate(self):
+        for host in self.hosts.values():
+            host.inventory.invalidate()
+
+    def stale_hosts(self):
+        """Hosts whose last scan failed or that have no snapshot yet."""
+        return [host.name for host in self.hosts.values()
+                if host.inventory.last_error is not None or host.inventory.current() is None]
+
+
+start_event_loop()
+hosts = make_hosts(LIBVIRT_URIS)
+primary = next(iter(hosts.values()))
+pool, broadcaster, inventory = primary.pool, primary.events, primary.inventory
+aggregate = AggregateInventory(hosts)
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+@app.errorhandler(PoolExhausted)
+def pool_exhausted(e):
+    return jsonify({'error': str(e)}), 503
+
+@app.errorhandler(UnknownHost)
+def unknown_host(e):
+    return jsonify({'error': str(e), 'hosts': list(hosts)}), 404
+
+def requested_host(name=None):
+    """Host named by `name` or the ?host= argument; the first host by default."""
+    name = name or request.args.get('host')
+    if not name:
+        return primary
+    if name not in hosts:
+        raise UnknownHost(f'unknown host {name!r}')
+    return hosts[name]
+
+def requested_max_age():
+    """max-age from the request's Cache-Control header (no-cache means 0)."""
+    cache_control = request.headers.get('Cache-Control', '')
+    for directive in cache_control.split(','):
+        directive = directive.strip().lower()
+        if directive == 'no-cache':
+            return 0
+        if directive.startswith('max-age='):
+            try:
+                return max(0, int(directive[len('max-age='):]))
+            except ValueError:
+                pass
+    return None
+
+def etag_matches(etag):
+    """True if the request's If-None-Match lists `etag` (weakly) or is '*'."""
+    for candidate in request.headers.get('If-None-Match', '').split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+def query_page(snapshot, args):
+    """
+    Answer a filtered GET /vms from the snapshot index. Returns the JSON
+    body of {items, next_cursor}; its cost grows with the page size.
+    """
+    fields = DEFAULT_FIELDS
+    if args.get('fields'):
+        fields = ['name'] + [f for f in args['fields'].split(',') if f and f != 'name']
+        unknown = [f for f in fields if f not in VM_FIELDS]
+        if unknown:
+            raise QueryError(f'unknown fields: {", ".join(unknown)}')
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise QueryError('limit must be an integer')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise QueryError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    state = args.get('state') or None
+    if state is not None and state not in DOMAIN_STATES.values():
+        raise QueryError(f'unknown state {state!r}')
+    cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+
+    try:
+        page, next_cursor = snapshot.index.query(
+            state=state, name_prefix=args.get('name_prefix') or None,
+            sort=args.get('sort', 'name'), limit=limit, cursor=cursor)
+    except TypeError:
+        raise QueryError('cursor does not match the requested sort')
+    return json.dumps({
+        'items': [project(vm, fields) for vm in page],
+        'next_cursor': encode_cursor(next_cursor) if next_cursor else None,
+    })
+
+# List all VMs (filters: host, state, name_prefix, fields, sort, limit, cursor).
+# With several hosts and no ?host= the list covers every host.
 @app.route('/vms', methods=['GET'])
 def list_vms():
-    conn = get_conn()
-    domains = conn.listAllDomains()
-    vms = [{
-        'name': d.name(),
-        'id': d.ID(),
-        'isActive': d.isActive()
-    } for d in domains]
-    conn.close()
-    return jsonify(vms)
+    if len(hosts) > 1 and not request.args.get('host'):
+        source = aggregate
+    else:
+        source = requested_host().inventory
+    snapshot = source.get(requested_max_age())
+    stale = source.stale_hosts()
+    body, etag = snapshot.body, snapshot.etag
+    args = {key: value for key, value in request.args.items() if key != 'host'}
+    if args:
+        try:
+            body = query_page(snapshot, args)
+        except QueryError as e:
+            return jsonify({'error': str(e)}), 400
+        etag = '"%s"' % hashlib.sha1(body.encode()).hexdigest()
+    headers = {'ETag': etag, 'Cache-Control': f'max-age={INVENTORY_MAX_AGE}'}
+    if stale:
+        # Cached inventory of hosts that are reconnecting
+        headers['Warning'] = '110 - "Response is Stale"'
+        headers['X-Stale-Hosts'] = ','.join(stale)
+    if etag_matches(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
 
 # Start a VM
 @app.route('/vms/<name>/start', methods=['POST'])
 def start_vm(name):
-    conn = get_conn()
-    domain = conn.lookupByName(name)
-    domain.create()
-    conn.close()
+    host = requested_host()
+    with host.pool.connection() as conn:
+        domain = conn.lookupByName(name)
+        domain.create()
+    host.inventory.invalidate()
     return jsonify({'status': 'started'})
 
 # Stop a VM
 @app.route('/vms/<name>/stop', methods=['POST'])
 def stop_vm(name):
-    conn = get_conn()
-    domain = conn.lookupByName(name)
-    domain.shutdown()
-    conn.close()
+    host = requested_host()
+    with host.pool.connection() as conn:
+        domain = conn.lookupByName(name)
+        domain.shutdown()
+    host.inventory.invalidate()
     return jsonify({'status': 'stopped'})
 
+def run_lifecycle_action(name, action, host=primary):
+    """Run one batch entry and return its result with timing."""
+    started = time.monotonic()
+    result = {'name': name, 'action': action, 'host': host.name}
+    try:
+        with host.pool.connection() as conn:
+            BATCH_ACTIONS[action](conn.lookupByName(name))
+        result['ok'] = True
+        host.inventory.invalidate()
+    except (libvirt.libvirtError, PoolExhausted) as e:
+        result['ok'] = False
+        result['error'] = str(e)
+    result['elapsed_ms'] = round((time.monotonic() - started) * 1000, 1)
+    return result
+
+# Run lifecycle actions on many VMs concurrently
+@app.route('/vms/batch', methods=['POST'])
+def batch_vms():
+    payload = request.get_json(silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        return jsonify({'error': 'expected a list of {name, action} entries'}), 400
+    for item in items:
+        if (not isinstance(item, dict) or not isinstance(item.get('name'), str)
+                or item.get('action') not in BATCH_ACTIONS):
+            return jsonify({'error': f'invalid entry: {item!r}',
+                            'actions': sorted(BATCH_ACTIONS)}), 400
+        # Entries may target any host; the default is ?host= or the first one
+        requested_host(item.get('host'))
+
+    started = time.monotonic()
+    futures = [batch_executor.submit(run_lifecycle_action, item['name'], item['action'],
+                                     requested_host(item.get('host')))
+               for item in items]
+
+    def summary(results):
+        succeeded = sum(1 for r in results if r['ok'])
+        return {'total': len(results), 'succeeded': succeeded,
+                'failed': len(results) - succeeded,
+                'elapsed_ms': round((time.monotonic() - started) * 1000, 1)}
+
+    stream = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+    if isinstance(payload, dict) and payload.get('stream'):
+        stream = True
+    if stream:
+        # One JSON document per line as each action finishes, then a summary
+        def generate():
+            results = []
+            for future in as_completed(futures):
+                results.append(future.result())
+                yield json.dumps(results[-1]) + '\n'
+            yield json.dumps({'done': True, **summary(results)}) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    results = [future.result() for future in futures]
+    return jsonify({'results': results, **summary(results)})
+
+# Stream VM state changes as Server-Sent Events (one host per stream)
+@app.route('/vms/events', methods=['GET'])
+def vm_events():
+    broadcaster = requested_host().events
+    try:
+        subscriber = broadcaster.subscribe()
+    except libvirt.libvirtError as e:
+        return jsonify({'error': f'cannot subscribe to libvirt events: {e}'}), 503
+
+    def stream():
+        try:
+            # Tell the client to load the full list before applying events
+            yield f"event: resync\ndata: {json.dumps(broadcaster.RESYNC)}\n\n"
+            while True:
+                try:
+                    message = subscriber.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    try:
+                        broadcaster.ensure_subscription()
+                    except libvirt.libvirtError as e:
+                        print(f"Event connection unavailable: {e}")
+                    continue
+                yield (f"id: {message['id']}\nevent: {message['type']}\n"
+                       f"data: {json.dumps(message)}\n\n")
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Connection pool metrics
+@app.route('/pool', methods=['GET'])
+def pool_stats():
+    return jsonify(requested_host().pool.stats())
+
+# Health and scan latency of every host
+@app.route('/hosts', methods=['GET'])
+def list_hosts():
+    now = time.monotonic()
+    result = []
+    for host in hosts.values():
+        snapshot = host.inventory.current()
+        if host.inventory.last_error is not None:
+            health = 'down'
+        else:
+            health = 'ok' if snapshot is not None else 'unknown'
+        result.append({
+            'name': host.name,
+            'uri': host.uri,
+            'health': health,
+            'latency_ms': host.inventory.last_scan_ms,
+            'age_s': round(now - snapshot.taken_at, 1) if snapshot is not None else None,
+            'vms': len(snapshot.vms) if snapshot is not None else None,
+            'error': host.inventory.last_error,
+            'reconnect_in': round(host.pool.backoff.remaining(), 1),
+        })
+    return jsonify(result)
+
+# Per-RPC libvirt latency histograms and scan timings (Prometheus text format)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(instrumentation.registry.prometheus_text(),
+                    mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True, port=8080)
@@ -9,12 +9,1787 @@ Gestor de Máquinas Virtuales usando libvirt y tkinter
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, simpledialog
 import libvirt
+import instrumentation
 import xml.etree.ElementTree as ET
 import os
 import threading
+import queue
+import random
 import time
 from datetime import datetime
+from collections import namedtuple, OrderedDict
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import re
 import subprocess
+import json
+import weakref
+import socket
+import tempfile
+from urllib.parse import urlparse
+import base64
+import struct
+import zlib
+
+# Grupos de estadísticas que se piden en bloque al refrescar la lista
+BULK_STATS = (libvirt.VIR_DOMAIN_STATS_STATE |
+              libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+              libvirt.VIR_DOMAIN_STATS_VCPU |
+              libvirt.VIR_DOMAIN_STATS_BALLOON |
+              libvirt.VIR_DOMAIN_STATS_BLOCK |
+              libvirt.VIR_DOMAIN_STATS_INTERFACE)
+
+# Datos de una VM necesarios para la lista (max_mem en MB, cpu_time en ns).
+# io son los contadores acumulados (DomainIO); cpu_percent e io_rate (bytes/s
+# de disco y red sumados) los calcula MetricsCollector con muestras sucesivas.
+DomainRecord = namedtuple('DomainRecord', 'uuid name state vcpus max_mem cpu_time io '
+                                          'cpu_percent io_rate',
+                          defaults=(0, None, None, None))
+
+# Contadores de E/S de una VM.
+# blocks: ((disco, lecturas, bytes leídos, escrituras, bytes escritos), ...)
+# nets: ((interfaz, bytes recibidos, bytes enviados), ...)
+DomainIO = namedtuple('DomainIO', 'blocks nets')
+
+# Columnas del Treeview de VMs, en el orden de sus valores
+TREE_COLUMNS = ('Estado', 'CPU', 'RAM', 'CPU%', 'E/S')
+
+# Clave de ordenación de cada columna del Treeview ('#0' es el nombre)
+TREE_SORT_KEYS = {
+    '#0': lambda record: record.name.lower(),
+    'Estado': lambda record: record.state,
+    'CPU': lambda record: record.vcpus,
+    'RAM': lambda record: record.max_mem,
+    'CPU%': lambda record: record.cpu_percent or 0.0,
+    'E/S': lambda record: record.io_rate or 0.0,
+}
+
+# Hosts de libvirt: lista de URIs separadas por comas en VM_CLIENT_URIS, o un
+# fichero con una URI por línea en VM_CLIENT_HOSTS_FILE (# inicia un comentario)
+DEFAULT_LIBVIRT_URI = "qemu+tcp://192.168.64.2/system"
+LIBVIRT_URIS = os.environ.get('VM_CLIENT_URIS', '')
+HOSTS_FILE = os.environ.get('VM_CLIENT_HOSTS_FILE')
+
+# Salud de un host de libvirt según su último sondeo: degraded es un sondeo
+# fallido con la conexión viva; reconnecting, una conexión perdida que el hilo
+# del host intenta reabrir
+HOST_HEALTH_LABELS = {
+    'connecting': '⚪ Conectando',
+    'ok': '🟢 En línea',
+    'degraded': '🟡 Degradado',
+    'reconnecting': '🟠 Reconectando',
+}
+
+# Keepalive de libvirt: segundos entre sondas y sondas sin respuesta tras las
+# que la conexión se da por muerta (requiere el bucle de eventos)
+KEEPALIVE_INTERVAL = int(os.environ.get('VM_CLIENT_KEEPALIVE_INTERVAL', '5'))
+KEEPALIVE_COUNT = int(os.environ.get('VM_CLIENT_KEEPALIVE_COUNT', '3'))
+
+# Reconexión con espera exponencial: primer y máximo plazo en segundos; cada
+# plazo se elige al azar entre su mitad y su valor para no sincronizar clientes
+RECONNECT_MIN_DELAY = float(os.environ.get('VM_CLIENT_RECONNECT_MIN', '1'))
+RECONNECT_MAX_DELAY = float(os.environ.get('VM_CLIENT_RECONNECT_MAX', '60'))
+
+# Motivos de cierre que libvirt pasa al callback de registerCloseCallback
+CLOSE_REASONS = {
+    libvirt.VIR_CONNECT_CLOSE_REASON_ERROR: "error de comunicación",
+    libvirt.VIR_CONNECT_CLOSE_REASON_EOF: "el host cerró la conexión",
+    libvirt.VIR_CONNECT_CLOSE_REASON_KEEPALIVE: "el host no responde al keepalive",
+    libvirt.VIR_CONNECT_CLOSE_REASON_CLIENT: "cerrada por el cliente",
+}
+
+# Segundos entre sondeos automáticos de libvirt (hilo en segundo plano)
+POLL_INTERVAL = float(os.environ.get('VM_CLIENT_POLL_INTERVAL', '5'))
+
+# Modo eventos: la lista se actualiza con eventos de libvirt y el sondeo
+# completo solo se hace cada RECONCILE_INTERVAL segundos como respaldo
+EVENT_MODE = os.environ.get('VM_CLIENT_EVENTS', '1') != '0'
+RECONCILE_INTERVAL = float(os.environ.get('VM_CLIENT_RECONCILE_INTERVAL', '60'))
+
+# Eventos de dominio que disparan una actualización parcial
+DOMAIN_EVENT_IDS = (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                    libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+                    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+                    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+                    libvirt.VIR_DOMAIN_EVENT_ID_TUNABLE)
+
+# Segundos durante los que se reutiliza la memoria libre por nodo NUMA que
+# muestra el panel de detalles (la fijación de CPUs se guarda por generación)
+NODE_MEMORY_INTERVAL = float(os.environ.get('VM_CLIENT_NODE_MEMORY_INTERVAL', '30'))
+
+# Métricas de CPU: segundos entre muestras en modo eventos (0 = desactivado)
+# y número de muestras que se conservan por VM
+METRICS_INTERVAL = float(os.environ.get('VM_CLIENT_METRICS_INTERVAL', '5'))
+METRICS_HISTORY = int(os.environ.get('VM_CLIENT_METRICS_HISTORY', '60'))
+
+# Resumen del uso de CPU (%) de una VM; history va de la muestra más antigua a la actual
+CpuSummary = namedtuple('CpuSummary', 'history current average peak')
+
+# Tasas de E/S por dispositivo de una VM.
+# blocks: ((disco, IOPS lectura, B/s lectura, IOPS escritura, B/s escritura), ...)
+# nets: ((interfaz, B/s recibidos, B/s enviados), ...)
+IORates = namedtuple('IORates', 'blocks nets')
+
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+
+# Máximo de configuraciones de dominio analizadas que se guardan en caché
+CONFIG_CACHE_SIZE = int(os.environ.get('VM_CLIENT_CONFIG_CACHE_SIZE', '256'))
+
+# Resumen de la configuración XML de un dominio (memory en MB).
+# interfaces: ((tipo, red), ...); disks: ((tipo, ruta), ...);
+# cdroms: (ruta ISO o None, ...); vnc: (puerto, autoport, listen) o None.
+# disk_targets / iface_targets: dispositivos destino (vda, vnet0...) para E/S
+DomainConfig = namedtuple('DomainConfig', 'os_type machine memory vcpus interfaces '
+                                          'disks cdroms vnc disk_targets iface_targets')
+
+# Pantalla VNC de una VM en ejecución; listen es la dirección en el host de libvirt
+DisplayEndpoint = namedtuple('DisplayEndpoint', 'name listen port')
+
+# Pantallas VNC nuevas que se resuelven como mucho en cada sondeo; el resto
+# queda para los siguientes (y se lee al momento si se pide conectar)
+DISPLAY_BATCH = int(os.environ.get('VM_CLIENT_DISPLAY_BATCH', '8'))
+
+# Direcciones de escucha que solo son accesibles desde el propio host
+LOOPBACK_ADDRESSES = ('127.0.0.1', 'localhost', '::1')
+
+# Usuario SSH para los túneles VNC (por defecto el de la URI de libvirt) y
+# segundos máximos de espera hasta que el túnel acepta conexiones
+SSH_USER = os.environ.get('VM_CLIENT_SSH_USER')
+TUNNEL_TIMEOUT = float(os.environ.get('VM_CLIENT_TUNNEL_TIMEOUT', '10'))
+
+# Miniaturas de pantalla: tamaño máximo (px), segundos entre capturas de una
+# miniatura visible, capturas por segundo como máximo contra cada host y memoria
+# máxima de la caché de imágenes ya escaladas
+THUMBNAIL_SIZE = (192, 144)
+THUMBNAIL_INTERVAL = float(os.environ.get('VM_CLIENT_THUMBNAIL_INTERVAL', '3'))
+SCREENSHOT_RATE = float(os.environ.get('VM_CLIENT_SCREENSHOT_RATE', '4'))
+THUMBNAIL_CACHE_MB = float(os.environ.get('VM_CLIENT_THUMBNAIL_CACHE_MB', '16'))
+
+# Miniatura en caché: png ya reducido a THUMBNAIL_SIZE, listo para Tk (o None
+# si falló la captura, con el motivo en error) y momento de la captura
+Thumbnail = namedtuple('Thumbnail', 'png taken_at error')
+
+# Detalles de una VM ya extraídos de libvirt, listos para mostrarse
+# numa es un NumaUsage o None si no se pudo obtener
+VMDetails = namedtuple('VMDetails', 'name uuid id state max_mem cpu_time config cpu io numa',
+                       defaults=(None,))
+
+# Topología NUMA del host: cpus es el total de CPUs lógicas (tamaño de los
+# cpumap de libvirt); nodes son NumaNode(id, (cpu, ...), memoria total en MB)
+HostTopology = namedtuple('HostTopology', 'cpus nodes')
+NumaNode = namedtuple('NumaNode', 'id cpus memory_mb')
+
+# Ubicación de una VM nueva: nodo NUMA para numatune (o None), cpuset de cada
+# vCPU y cpuset del emulador (y de los iothreads)
+NumaPlacement = namedtuple('NumaPlacement', 'node vcpu_sets emulator_set')
+
+# Fijación actual de una VM para el panel de detalles.
+# nodes: ((nodo, cpuset, MB libres, MB totales), ...)
+# vcpus: ((vCPU, cpuset, (nodos, ...)), ...); emulator: (cpuset, (nodos, ...)) o None
+NumaUsage = namedtuple('NumaUsage', 'nodes vcpus emulator')
+
+# Directorio donde se crean los discos de las VMs nuevas
+IMAGES_DIR = '/var/lib/libvirt/images'
+
+# Hilos para crear discos y definir VMs en paralelo en el modo lote
+PROVISION_WORKERS = int(os.environ.get('VM_CLIENT_PROVISION_WORKERS', '8'))
+
+# Apagado ordenado: segundos de plazo por VM tras la señal ACPI (el total,
+# también con reintento), política al vencer el plazo (clave de
+# SHUTDOWN_POLICIES) y máximo de VMs en paralelo
+SHUTDOWN_DEADLINE = float(os.environ.get('VM_CLIENT_SHUTDOWN_DEADLINE', '120'))
+SHUTDOWN_POLICY = os.environ.get('VM_CLIENT_SHUTDOWN_POLICY', 'retry')
+SHUTDOWN_WORKERS = int(os.environ.get('VM_CLIENT_SHUTDOWN_WORKERS', '64'))
+SHUTDOWN_POLICIES = {
+    'retry': "Reenviar la señal ACPI a mitad de plazo y luego forzar (destroy)",
+    'destroy': "Forzar (destroy) al vencer el plazo",
+    'leave': "Dejar la VM encendida y marcarla como fallida",
+}
+
+# Cada cuántos segundos se comprueba el estado mientras se espera un apagado
+# (con eventos es solo una red de seguridad por si se pierde alguno)
+SHUTDOWN_CHECK_INTERVAL = 5.0
+SHUTDOWN_EVENT_CHECK_INTERVAL = 30.0
+
+# Hilos de la cola de eliminación de VMs
+DELETE_WORKERS = int(os.environ.get('VM_CLIENT_DELETE_WORKERS', '4'))
+
+# Al eliminar una VM se borran también sus metadatos de instantáneas y
+# checkpoints, el estado guardado y la NVRAM
+UNDEFINE_FLAGS = (libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+                  libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
+                  libvirt.VIR_DOMAIN_UNDEFINE_CHECKPOINTS_METADATA |
+                  libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
+
+# Imágenes base (golden images) para crear clones enlazados, y formato
+# de cada extensión reconocida en ese directorio
+BASE_IMAGES_DIR = os.environ.get('VM_CLIENT_BASE_IMAGES_DIR', f'{IMAGES_DIR}/base')
+BASE_IMAGE_FORMATS = {'.qcow2': 'qcow2', '.img': 'raw', '.raw': 'raw'}
+
+# Imagen base del catálogo (virtual_gb: tamaño visto por la VM; size_mb: ocupado en disco)
+BaseImage = namedtuple('BaseImage', 'name path format virtual_gb size_mb')
+
+# Motor de virtualización para las VMs nuevas, según las capacidades del host.
+# domain_type: 'kvm' o 'qemu' (TCG); cpu_mode: modo <cpu> o None; reason: texto para el usuario
+EngineInfo = namedtuple('EngineInfo', 'domain_type cpu_mode emulator reason')
+
+# Emulador por defecto si el host no informa uno
+DEFAULT_EMULATOR = '/usr/bin/qemu-system-x86_64'
+
+# Modos de CPU preferidos por tipo de dominio, del más al menos deseable
+ENGINE_CPU_MODES = {
+    'kvm': ('host-passthrough', 'host-model'),
+    'qemu': ('host-model',),
+}
+
+# Segundos entre consultas del avance de un blockPull al aplanar un disco
+FLATTEN_POLL_INTERVAL = 1.0
+
+# Perfil de rendimiento de los dispositivos de una VM nueva: caché/io y
+# discard del disco, iothreads dedicados (0 = ninguno), colas de virtio-net
+# según las vCPUs, memoria con hugepages, sin pantalla y free page reporting
+PerformanceProfile = namedtuple('PerformanceProfile', 'label cache io discard iothreads multiqueue '
+                                                      'hugepages headless free_page_reporting')
+
+PERFORMANCE_PROFILES = {
+    'default': PerformanceProfile("Estándar (valores por defecto de libvirt)",
+                                  None, None, None, 0, False, False, False, False),
+    'throughput': PerformanceProfile("Throughput: io_uring, 2 iothreads, multicola",
+                                     'none', 'io_uring', 'unmap', 2, True, False, False, False),
+    'latency': PerformanceProfile("Latencia: io nativo, iothread dedicado, multicola",
+                                  'none', 'native', 'unmap', 1, True, False, False, False),
+    'dense': PerformanceProfile("Densidad: sin pantalla, discard y devolución de memoria",
+                                'writeback', 'threads', 'unmap', 0, False, False, True, True),
+}
+DEFAULT_PROFILE = 'default'
+
+# Tamaños de hugepage (KiB) que se suman al comprobar si caben las VMs
+HUGEPAGE_SIZES_KIB = (2048, 1048576)
+
+# Máximo de colas de virtio-net por interfaz
+MAX_NET_QUEUES = 8
+
+# Parámetros ya validados de una VM a crear. Con backing (BaseImage) el disco
+# es un overlay qcow2 sobre la imagen base; disk_gb None conserva su tamaño.
+# profile es un PerformanceProfile (None = perfil por defecto) y placement
+# un NumaPlacement (None = sin fijar).
+VMSpec = namedtuple('VMSpec', 'name memory_mb vcpus disk_gb os_type iso_path disk_path backing '
+                              'profile placement',
+                    defaults=(None, None, None))
+
+# Resultado inmutable de un sondeo que el hilo de fondo de un host (HostConnection)
+# entrega a la interfaz. Si partial es True solo contiene los dominios afectados
+# por eventos.
+InventorySnapshot = namedtuple('InventorySnapshot', 'host records rpc_count selected details '
+                                                    'details_error error partial removed')
+
+
+def is_active_state(state):
+    """Indica si un estado corresponde a un dominio activo (como isActive())"""
+    return state not in (libvirt.VIR_DOMAIN_NOSTATE, libvirt.VIR_DOMAIN_SHUTOFF)
+
+
+def format_rate(bytes_per_second):
+    """Formatear una tasa en bytes/s con la unidad adecuada"""
+    for unit in ('B/s', 'KB/s', 'MB/s'):
+        if bytes_per_second < 1024:
+            return f"{bytes_per_second:.0f} {unit}" if unit == 'B/s' else f"{bytes_per_second:.1f} {unit}"
+        bytes_per_second /= 1024
+    return f"{bytes_per_second:.1f} GB/s"
+
+
+def sparkline(values):
+    """Representar valores de 0 a 100 como una línea de bloques Unicode"""
+    top = len(SPARK_CHARS) - 1
+    return ''.join(SPARK_CHARS[min(top, int(value * top / 100 + 0.5))] for value in values)
+
+
+class MetricsHistory:
+    """
+    Métricas de una VM: muestras de CPU% en un buffer circular de tamaño
+    fijo, más los últimos contadores y tasas de E/S.
+    """
+
+    __slots__ = ('samples', 'count', 'next', 'last_cpu_time', 'last_wall',
+                 'last_io', 'io_rates')
+
+    def __init__(self, size):
+        self.samples = array('d', bytes(8 * size))
+        self.count = 0
+        self.next = 0
+        self.last_cpu_time = 0
+        self.last_wall = None
+        self.last_io = None
+        self.io_rates = None
+
+    def append(self, value):
+        self.samples[self.next] = value
+        self.next = (self.next + 1) % len(self.samples)
+        if self.count < len(self.samples):
+            self.count += 1
+
+    def values(self):
+        size = len(self.samples)
+        start = (self.next - self.count) % size
+        return tuple(self.samples[(start + i) % size] for i in range(self.count))
+
+
+class MetricsCollector:
+    """
+    Calcula el uso de CPU de cada VM a partir de cpu_time de estadísticas
+    sucesivas, normalizado por el número de vCPUs, y las tasas de E/S a
+    partir de los contadores de disco y red. Cada VM tiene un MetricsHistory
+    de tamaño fijo, así que la memoria no crece con el tiempo.
+    """
+
+    def __init__(self, history_size=METRICS_HISTORY):
+        self.history_size = history_size
+        self._histories = {}  # uuid -> MetricsHistory
+
+    def sample(self, records, now, prune=False):
+        """Registrar una muestra y devolver los registros con cpu_percent"""
+        sampled = []
+        for record in records:
+            history = self._histories.get(record.uuid)
+            if history is None:
+                history = self._histories[record.uuid] = MetricsHistory(self.history_size)
+            percent = io_rate = None
+            if is_active_state(record.state):
+                elapsed = now - history.last_wall if history.last_wall is not None else 0
+                used = record.cpu_time - history.last_cpu_time
+                if elapsed > 0 and record.vcpus and used >= 0:
+                    percent = min(100.0, used / (elapsed * 1e9 * record.vcpus) * 100)
+                    history.append(percent)
+                if elapsed > 0 and record.io is not None and history.last_io is not None:
+                    history.io_rates = self._io_rates(history.last_io, record.io, elapsed)
+                    io_rate = (sum(r[2] + r[4] for r in history.io_rates.blocks) +
+                               sum(r[1] + r[2] for r in history.io_rates.nets))
+                history.last_cpu_time = record.cpu_time
+                history.last_io = record.io
+                history.last_wall = now
+            else:
+                history.last_wall = None
+                history.last_io = history.io_rates = None
+            sampled.append(record._replace(cpu_percent=percent, io_rate=io_rate))
+
+        # En un sondeo completo se descartan las VMs que ya no existen
+        if prune:
+            current = {record.uuid for record in records}
+            for uuid in [uuid for uuid in self._histories if uuid not in current]:
+                del self._histories[uuid]
+        return sampled
+
+    @staticmethod
+    def _io_rates(previous, current, elapsed):
+        """Tasas por segundo entre dos DomainIO; los contadores reiniciados cuentan como 0"""
+        def rates(old_rows, new_rows):
+            old = {row[0]: row for row in old_rows}
+            result = []
+            for row in new_rows:
+                base = old.get(row[0], row)
+                result.append((row[0],) + tuple(max(0, new - prev) / elapsed
+                                                 for new, prev in zip(row[1:], base[1:])))
+            return tuple(result)
+        return IORates(rates(previous.blocks, current.blocks), rates(previous.nets, current.nets))
+
+    def io_summary(self, uuid):
+        history = self._histories.get(uuid)
+        return history.io_rates if history is not None else None
+
+    def summary(self, uuid):
+        history = self._histories.get(uuid)
+        if history is None or not history.count:
+            return None
+        values = history.values()
+        return CpuSummary(values, values[-1], sum(values) / len(values), max(values))
+
+
+def parse_domain_config(xml_desc):
+    """Extraer un DomainConfig del XML de un dominio en una sola pasada"""
+    root = ET.fromstring(xml_desc)
+    os_type = machine = 'Desconocido'
+    memory, vcpus = 0, '0'
+    interfaces, disks, cdroms = [], [], []
+    disk_targets, iface_targets = [], []
+    vnc = None
+
+    for elem in root:
+        if elem.tag == 'os':
+            os_type_elem = elem.find('type')
+            if os_type_elem is not None:
+                os_type = os_type_elem.text
+                machine = os_type_elem.get('machine', 'Desconocido')
+        elif elem.tag == 'memory':
+            memory = int(elem.text) // 1024
+        elif elem.tag == 'vcpu':
+            vcpus = elem.text
+        elif elem.tag == 'devices':
+            for device in elem:
+                source = device.find('source')
+                target = device.find('target')
+                target_dev = target.get('dev') if target is not None else None
+                if device.tag == 'interface' and target_dev:
+                    iface_targets.append(target_dev)
+                elif device.tag == 'disk' and device.get('device') == 'disk' and target_dev:
+                    disk_targets.append(target_dev)
+                if device.tag == 'interface' and source is not None:
+                    network = source.get('network', source.get('bridge', 'Desconocido'))
+                    interfaces.append((device.get('type', 'Desconocido'), network))
+                elif device.tag == 'disk' and source is not None:
+                    if device.get('device') == 'disk':
+                        disks.append((device.get('type', 'Desconocido'),
+                                      source.get('file', source.get('dev', 'Desconocido'))))
+                    elif device.get('device') == 'cdrom':
+                        cdroms.append(source.get('file'))
+                elif device.tag == 'graphics' and device.get('type') == 'vnc' and vnc is None:
+                    vnc = (device.get('port'), device.get('autoport'),
+                           device.get('listen', '127.0.0.1'))
+
+    return DomainConfig(os_type, machine, memory, vcpus, tuple(interfaces),
+                        tuple(disks), tuple(cdroms), vnc, tuple(disk_targets),
+                        tuple(iface_targets))
+
+
+class DomainConfigCache:
+    """
+    Caché LRU de DomainConfig por UUID de dominio.
+
+    Cada entrada guarda la "generación" con la que se obtuvo: el ID del
+    dominio si estaba activo (el XML en vivo difiere del persistente y cambia
+    en cada arranque, p. ej. el puerto VNC autoasignado) o None si no. Si
+    cambia, o si llega un evento de definición/dispositivo, se vuelve a pedir
+    el XML. ID() no genera tráfico: viene con el objeto dominio.
+    """
+
+    def __init__(self, max_entries=CONFIG_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # uuid -> (generación, DomainConfig)
+        self._lock = threading.Lock()
+
+    def get(self, vm, active):
+        """Configuración de `vm`; solo llama a XMLDesc si no está en caché"""
+        uuid = vm.UUIDString()
+        generation = vm.ID() if active else None
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(uuid)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        config = parse_domain_config(vm.XMLDesc(0))
+        with self._lock:
+            self._entries[uuid] = (generation, config)
+            self._entries.move_to_end(uuid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return config
+
+    def invalidate(self, uuid):
+        with self._lock:
+            self._entries.pop(uuid, None)
+
+
+class PinningCache:
+    """
+    Fijación de CPUs (vCPUs y emulador) por UUID de dominio, con la misma
+    generación que DomainConfigCache: vcpuPinInfo/emulatorPinInfo solo se
+    piden si la VM se reinició o si un evento de ciclo de vida o de cputune
+    (o una fijación desde el cliente) invalidó la entrada.
+    """
+
+    def __init__(self, max_entries=CONFIG_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # uuid -> (generación, cpus por vCPU, cpus del emulador)
+        self._lock = threading.Lock()
+
+    def get(self, vm):
+        """((cpus de cada vCPU), cpus del emulador) de una VM en ejecución"""
+        uuid = vm.UUIDString()
+        generation = vm.ID()
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(uuid)
+                return entry[1:]
+
+        vcpus = tuple(map(cpumap_to_cpus, vm.vcpuPinInfo(0)))
+        emulator = cpumap_to_cpus(vm.emulatorPinInfo(0))
+        with self._lock:
+            self._entries[uuid] = (generation, vcpus, emulator)
+            self._entries.move_to_end(uuid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return vcpus, emulator
+
+    def invalidate(self, uuid):
+        with self._lock:
+            self._entries.pop(uuid, None)
+
+
+def display_endpoint(name, config):
+    """DisplayEndpoint a partir del DomainConfig en vivo, o None si no hay puerto VNC asignado"""
+    if config.vnc is None:
+        return None
+    port, _, listen = config.vnc
+    try:
+        port = int(port)
+    except (TypeError, ValueError):
+        return None
+    return DisplayEndpoint(name, listen or '127.0.0.1', port) if port > 0 else None
+
+
+def resolve_vnc_address(endpoint, libvirt_host):
+    """
+    (host, puerto, requiere túnel) al que debe conectarse el visor. Una
+    pantalla que solo escucha en loopback de un host remoto necesita un
+    túnel SSH; una que escucha en todas las interfaces se alcanza por el
+    nombre del host de libvirt.
+    """
+    remote = libvirt_host not in (None, '') and libvirt_host not in LOOPBACK_ADDRESSES
+    if endpoint.listen in LOOPBACK_ADDRESSES:
+        return '127.0.0.1', endpoint.port, remote
+    if endpoint.listen in ('0.0.0.0', '::'):
+        return (libvirt_host if remote else '127.0.0.1'), endpoint.port, False
+    return endpoint.listen, endpoint.port, False
+
+
+class DisplayEndpointTable:
+    """
+    Pantallas VNC de las VMs en ejecución por UUID. La mantiene el hilo de
+    sondeo con los eventos de arranque/parada; None indica una VM activa ya
+    consultada que no tiene VNC, para no volver a pedir su XML.
+    """
+
+    def __init__(self):
+        self._endpoints = {}  # uuid -> DisplayEndpoint o None
+        self._lock = threading.Lock()
+
+    def __contains__(self, uuid):
+        with self._lock:
+            return uuid in self._endpoints
+
+    def get(self, name):
+        with self._lock:
+            return next((endpoint for endpoint in self._endpoints.values()
+                         if endpoint is not None and endpoint.name == name), None)
+
+    def set(self, uuid, endpoint):
+        with self._lock:
+            self._endpoints[uuid] = endpoint
+
+    def discard(self, uuid):
+        with self._lock:
+            self._endpoints.pop(uuid, None)
+
+    def retain(self, uuids):
+        """Quitar las VMs que ya no están en ejecución"""
+        with self._lock:
+            for uuid in [uuid for uuid in self._endpoints if uuid not in uuids]:
+                del self._endpoints[uuid]
+
+    def ports(self):
+        with self._lock:
+            return {endpoint.port for endpoint in self._endpoints.values() if endpoint is not None}
+
+
+class TunnelError(Exception):
+    pass
+
+
+class SSHTunnelManager:
+    """
+    Túneles SSH locales hacia pantallas VNC que solo escuchan en loopback del
+    host de libvirt. Se reutiliza un túnel por puerto remoto mientras siga
+    vivo. Requiere autenticación sin contraseña (BatchMode).
+    """
+
+    def __init__(self, host, user=None):
+        self.host = host
+        self.user = user
+        self._tunnels = {}  # puerto remoto -> (Popen, puerto local)
+        self._opening = {}  # puerto remoto -> Lock de quien abre su túnel
+        self._lock = threading.Lock()
+
+    def open(self, remote_port):
+        """Abrir (o reutilizar) un túnel; bloquea hasta que acepta conexiones y devuelve el puerto local"""
+        with self._lock:
+            opening = self._opening.setdefault(remote_port, threading.Lock())
+        # Aperturas simultáneas del mismo puerto esperan a la primera y reutilizan su túnel
+        with opening:
+            with self._lock:
+                tunnel = self._tunnels.get(remote_port)
+                if tunnel is not None and tunnel[0].poll() is None:
+                    return tunnel[1]
+            tunnel = self._spawn(remote_port)
+            with self._lock:
+                self._tunnels[remote_port] = tunnel
+            return tunnel[1]
+
+    def _spawn(self, remote_port):
+        """Lanzar ssh y esperar a que el túnel acepte conexiones; devuelve (Popen, puerto local)"""
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            local_port = probe.getsockname()[1]
+        target = f"{self.user}@{self.host}" if self.user else self.host
+        command = ["ssh", "-N", "-o", "BatchMode=yes", "-o", "ExitOnForwardFailure=yes",
+                   "-L", f"127.0.0.1:{local_port}:127.0.0.1:{remote_port}", target]
+        # stderr a un archivo temporal: una tubería sin leer podría llenarse y bloquear ssh
+        with tempfile.TemporaryFile() as log:
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=log)
+            except FileNotFoundError:
+                raise TunnelError("El comando 'ssh' no fue encontrado.")
+
+            deadline = time.monotonic() + TUNNEL_TIMEOUT
+            while True:
+                if process.poll() is not None:
+                    log.seek(0)
+                    message = log.read().decode(errors='replace').strip()
+                    raise TunnelError(f"ssh terminó al abrir el túnel:\n{message}")
+                try:
+                    socket.create_connection(('127.0.0.1', local_port), timeout=0.5).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        process.terminate()
+                        raise TunnelError(f"El túnel hacia {target} no respondió en {TUNNEL_TIMEOUT:.0f} s")
+                    time.sleep(0.1)
+        return process, local_port
+
+    def close_unused(self, remote_ports):
+        """Cerrar los túneles cuyo puerto remoto ya no pertenece a ninguna VM activa"""
+        with self._lock:
+            for port in [port for port in self._tunnels if port not in remote_ports]:
+                self._tunnels.pop(port)[0].terminate()
+
+    def close_all(self):
+        self.close_unused(())
+
+
+def parse_ppm(data):
+    """
+    Cabecera de un PPM binario (P6, 8 bits): devuelve (ancho, alto, píxeles
+    RGB). Lanza ValueError si la cabecera está incompleta (captura cortada).
+    """
+    if not data.startswith(b'P6'):
+        raise ValueError("no es un PPM binario")
+    fields, pos, size = [], 2, len(data)
+    while len(fields) < 3:
+        while pos < size and data[pos:pos + 1].isspace():
+            pos += 1
+        if pos >= size:
+            raise ValueError("cabecera PPM incompleta")
+        if data[pos:pos + 1] == b'#':
+            end = data.find(b'\n', pos)
+            if end < 0:
+                raise ValueError("cabecera PPM incompleta")
+            pos = end + 1
+            continue
+        end = pos
+        while end < size and not data[end:end + 1].isspace():
+            end += 1
+        if end >= size:
+            raise ValueError("cabecera PPM incompleta")
+        fields.append(int(data[pos:end]))
+        pos = end
+    width, height, maxval = fields
+    if maxval > 255:
+        raise ValueError("PPM de 16 bits no soportado")
+    return width, height, data[pos + 1:pos + 1 + width * height * 3]
+
+
+def decode_png(data):
+    """
+    Decodificar un PNG de 8 bits RGB o RGBA sin entrelazado (las capturas
+    de QEMU): devuelve (ancho, alto, píxeles RGB). Se usa en el hilo de
+    capturas para que Tk solo reciba miniaturas ya reducidas.
+    """
+    if not data.startswith(b'\x89PNG\r\n\x1a\n'):
+        raise ValueError("no es un PNG")
+    pos, header, idat = 8, None, []
+    while pos + 8 <= len(data):
+        length, tag = struct.unpack('>I4s', data[pos:pos + 8])
+        payload = data[pos + 8:pos + 8 + length]
+        if len(payload) < length:
+            raise ValueError("PNG incompleto")
+        if tag == b'IHDR':
+            header = struct.unpack('>IIBBBBB', payload)
+        elif tag == b'IDAT':
+            idat.append(payload)
+        elif tag == b'IEND':
+            break
+        pos += 12 + length
+    if header is None or not idat:
+        raise ValueError("PNG incompleto")
+    width, height, depth, color, _, _, interlace = header
+    if depth != 8 or color not in (2, 6) or interlace:
+        raise ValueError("formato PNG no soportado")
+    bpp = 3 if color == 2 else 4
+    stride = width * bpp
+    try:
+        raw = zlib.decompress(b''.join(idat))
+    except zlib.error as e:
+        raise ValueError(f"PNG dañado: {e}")
+    if len(raw) < height * (stride + 1):
+        raise ValueError("PNG incompleto")
+
+    rows, previous = [], bytes(stride)
+    for y in range(height):
+        start = y * (stride + 1)
+        kind, row = raw[start], bytearray(raw[start + 1:start + 1 + stride])
+        if kind == 1:
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xff
+        elif kind == 2:
+            row = bytearray((a + b) & 0xff for a, b in zip(row, previous))
+        elif kind == 3:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif kind == 4:
+            for i in range(stride):
+                a = row[i - bpp] if i >= bpp else 0
+                b = previous[i]
+                c = previous[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+        previous = bytes(row)
+        rows.append(previous if bpp == 3 else
+                    b''.join(previous[x:x + 3] for x in range(0, stride, 4)))
+    return width, height, b''.join(rows)
+
+
+def scale_rgb(width, height, pixels, max_width, max_height):
+    """Reducir una imagen RGB por vecino más cercano; devuelve (ancho, alto, filas)"""
+    factor = min(max_width / width, max_height / height, 1.0)
+    new_width, new_height = max(1, int(width * factor)), max(1, int(height * factor))
+    offsets = [(x * width // new_width) * 3 for x in range(new_width)]
+    stride = width * 3
+    rows = []
+    for y in range(new_height):
+        start = (y * height // new_height) * stride
+        row = pixels[start:start + stride]
+        rows.append(b''.join([row[offset:offset + 3] for offset in offsets]))
+    return new_width, new_height, rows
+
+
+def encode_png(width, height, rows):
+    """Codificar filas RGB como PNG (Tk lo muestra sin dependencias externas)"""
+    def chunk(tag, payload):
+        return (struct.pack('>I', len(payload)) + tag + payload +
+                struct.pack('>I', zlib.crc32(tag + payload) & 0xffffffff))
+    raw = b''.join(b'\x00' + row for row in rows)
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+
+def capture_thumbnail(conn, vm):
+    """
+    Capturar la pantalla de `vm` por un stream de libvirt y reducirla a
+    THUMBNAIL_SIZE (se ejecuta en un hilo de trabajo): tanto los PPM como
+    los PNG de versiones recientes de QEMU se decodifican y escalan aquí.
+    """
+    stream = conn.newStream(0)
+    try:
+        mime = vm.screenshot(stream, 0, 0)
+        chunks = []
+        stream.recvAll(lambda st, data, opaque: chunks.append(data), None)
+        stream.finish()
+    except libvirt.libvirtError:
+        try:
+            stream.abort()
+        except libvirt.libvirtError:
+            pass
+        raise
+    data = b''.join(chunks)
+
+    if mime == 'image/x-portable-pixmap' or data.startswith(b'P6'):
+        width, height, pixels = parse_ppm(data)
+    elif mime == 'image/png' or data.startswith(b'\x89PNG'):
+        width, height, pixels = decode_png(data)
+    else:
+        raise ValueError(f"formato de captura no soportado: {mime}")
+    if not width or not height or len(pixels) != width * height * 3:
+        raise ValueError("captura incompleta")
+    return Thumbnail(encode_png(*scale_rgb(width, height, pixels, *THUMBNAIL_SIZE)),
+                     time.monotonic(), None)
+
+
+class ThumbnailCache:
+    """
+    Caché LRU de miniaturas por UUID limitada por memoria (bytes de imagen);
+    al superar el límite se descartan las menos usadas.
+    """
+
+    def __init__(self, max_bytes=int(THUMBNAIL_CACHE_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # uuid -> Thumbnail
+        self._lock = threading.Lock()
+
+    def get(self, uuid):
+        with self._lock:
+            thumbnail = self._entries.get(uuid)
+            if thumbnail is not None:
+                self._entries.move_to_end(uuid)
+            return thumbnail
+
+    def put(self, uuid, thumbnail):
+        with self._lock:
+            self._pop(uuid)
+            self._entries[uuid] = thumbnail
+            self.size += len(thumbnail.png or b'')
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                self._pop(next(iter(self._entries)))
+
+    def discard(self, uuid):
+        with self._lock:
+            self._pop(uuid)
+
+    def _pop(self, uuid):
+        thumbnail = self._entries.pop(uuid, None)
+        if thumbnail is not None:
+            self.size -= len(thumbnail.png or b'')
+
+
+def expand_name_pattern(pattern, count=1):
+    """
+    Expandir un patrón de nombres para el modo lote. 'web-{01..40}' produce
+    web-01 ... web-40 (conservando los ceros a la izquierda); sin rango y con
+    count > 1 se numera como nombre-01 ... nombre-N (con ceros según N).
+    """
+    match = re.search(r'\{(\d+)\.\.(\d+)\}', pattern)
+    if match:
+        first, last = match.group(1), match.group(2)
+        width = max(len(first), len(last)) if first.startswith('0') or last.startswith('0') else 0
+        step = 1 if int(last) >= int(first) else -1
+        return [pattern[:match.start()] + str(i).zfill(width) + pattern[match.end():]
+                for i in range(int(first), int(last) + step, step)]
+    if count <= 1:
+        return [pattern]
+    width = len(str(count))
+    return [f"{pattern}-{i:0{width}d}" for i in range(1, count + 1)]
+
+
+class DiskCreationError(Exception):
+    pass
+
+
+def make_qcow2_disk(disk_path, disk_size_gb, backing=None):
+    """
+    Crear un disco QCOW2 con qemu-img; lanza DiskCreationError si falla.
+    Con backing (BaseImage) se crea un overlay que solo guarda los cambios
+    respecto a la imagen base; sin tamaño, hereda el de la base.
+    """
+    command = ["qemu-img", "create", "-f", "qcow2"]
+    if backing is not None:
+        command += ["-b", backing.path, "-F", backing.format]
+    command.append(disk_path)
+    if disk_size_gb is not None:
+        command.append(f"{disk_size_gb}G")
+    try:
+        os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+        result = subprocess.run(command, check=True, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise DiskCreationError("El comando 'qemu-img' no fue encontrado.\n"
+                                "Asegúrese de que QEMU esté instalado (sudo apt install qemu-utils).")
+    except subprocess.CalledProcessError as e:
+        raise DiskCreationError(f"Fallo al crear el disco QCOW2:\n{e.stderr}")
+    except OSError as e:
+        raise DiskCreationError(f"Ocurrió un error inesperado al crear el disco:\n{e}")
+    print(f"Comando ejecutado para crear disco: {' '.join(command)}")
+    print(f"Salida de qemu-img: {result.stdout}")
+
+
+def define_domain(conn, xml):
+    """Definir un dominio validando el XML contra el esquema de libvirt"""
+    flags = getattr(libvirt, 'VIR_DOMAIN_DEFINE_VALIDATE', 0)
+    if flags:
+        return conn.defineXMLFlags(xml, flags)
+    return conn.defineXML(xml)
+
+
+def provision_vm(conn, spec, xml):
+    """
+    Crear el disco y definir una VM (se ejecuta en un hilo de trabajo).
+    Si la definición falla se elimina solo el disco creado para esta VM.
+    """
+    if os.path.exists(spec.disk_path):
+        raise DiskCreationError(f"El disco '{spec.disk_path}' ya existe")
+    make_qcow2_disk(spec.disk_path, spec.disk_gb, spec.backing)
+    try:
+        define_domain(conn, xml)
+    except libvirt.libvirtError:
+        try:
+            os.remove(spec.disk_path)
+        except OSError as e:
+            print(f"No se pudo eliminar el disco '{spec.disk_path}': {e}")
+        raise
+    return "Creada"
+
+
+def build_vm_xml(spec, engine):
+    """Generar el XML de configuración de una VM nueva para el motor indicado"""
+    name = spec.name
+    memory_kb = spec.memory_mb * 1024
+    vcpus = spec.vcpus
+    disk_path = spec.disk_path
+    iso_path_val = spec.iso_path
+    profile = spec.profile or PERFORMANCE_PROFILES[DEFAULT_PROFILE]
+    if engine.cpu_mode == 'host-passthrough':
+        cpu_xml = "\n  <cpu mode='host-passthrough' check='none' migratable='on'/>"
+    elif engine.cpu_mode:
+        cpu_xml = f"\n  <cpu mode='{engine.cpu_mode}' check='partial'/>"
+    else:
+        cpu_xml = ""
+
+    # Ajustes del perfil de rendimiento
+    tuning_xml = ""
+    if profile.hugepages:
+        tuning_xml += "\n  <memoryBacking>\n    <hugepages/>\n  </memoryBacking>"
+    if profile.iothreads:
+        tuning_xml += f"\n  <iothreads>{profile.iothreads}</iothreads>"
+    disk_driver = "name='qemu' type='qcow2'"
+    if profile.cache:
+        disk_driver += f" cache='{profile.cache}'"
+    if profile.io:
+        disk_driver += f" io='{profile.io}'"
+    if profile.discard:
+        disk_driver += f" discard='{profile.discard}' detect_zeroes='{profile.discard}'"
+    if profile.iothreads:
+        disk_driver += " iothread='1'"
+    # Fijación de vCPUs, emulador e iothreads y memoria en el nodo elegido
+    placement_xml = ""
+    placement = spec.placement
+    if placement is not None:
+        pins = ''.join(f"\n    <vcpupin vcpu='{i}' cpuset='{cpuset}'/>"
+                       for i, cpuset in enumerate(placement.vcpu_sets))
+        pins += f"\n    <emulatorpin cpuset='{placement.emulator_set}'/>"
+        pins += ''.join(f"\n    <iothreadpin iothread='{i}' cpuset='{placement.emulator_set}'/>"
+                        for i in range(1, profile.iothreads + 1))
+        placement_xml = f"\n  <cputune>{pins}\n  </cputune>"
+        if placement.node is not None:
+            placement_xml += (f"\n  <numatune>\n    <memory mode='strict' nodeset='{placement.node}'/>"
+                              f"\n  </numatune>")
+    net_driver_xml = ""
+    if profile.multiqueue and vcpus > 1:
+        net_driver_xml = f"\n      <driver name='vhost' queues='{min(vcpus, MAX_NET_QUEUES)}'/>"
+
+    # XML básico
+    xml = f"""<domain type='{engine.domain_type}'>
+  <name>{name}</name>
+  <memory unit='KiB'>{memory_kb}</memory>
+  <currentMemory unit='KiB'>{memory_kb}</currentMemory>{tuning_xml}
+  <vcpu placement='static'>{vcpus}</vcpu>{placement_xml}
+  <os>
+    <type arch='x86_64' machine='q35'>hvm</type>
+    <boot dev='hd'/>
+    <boot dev='cdrom'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+  </features>{cpu_xml}
+  <clock offset='utc'/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>restart</on_crash>
+  <devices>
+    <emulator>{engine.emulator}</emulator>
+    <disk type='file' device='disk'>
+      <driver {disk_driver}/>
+      <source file='{disk_path}'/>
+      <target dev='vda' bus='virtio'/>
+      <address type='pci' domain='0x0000' bus='0x04' slot='0x00' function='0x0'/>
+    </disk>"""
+
+    # Agregar CDROM si hay ISO
+    if iso_path_val:
+        xml += f"""
+    <disk type='file' device='cdrom'>
+      <driver name='qemu' type='raw'/>
+      <source file='{iso_path_val}'/>
+      <target dev='sdb' bus='sata'/>
+      <readonly/>
+      <address type='drive' controller='0' bus='0' target='0' unit='0'/>
+    </disk>"""
+
+    # Continuar con el resto de la configuración
+    xml += f"""
+    <controller type='usb' index='0' model='qemu-xhci' ports='15'>
+      <address type='pci' domain='0x0000' bus='0x02' slot='0x00' function='0x0'/>
+    </controller>
+    <controller type='sata' index='0'>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x1f' function='0x2'/>
+    </controller>
+    <controller type='pci' index='0' model='pcie-root'/>
+    <controller type='pci' index='1' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='1' port='0x10'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x0' multifunction='on'/>
+    </controller>
+    <controller type='pci' index='2' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='2' port='0x11'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x1'/>
+    </controller>
+    <controller type='pci' index='3' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='3' port='0x12'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x2'/>
+    </controller>
+    <controller type='pci' index='4' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='4' port='0x13'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x3'/>
+    </controller>
+    <controller type='virtio-serial' index='0'>
+      <address type='pci' domain='0x0000' bus='0x03' slot='0x00' function='0x0'/>
+    </controller>
+    <interface type='network'>
+      <source network='default'/>
+      <model type='virtio'/>{net_driver_xml}
+      <address type='pci' domain='0x0000' bus='0x01' slot='0x00' function='0x0'/>
+    </interface>
+    <serial type='pty'>
+      <target type='isa-serial' port='0'>
+        <model name='isa-serial'/>
+      </target>
+    </serial>
+    <console type='pty'>
+      <target type='serial' port='0'/>
+    </console>
+    <channel type='unix'>
+      <target type='virtio' name='org.qemu.guest_agent.0'/>
+      <address type='virtio-serial' controller='0' bus='0' port='1'/>
+    </channel>
+    <input type='tablet' bus='usb'>
+      <address type='usb' bus='0' port='1'/>
+    </input>
+    <input type='mouse' bus='ps2'/>
+    <input type='keyboard' bus='ps2'/>"""
+
+    # Sin pantalla no hay VNC, sonido ni tarjeta de vídeo emulada
+    if profile.headless:
+        xml += """
+    <video>
+      <model type='none'/>
+    </video>"""
+    else:
+        xml += """
+    <graphics type='vnc' port='-1' autoport='yes' listen='127.0.0.1'>
+      <listen type='address' address='127.0.0.1'/>
+    </graphics>
+    <sound model='ich9'>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x1b' function='0x0'/>
+    </sound>
+    <video>
+      <model type='qxl' ram='65536' vram='65536' vgamem='16384' heads='1' primary='yes'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x0'/>
+    </video>"""
+
+    balloon_attrs = " freePageReporting='on'" if profile.free_page_reporting else ""
+    xml += f"""
+    <memballoon model='virtio'{balloon_attrs}>
+      <address type='pci' domain='0x0000' bus='0x05' slot='0x00' function='0x0'/>
+    </memballoon>
+    <rng model='virtio'>
+      <backend model='random'>/dev/urandom</backend>
+      <address type='pci' domain='0x0000' bus='0x06' slot='0x00' function='0x0'/>
+    </rng>
+  </devices>
+</domain>"""
+
+    return xml
+
+
+class DiskDeletionError(Exception):
+    pass
+
+
+class ShutdownTimeout(Exception):
+    pass
+
+
+class ShutdownOrchestrator:
+    """
+    Apagado ordenado de muchas VMs a la vez. Cada VM recibe shutdown() y se
+    espera a su evento de parada (o se consulta su estado si no hay
+    eventos); al vencer su plazo se aplica la política de escalado.
+    shutdown() se ejecuta en un hilo de trabajo por VM, que puede ser de
+    cualquier host.
+    """
+
+    def __init__(self):
+        self._waiting = {}  # uuid -> threading.Event
+        self._lock = threading.Lock()
+
+    def notify_stopped(self, uuid):
+        """Un dominio se detuvo (hilo de eventos de libvirt)"""
+        with self._lock:
+            stopped = self._waiting.get(uuid)
+        if stopped is not None:
+            stopped.set()
+
+    def shutdown(self, conn, name, deadline, policy, events, report):
+        """Apagar una VM; devuelve el texto de resultado o lanza ShutdownTimeout"""
+        vm = conn.lookupByName(name)
+        uuid = vm.UUIDString()
+        stopped = threading.Event()
+        with self._lock:
+            self._waiting[uuid] = stopped
+        try:
+            if not vm.isActive():
+                return "Ya estaba detenida"
+            started = time.monotonic()
+            # Con 'retry' el mismo plazo se reparte entre los dos intentos ACPI
+            attempts = 2 if policy == 'retry' else 1
+            for attempt in range(attempts):
+                try:
+                    vm.shutdown()
+                except libvirt.libvirtError:
+                    # En el reintento la VM pudo terminar de apagarse justo antes
+                    if attempt and not vm.isActive():
+                        return f"Apagada en {time.monotonic() - started:.0f} s"
+                    raise
+                wait = started + deadline * (attempt + 1) / attempts - time.monotonic()
+                report(f"Señal ACPI enviada, esperando hasta {max(0.0, wait):.0f} s"
+                       + (" (reintento)" if attempt else ""))
+                if self._wait(vm, stopped, wait, events):
+                    return f"Apagada en {time.monotonic() - started:.0f} s"
+
+            if policy == 'leave':
+                raise ShutdownTimeout(f"No se apagó en {time.monotonic() - started:.0f} s; sigue encendida")
+            report("Plazo vencido, forzando apagado")
+            try:
+                vm.destroy()
+            except libvirt.libvirtError:
+                # Pudo apagarse justo antes del destroy
+                if vm.isActive():
+                    raise
+            return f"Forzada (destroy) tras {time.monotonic() - started:.0f} s"
+        finally:
+            with self._lock:
+                self._waiting.pop(uuid, None)
+
+    @staticmethod
+    def _wait(vm, stopped, timeout, events):
+        """Esperar la parada de `vm` hasta `timeout` segundos; True si se detuvo"""
+        check_interval = SHUTDOWN_EVENT_CHECK_INTERVAL if events else SHUTDOWN_CHECK_INTERVAL
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            if stopped.wait(min(remaining, check_interval)) or not vm.isActive():
+                return True
+
+
+def domain_disk_files(vm):
+    """
+    Archivos de disco propios de una VM: los del XML persistente más los de
+    sus instantáneas externas. Las imágenes base de los clones enlazados solo
+    aparecen como backingStore, así que nunca se incluyen.
+    """
+    files = [path for disk_type, path in
+             parse_domain_config(vm.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)).disks
+             if disk_type == 'file']
+    for snapshot in vm.listAllSnapshots(0):
+        root = ET.fromstring(snapshot.getXMLDesc(0))
+        sources = root.findall("disks/disk[@snapshot='external']/source")
+        sources += root.findall("domain/devices/disk[@device='disk']/source")
+        files.extend(source.get('file') for source in sources if source.get('file'))
+    return list(dict.fromkeys(files))
+
+
+def lookup_volume(conn, path):
+    """
+    Volumen de almacenamiento de `path` en el host de libvirt. Los discos
+    creados con qemu-img pueden no estar aún en el pool: se refrescan los
+    pools activos del directorio y se vuelve a buscar.
+    """
+    try:
+        return conn.storageVolLookupByPath(path)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+            raise
+    directory = os.path.dirname(path)
+    for pool in conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+        if ET.fromstring(pool.XMLDesc(0)).findtext('target/path') == directory:
+            pool.refresh(0)
+    return conn.storageVolLookupByPath(path)
+
+
+def delete_domain(conn, name, wipe=False):
+    """
+    Eliminar una VM con sus discos, instantáneas y NVRAM (se ejecuta en un
+    hilo de trabajo). Los discos se borran con la API de almacenamiento, es
+    decir, en el host de libvirt y no en la máquina local.
+    """
+    vm = conn.lookupByName(name)
+    files = domain_disk_files(vm)
+    if vm.isActive():
+        vm.destroy()
+    vm.undefineFlags(UNDEFINE_FLAGS)
+
+    pending = []
+    for path in files:
+        try:
+            volume = lookup_volume(conn, path)
+            if wipe:
+                volume.wipe(0)
+            volume.delete(0)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_VOL:
+                pending.append(f"{os.path.basename(path)} (fuera de los pools)")
+            else:
+                pending.append(f"{os.path.basename(path)} ({e})")
+    if pending:
+        raise DiskDeletionError(f"VM eliminada, pero no se borraron: {', '.join(pending)}")
+    return f"Eliminada ({len(files)} discos{', sobrescritos' if wipe else ''})"
+
+
+def qcow2_backing_file(path):
+    """Imagen base de un qcow2 local según qemu-img info, o None si no tiene"""
+    try:
+        result = subprocess.run(["qemu-img", "info", "-U", "--output=json", path],
+                                check=True, capture_output=True, text=True)
+        return json.loads(result.stdout).get('backing-filename')
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        print(f"No se pudo leer la imagen base de '{path}': {e}")
+        return None
+
+
+def backed_disks(vm, active):
+    """
+    Discos (target, archivo) de `vm` que dependen de una imagen base. Con la
+    VM encendida lo indica el XML en vivo (backingStore); apagada se consulta
+    qemu-img info, así que los archivos deben ser locales (ver flatten_disk).
+    """
+    flags = 0 if active else libvirt.VIR_DOMAIN_XML_INACTIVE
+    disks = []
+    for disk in ET.fromstring(vm.XMLDesc(flags)).iter('disk'):
+        source, target = disk.find('source'), disk.find('target')
+        if (disk.get('device') != 'disk' or source is None or target is None
+                or not source.get('file')):
+            continue
+        if active:
+            backed = disk.find('backingStore/source') is not None
+        else:
+            backed = bool(qcow2_backing_file(source.get('file')))
+        if backed:
+            disks.append((target.get('dev'), source.get('file')))
+    return disks
+
+
+def flatten_disk(vm, disks, active):
+    """
+    Copiar en cada overlay de `disks` [(target, archivo)] los datos de su
+    imagen base para que deje de depender de ella (se ejecuta en un hilo de
+    trabajo). Con la VM encendida se usa blockPull de libvirt en el host;
+    apagada, qemu-img rebase sin imagen base, que trabaja sobre archivos
+    locales y por eso solo se ofrece con hosts locales.
+    """
+    if not active:
+        for target, disk_path in disks:
+            command = ["qemu-img", "rebase", "-f", "qcow2", "-b", "", disk_path]
+            try:
+                subprocess.run(command, check=True, capture_output=True, text=True)
+            except FileNotFoundError:
+                raise DiskCreationError("El comando 'qemu-img' no fue encontrado.")
+            except subprocess.CalledProcessError as e:
+                raise DiskCreationError(f"Fallo al aplanar el disco {target}:\n{e.stderr}")
+        return f"Aplanado ({len(disks)} discos)"
+
+    for target, _ in disks:
+        vm.blockPull(target, 0, 0)
+        while vm.blockJobInfo(target, 0):
+            time.sleep(FLATTEN_POLL_INTERVAL)
+
+    # El trabajo desaparece tanto si termina como si falla: comprobar en el
+    # XML en vivo que los discos ya no tienen imagen base
+    targets = {target for target, _ in disks}
+    for disk in ET.fromstring(vm.XMLDesc(0)).iter('disk'):
+        target_elem = disk.find('target')
+        if target_elem is not None and target_elem.get('dev') in targets:
+            if disk.find('backingStore/source') is not None:
+                raise DiskCreationError(f"El blockPull de {target_elem.get('dev')} "
+                                        "terminó sin consolidar el disco")
+    return f"Aplanado en vivo ({len(disks)} discos)"
+
+
+class BaseImageCatalog:
+    """
+    Catálogo de imágenes base en BASE_IMAGES_DIR. El directorio solo se
+    vuelve a leer si cambia su mtime, y qemu-img info solo se ejecuta para
+    imágenes nuevas o modificadas.
+    """
+
+    def __init__(self, directory=BASE_IMAGES_DIR):
+        self.directory = directory
+        self._dir_mtime = None
+        self._images = []
+        self._info = {}  # ruta -> ((mtime, tamaño), BaseImage)
+        self._lock = threading.Lock()
+
+    def images(self):
+        """Imágenes base disponibles, ordenadas por nombre"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.directory).st_mtime_ns
+            except OSError:
+                self._dir_mtime, self._images = None, []
+                return []
+            if mtime != self._dir_mtime:
+                self._images = self._scan()
+                self._dir_mtime = mtime
+            return list(self._images)
+
+    def _scan(self):
+        images, info = [], {}
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            image_format = BASE_IMAGE_FORMATS.get(os.path.splitext(entry.name)[1])
+            if image_format is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            key = (stat.st_mtime_ns, stat.st_size)
+            cached = self._info.get(entry.path)
+            if cached is not None and cached[0] == key:
+                image = cached[1]
+            else:
+                image = BaseImage(os.path.splitext(entry.name)[0], entry.path, image_format,
+                                  self._virtual_size_gb(entry.path, image_format, stat.st_size),
+                                  stat.st_blocks * 512 // (1024 * 1024))
+            info[entry.path] = (key, image)
+            images.append(image)
+        self._info = info
+        return images
+
+    @staticmethod
+    def _virtual_size_gb(path, image_format, file_size):
+        """Tamaño virtual en GB; -U permite leer imágenes abiertas por VMs en ejecución"""
+        try:
+            result = subprocess.run(["qemu-img", "info", "-U", "--output=json", "-f", image_format, path],
+                                    check=True, capture_output=True, text=True)
+            size = json.loads(result.stdout)['virtual-size']
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+            print(f"No se pudo leer el tamaño de la imagen base '{path}': {e}")
+            size = file_size
+        return -(-size // (1024 ** 3))
+
+
+_engine_cache = weakref.WeakKeyDictionary()  # conexión -> EngineInfo
+_topology_cache = weakref.WeakKeyDictionary()  # conexión -> HostTopology
+_free_memory_cache = weakref.WeakKeyDictionary()  # conexión -> (momento, [MB libres])
+_host_info_lock = threading.Lock()
+
+def detect_engine(conn, arch='x86_64'):
+    """
+    Elegir el tipo de dominio y el modo de CPU para VMs nuevas a partir de
+    getCapabilities()/getDomainCapabilities(). Se prefiere KVM; QEMU (TCG)
+    solo si el host no lo ofrece. El resultado se guarda por conexión.
+    """
+    with _host_info_lock:
+        engine = _engine_cache.get(conn)
+    if engine is not None:
+        return engine
+
+    try:
+        engine = _detect_engine(conn, arch)
+    except (libvirt.libvirtError, ET.ParseError) as e:
+        # Sin capacidades no se cachea: se reintenta al abrir el diálogo de nuevo
+        return EngineInfo('qemu', None, DEFAULT_EMULATOR,
+                          f"no se pudieron leer las capacidades del host ({e})")
+    with _host_info_lock:
+        _engine_cache[conn] = engine
+    return engine
+
+
+def _detect_engine(conn, arch):
+    domain_types, emulator = set(), None
+    for guest in ET.fromstring(conn.getCapabilities()).findall('guest'):
+        guest_arch = guest.find('arch')
+        if guest.findtext('os_type') != 'hvm' or guest_arch is None or guest_arch.get('name') != arch:
+            continue
+        emulator = emulator or guest_arch.findtext('emulator')
+        domain_types.update(domain.get('type') for domain in guest_arch.findall('domain'))
+
+    if 'kvm' in domain_types:
+        domain_type, reason = 'kvm', "aceleración por hardware disponible"
+    elif 'qemu' in domain_types:
+        domain_type, reason = 'qemu', "el host no ofrece KVM, se usará emulación por software"
+    else:
+        raise libvirt.libvirtError(f"el host no admite invitados hvm {arch}")
+
+    domcaps = ET.fromstring(conn.getDomainCapabilities(emulator, arch, None, domain_type, 0))
+    emulator = domcaps.findtext('path') or emulator or DEFAULT_EMULATOR
+    supported = {mode.get('name') for mode in domcaps.findall('cpu/mode')
+                 if mode.get('supported') == 'yes'}
+    cpu_mode = next((mode for mode in ENGINE_CPU_MODES[domain_type] if mode in supported), None)
+    return EngineInfo(domain_type, cpu_mode, emulator, reason)
+
+
+def host_topology(conn):
+    """
+    Topología NUMA del host a partir de getCapabilities() y nodeGetInfo().
+    Si el host no informa celdas se trata como un único nodo. Se guarda por
+    conexión; la memoria libre, que sí cambia, se pide aparte.
+    """
+    with _host_info_lock:
+        topology = _topology_cache.get(conn)
+    if topology is not None:
+        return topology
+
+    info = conn.nodeGetInfo()
+    nodes = []
+    for cell in ET.fromstring(conn.getCapabilities()).findall('host/topology/cells/cell'):
+        memory = cell.find('memory')
+        memory_mb = int(memory.text) // 1024 if memory is not None else 0
+        cpus = tuple(sorted(int(cpu.get('id')) for cpu in cell.findall('cpus/cpu')))
+        nodes.append(NumaNode(int(cell.get('id')), cpus, memory_mb))
+    if not nodes:
+        nodes = [NumaNode(0, tuple(range(info[2])), info[1])]
+    total_cpus = max(info[2], max((max(node.cpus) + 1 for node in nodes if node.cpus), default=0))
+
+    topology = HostTopology(total_cpus, tuple(nodes))
+    with _host_info_lock:
+        _topology_cache[conn] = topology
+    return topology
+
+
+def node_free_memory_mb(conn, topology, max_age=0):
+    """
+    MB libres de cada nodo NUMA, en el orden de topology.nodes. Con max_age
+    se reutiliza la última consulta de la conexión si no es más antigua.
+    """
+    now = time.monotonic()
+    with _host_info_lock:
+        cached = _free_memory_cache.get(conn)
+    if cached is not None and now - cached[0] < max_age:
+        return cached[1]
+    # Un nodo por llamada: los ids de nodo NUMA no tienen por qué ser contiguos
+    free = [conn.getCellsFreeMemory(node.id, 1)[0] // (1024 * 1024) for node in topology.nodes]
+    with _host_info_lock:
+        _free_memory_cache[conn] = (now, free)
+    return free
+
+
+def free_hugepages_mb(conn, topology):
+    """MB libres en hugepages reservadas de todos los nodos NUMA del host"""
+    node_ids = [node.id for node in topology.nodes] if topology is not None else [0]
+    free_kib = 0
+    for node_id in node_ids:
+        for pages in conn.getFreePages(list(HUGEPAGE_SIZES_KIB), node_id, 1).values():
+            free_kib += sum(size * count for size, count in pages.items())
+    return free_kib // 1024
+
+
+def format_cpuset(cpus):
+    """Representar CPUs como cpuset de libvirt: (0, 1, 2, 5) -> '0-2,5'"""
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def parse_cpuset(text):
+    """Leer un cpuset ('0-3,8') como lista ordenada; lanza ValueError si no es válido"""
+    cpus = set()
+    for part in text.replace(' ', '').split(','):
+        first, _, last = part.partition('-')
+        first, last = int(first), int(last or first)
+        if first < 0 or last < first:
+            raise ValueError(f"rango de CPUs no válido: '{part}'")
+        cpus.update(range(first, last + 1))
+    return sorted(cpus)
+
+
+def vcpu_pin_sets(cpus, vcpus):
+    """
+    CPUs de cada vCPU: con al menos tantas CPUs como vCPUs cada una se fija
+    a una CPU propia; si no, todas pueden usar el conjunto completo
+    """
+    if len(cpus) >= vcpus:
+        return tuple((cpu,) for cpu in cpus[:vcpus])
+    return (tuple(cpus),) * vcpus
+
+
+def cpus_to_nodes(cpus, topology):
+    """Nodos NUMA que contienen alguna de las CPUs indicadas"""
+    cpus = set(cpus)
+    return tuple(node.id for node in topology.nodes if cpus.intersection(node.cpus))
+
+
+def choose_numa_nodes(topology, free_mb, requests):
+    """
+    Ubicación automática: para cada (memoria MB, vCPUs) elige el nodo con más
+    memoria libre que tenga CPUs suficientes, descontando lo ya asignado.
+    Devuelve el id de nodo de cada petición, o None si ninguno cabe.
+    """
+    free = dict(zip((node.id for node in topology.nodes), free_mb))
+    chosen = []
+    for memory_mb, vcpus in requests:
+        candidates = [node for node in topology.nodes
+                      if len(node.cpus) >= vcpus and free[node.id] >= memory_mb]
+        if not candidates:
+            chosen.append(None)
+            continue
+        node = max(candidates, key=lambda n: free[n.id])
+        free[node.id] -= memory_mb
+        chosen.append(node.id)
+    return chosen
+
+
+def warm_host_info(conn):
+    """Cargar en caché el motor y la topología del host (en un hilo aparte)"""
+    detect_engine(conn)
+    try:
+        host_topology(conn)
+    except libvirt.libvirtError as e:
+        print(f"No se pudo leer la topología del host: {e}")
+
+
+def cpumap_to_cpus(cpumap):
+    return tuple(cpu for cpu, used in enumerate(cpumap) if used)
+
+
+def cpus_to_cpumap(cpus, total_cpus):
+    cpus = set(cpus)
+    return tuple(cpu in cpus for cpu in range(total_cpus))
+
+
+_event_loop_thread = None
+
+def start_libvirt_event_loop():
+    """
+    Registrar la implementación de eventos por defecto de libvirt y atenderla
+    en un hilo propio. Debe llamarse antes de abrir la conexión.
+    """
+    global _event_loop_thread
+    if _event_loop_thread is not None:
+        return
+
+    def run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    libvirt.virEventRegisterDefaultImpl()
+    _event_loop_thread = threading.Thread(target=run, name='libvirt-events', daemon=True)
+    _event_loop_thread.start()
+
+
+def load_libvirt_uris():
+    """URIs de los hosts configurados, sin duplicados y en orden"""
+    uris = [uri.strip() for uri in LIBVIRT_URIS.split(',')]
+    if HOSTS_FILE:
+        with open(HOSTS_FILE) as f:
+            uris += [line.split('#', 1)[0].strip() for line in f]
+    uris = list(OrderedDict.fromkeys(uri for uri in uris if uri))
+    return uris or [DEFAULT_LIBVIRT_URI]
+
+
+class HostConnection:
+    """
+    Conexión vigilada a un host de libvirt y el estado que depende de él:
+    métricas, pantallas VNC, túneles SSH y suscripción a eventos. La abre
+    y la comprueba su propio InventoryPoller, de modo que un host caído o
+    lento solo retrasa a su hilo y no a la interfaz ni a los demás hosts.
+
+    La conexión usa keepalive y un callback de cierre: al perderse se marca
+    como reconnecting y el hilo del host la reabre con espera exponencial,
+    mientras la interfaz sigue mostrando el último inventario como antiguo.
+    """
+
+    def __init__(self, uri, name):
+        self.uri = uri
+        self.name = name
+        self.iid = f'host:{name}'  # fila del host en el Treeview
+        self.conn = None
+        self.health = 'connecting'
+        self.latency = None  # segundos del último inventario completo
+        self.error = None
+        self.last_ok = None  # datetime del último sondeo correcto
+        self.events_enabled = False
+        self.bulk_stats_supported = True
+        self.reconcile_due = 0.0
+        self.lost = False  # el callback de cierre se disparó
+        self.attempts = 0  # intentos de reconexión fallidos seguidos
+        self.reconnect_at = 0.0  # time.monotonic() del próximo intento
+        self.metrics = MetricsCollector()
+        self.displays = DisplayEndpointTable()
+        self.screenshot_bucket = TokenBucket(SCREENSHOT_RATE)  # capturas de miniaturas
+        uri = urlparse(uri)
+        self.hostname = uri.hostname
+        self.tunnels = SSHTunnelManager(uri.hostname, SSH_USER or uri.username)
+        self.poller = None
+        self._event_callbacks = []
+
+    def connected(self):
+        return self.conn is not None and not self.lost
+
+    def local(self):
+        """True si libvirt corre en esta máquina (sus rutas de disco son locales)"""
+        return not self.hostname or self.hostname in LOOPBACK_ADDRESSES
+
+    def reconnect_delay(self):
+        """Segundos hasta el próximo intento de reconexión, o None si hay conexión"""
+        if self.connected():
+            return None
+        return max(0.0, self.reconnect_at - time.monotonic())
+
+    def ensure_connected(self):
+        """
+        Abrir la conexión si no hay una viva (hilo de sondeo). Devuelve True
+        si se abrió una nueva; lanza libvirtError si el host no responde, y
+        entonces el siguiente intento se aplaza con espera exponencial.
+        """
+        if self.connected():
+            try:
+                if self.conn.isAlive():
+                    return False
+            except libvirt.libvirtError:
+                pass
+        self.close()
+        try:
+            conn = instrumentation.open_connection(self.uri, self.name)
+        except libvirt.libvirtError:
+            self._schedule_reconnect()
+            raise
+        try:
+            conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+            conn.registerCloseCallback(self._on_close, None)
+        except libvirt.libvirtError as e:
+            print(f"Keepalive no disponible en {self.name}: {e}")
+        self.conn, self.lost, self.attempts = conn, False, 0
+        return True
+
+    def _schedule_reconnect(self):
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** self.attempts)
+        self.attempts += 1
+        self.reconnect_at = time.monotonic() + random.uniform(delay / 2, delay)
+        self.health = 'reconnecting'
+
+    def _on_close(self, conn, reason, opaque):
+        """Callback de cierre de libvirt (hilo de eventos): programar la reconexión"""
+        if conn is not self.conn or self.lost:
+            return
+        self.lost = True
+        self.error = f"Conexión perdida: {CLOSE_REASONS.get(reason, reason)}"
+        self._schedule_reconnect()
+        if self.poller is not None:
+            self.poller.wake()
+
+    def require(self):
+        """Conexión abierta o libvirtError si el host no está disponible"""
+        conn = self.conn
+        if conn is None or self.lost:
+            raise libvirt.libvirtError(f"Sin conexión con el host {self.name}")
+        return conn
+
+    def mark_ok(self, latency):
+        self.health, self.error, self.latency = 'ok', None, latency
+        self.last_ok = datetime.now()
+
+    def mark_down(self, error):
+        """
+        Registrar un sondeo fallido. Con la conexión viva el host queda
+        degradado; si murió se cierra y se reabrirá tras la espera.
+        """
+        self.error = error
+        if self.lost or self.conn is None:
+            return
+        try:
+            alive = self.conn.isAlive()
+        except libvirt.libvirtError:
+            alive = False
+        if alive:
+            self.health = 'degraded'
+        else:
+            self.close()
+            self._schedule_reconnect()
+
+    def register_events(self, callback):
+        """Suscribirse a DOMAIN_EVENT_IDS; el opaque de cada evento es (host, id)"""
+        try:
+            for event_id in DOMAIN_EVENT_IDS:
+                self._event_callbacks.append(
+                    self.conn.domainEventRegisterAny(None, event_id, callback, (self, event_id)))
+            self.events_enabled = True
+        except libvirt.libvirtError as e:
+            print(f"Eventos de libvirt no disponibles en {self.name}, se usará sondeo: {e}")
+            self._deregister_events()
+
+    def _deregister_events(self):
+        for callback_id in self._event_callbacks:
+            try:
+                self.conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self._event_callbacks = []
+        self.events_enabled = False
+
+    def close(self):
+        conn = self.conn
+        if conn is None:
+            return
+        self._deregister_events()
+        self.conn = None
+        try:
+            conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+        try:
+            conn.close()
+        except libvirt.libvirtError as e:
+            print(f"Error al cerrar la conexión con {self.name}: {e}")
+
+
+class ConnectionManager:
+    """Hosts de libvirt configurados, en el orden de la configuración"""
+
+    def __init__(self, uris):
+        self.hosts = []
+        self._by_name = {}
+        for uri in uris:
+            name = urlparse(uri).hostname or uri
+            if name in self._by_name:
+                name = uri
+            host = HostConnection(uri, name)
+            self.hosts.append(host)
+            self._by_name[name] = host
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    @property
+    def primary(self):
+        return self.hosts[0]
+
+    def by_iid(self, iid):
+        """Host cuya fila del Treeview es `iid`, o None si es una VM"""
+        if not iid.startswith('host:'):
+            return None
+        return self._by_name.get(iid[len('host:'):])
+
+    def close_all(self):
+        for host in self.hosts:
+            if host.poller is not None:
+                host.poller.stop()
+            host.tunnels.close_all()
+            host.close()
+
 
 class VirtualizationClient:
     def __init__(self, root):
@@ -23,29 +1798,69 @@ class VirtualizationClient:
         self.root.geometry("1200x800")
         self.root.configure(bg='#2c3e50')
 
-        # Conexión a libvirt
-        self.conn = None
-        self.connect_to_libvirt()
+        # Hosts de libvirt; cada uno se conecta desde su propio hilo de sondeo.
+        # El bucle de eventos hace falta también sin EVENT_MODE para el keepalive
+        start_libvirt_event_loop()
+        self.hosts = ConnectionManager(load_libvirt_uris())
 
-        # Variables
-        self.vms = {}
-        self.selected_vm = None
+        self.init_state()
+
+        # Miniaturas de pantalla de las VMs en ejecución
+        self.thumbnail_cache = ThumbnailCache()
+        self.screenshots = ScreenshotWorker(self.hosts, self._vm_hosts.get, self.lookup_domain,
+                                            self.thumbnail_cache)
 
         # Configurar interfaz
         self.setup_ui()
-        self.refresh_vm_list()
 
-        # Auto-refresh cada 5 segundos
+        # Las llamadas periódicas a libvirt se hacen en un hilo por host, que
+        # publican sus sondeos en la cola común self.snapshots
+        for host in self.hosts:
+            host.poller = InventoryPoller(self, host, self.snapshots)
+            host.poller.start()
+        self.screenshots.start()
+        self.request_refresh()
+        self.process_snapshots()
+
+        # Sondeo periódico (cada POLL_INTERVAL, o RECONCILE_INTERVAL con eventos)
         self.auto_refresh()
+        self.refresh_thumbnails()
+        self.refresh_rpc_metrics()
+        if EVENT_MODE and METRICS_INTERVAL > 0:
+            self.sample_metrics()
 
-    def connect_to_libvirt(self):
-        """Conectar a libvirt"""
-        try:
-            self.conn = libvirt.open("qemu+tcp://192.168.64.2/system")
-            if self.conn is None:
-                messagebox.showerror("Error", "No se pudo conectar a libvirt")
-        except libvirt.libvirtError as e:
-            messagebox.showerror("Error de conexión", f"Error al conectar con libvirt: {str(e)}")
+    def init_state(self):
+        """
+        Estado de la sesión que no depende de Tk; bench_scale.py lo usa con
+        una vista sin pantalla.
+        """
+        self.vms = {}
+        self.selected_vm = None
+        self.selected_host = None  # HostConnection de la fila seleccionada
+        self.config_cache = DomainConfigCache()
+        self.pinning_cache = PinningCache()
+        self.base_images = BaseImageCatalog()
+        self.last_refresh_rpcs = 0
+        self.last_tree_ops = 0
+        self._tree_snapshot = {}  # uuid -> DomainRecord mostrado en el tree
+        self._vm_hosts = {}  # uuid -> HostConnection de cada VM del tree
+        self._host_rows = {}  # HostConnection -> (texto, valores) de su fila
+        self._sort_column = None  # columna elegida por el usuario
+        self._sort_descending = False
+        self._deleting = set()  # etiquetas de VMs en la cola de eliminación
+        self.shutdowns = ShutdownOrchestrator()
+        self._tunnel_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ssh-tunnel')
+        self._host_info_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='host-info')
+        self.snapshots = queue.Queue()  # sondeos de los InventoryPoller
+
+    @property
+    def conn(self):
+        """Conexión del host seleccionado (o del primero) para las acciones de la interfaz"""
+        return (self.selected_host or self.hosts.primary).conn
+
+    def selected_domain(self):
+        """Dominio de la VM seleccionada en su host; libvirtError si no está disponible"""
+        return (self.selected_host or self.hosts.primary).require().lookupByName(self.selected_vm)
 
     def setup_ui(self):
         """Configurar la interfaz de usuario"""
@@ -80,16 +1895,19 @@ class VirtualizationClient:
         tree_frame = tk.Frame(left_frame, bg='#34495e')
         tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
 
-        self.vm_tree = ttk.Treeview(tree_frame, columns=('Estado', 'CPU', 'RAM'), show='tree headings')
-        self.vm_tree.heading('#0', text='Nombre')
-        self.vm_tree.heading('Estado', text='Estado')
-        self.vm_tree.heading('CPU', text='CPU')
-        self.vm_tree.heading('RAM', text='RAM (MB)')
+        self.vm_tree = ttk.Treeview(tree_frame, columns=TREE_COLUMNS, show='tree headings')
+        headings = {'#0': 'Nombre', 'Estado': 'Estado', 'CPU': 'CPU', 'RAM': 'RAM (MB)',
+                    'CPU%': 'CPU %', 'E/S': 'E/S'}
+        for column, text in headings.items():
+            self.vm_tree.heading(column, text=text,
+                                 command=lambda c=column: self.sort_vm_tree_by(c))
 
         self.vm_tree.column('#0', width=120)
         self.vm_tree.column('Estado', width=80)
         self.vm_tree.column('CPU', width=50)
         self.vm_tree.column('RAM', width=80)
+        self.vm_tree.column('CPU%', width=60)
+        self.vm_tree.column('E/S', width=80)
 
         # Scrollbar para el treeview
         scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.vm_tree.yview)
@@ -101,6 +1919,13 @@ class VirtualizationClient:
         # Bind para selección
         self.vm_tree.bind('<<TreeviewSelect>>', self.on_vm_select)
 
+        # Una fila por host con su salud y latencia; las VMs cuelgan de ella.
+        # Las de un host sin conexión se muestran en gris (datos antiguos)
+        self.vm_tree.tag_configure('stale', foreground='#95a5a6')
+        for host in self.hosts:
+            self.vm_tree.insert('', 'end', iid=host.iid, text=host.name, open=True,
+                                values=(HOST_HEALTH_LABELS[host.health], '', '', '', ''))
+
         # Botones de control
         buttons_frame = tk.Frame(left_frame, bg='#34495e')
         buttons_frame.pack(fill=tk.X, padx=10, pady=10)
@@ -108,7 +1933,7 @@ class VirtualizationClient:
         btn_style = {'font': ('Arial', 10, 'bold'), 'width': 15, 'height': 2}
 
         self.btn_refresh = tk.Button(buttons_frame, text="Actualizar", bg='#3498db', fg='white',
-                                     command=self.refresh_vm_list, **btn_style)
+                                     command=self.request_refresh, **btn_style)
         self.btn_refresh.pack(pady=2, fill=tk.X)
 
         self.btn_create = tk.Button(buttons_frame, text="Crear VM", bg='#27ae60', fg='white',
@@ -123,6 +1948,10 @@ class VirtualizationClient:
                                   command=self.stop_vm, **btn_style)
         self.btn_stop.pack(pady=2, fill=tk.X)
 
+        self.btn_stop_all = tk.Button(buttons_frame, text="Apagar todas", bg='#c0392b', fg='white',
+                                      command=self.stop_all_vms, **btn_style)
+        self.btn_stop_all.pack(pady=2, fill=tk.X)
+
         self.btn_connect_vnc = tk.Button(buttons_frame, text="Entrar a VM", bg='#6c5ce7', fg='white',
                                          command=self.connect_to_vm_display, **btn_style)
         self.btn_connect_vnc.pack(pady=2, fill=tk.X)
@@ -131,6 +1960,10 @@ class VirtualizationClient:
                                      command=self.delete_vm, **btn_style)
         self.btn_delete.pack(pady=2, fill=tk.X)
 
+        self.btn_flatten = tk.Button(buttons_frame, text="Aplanar disco", bg='#16a085', fg='white',
+                                     command=self.flatten_vm_disk, **btn_style)
+        self.btn_flatten.pack(pady=2, fill=tk.X)
+
         # Panel derecho - Detalles
         right_frame = tk.Frame(main_frame, bg='#34495e')
         right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=(5, 0))
@@ -140,8 +1973,20 @@ class VirtualizationClient:
                                  font=('Arial', 16, 'bold'), fg='white', bg='#34495e')
         details_title.pack(pady=10)
 
+        # Pestañas: detalles de la VM seleccionada y miniaturas de todas
+        self.right_tabs = ttk.Notebook(right_frame)
+        self.right_tabs.pack(fill=tk.BOTH, expand=True)
+        details_tab = tk.Frame(self.right_tabs, bg='#34495e')
+        self.thumbnails = ThumbnailGrid(self.right_tabs, self.screenshots, self.thumbnail_cache,
+                                        self.select_vm_by_uuid, self.open_vm_display_by_uuid)
+        self.rpc_metrics = RPCMetricsPanel(self.right_tabs, instrumentation.registry)
+        self.right_tabs.add(details_tab, text="Detalles")
+        self.right_tabs.add(self.thumbnails.frame, text="Miniaturas")
+        self.right_tabs.add(self.rpc_metrics.frame, text="Depuración")
+        self.right_tabs.bind('<<NotebookTabChanged>>', self.on_right_tab_changed)
+
         # Frame para información
-        self.info_frame = tk.Frame(right_frame, bg='#2c3e50', relief=tk.RAISED, bd=2)
+        self.info_frame = tk.Frame(details_tab, bg='#2c3e50', relief=tk.RAISED, bd=2)
         self.info_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
         # Área de texto para mostrar información
@@ -149,6 +1994,13 @@ class VirtualizationClient:
                                  font=('Consolas', 11), wrap=tk.WORD, padx=15, pady=15)
         self.info_text.pack(fill=tk.BOTH, expand=True)
 
+        details_buttons = tk.Frame(details_tab, bg='#34495e')
+        details_buttons.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        self.btn_pin = tk.Button(details_buttons, text="Fijar vCPUs", bg='#2980b9', fg='white',
+                                 font=('Arial', 10, 'bold'), command=self.pin_vm_cpus)
+        self.btn_pin.pack(side=tk.LEFT)
+
         # Estado de conexión
         status_frame = tk.Frame(self.root, bg='#34495e', height=30)
         status_frame.pack(fill=tk.X, side=tk.BOTTOM)
@@ -162,62 +2014,266 @@ class VirtualizationClient:
                                    fg='#bdc3c7', bg='#34495e', font=('Arial', 10))
         self.time_label.pack(side=tk.RIGHT, padx=10, pady=5)
 
-    def connect_to_libvirt(self):
-        """Conectar a libvirt"""
-        try:
-            self.conn = libvirt.open("qemu+tcp://192.168.64.2/system")
-            if self.conn is None:
-                messagebox.showerror("Error", "No se pudo conectar a libvirt")
-        except libvirt.libvirtError as e:
-            messagebox.showerror("Error de conexión", f"Error al conectar con libvirt: {str(e)}")
+    def host_connected(self, host):
+        """
+        Preparar una conexión recién abierta (hilo de sondeo del host):
+        suscribirse a sus eventos de dominio, o quedarse en modo sondeo si
+        fallan, y consultar ya en segundo plano sus capacidades para que el
+        diálogo de creación se abra sin esperar a libvirt.
+        """
+        if EVENT_MODE:
+            host.register_events(self._on_domain_event)
+        threading.Thread(target=warm_host_info, args=(host.conn,),
+                         name='libvirt-capabilities', daemon=True).start()
+
+    def _on_domain_event(self, conn, dom, *args):
+        """Callback de libvirt (hilo de eventos): encolar el dominio afectado"""
+        host, event_id = args[-1]
+        is_lifecycle = event_id == libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE
+        removed = is_lifecycle and args[0] == libvirt.VIR_DOMAIN_EVENT_UNDEFINED
+        # Arrancar/detener ya cambia la generación de la caché; la definición
+        # y los cambios de dispositivos invalidan la configuración guardada
+        if (event_id in (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+                         libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED) or
+                (is_lifecycle and args[0] in (libvirt.VIR_DOMAIN_EVENT_DEFINED,
+                                              libvirt.VIR_DOMAIN_EVENT_UNDEFINED))):
+            self.config_cache.invalidate(dom.UUIDString())
+        # La fijación de CPUs cambia con cualquier transición o ajuste de cputune
+        if is_lifecycle or event_id == libvirt.VIR_DOMAIN_EVENT_ID_TUNABLE:
+            self.pinning_cache.invalidate(dom.UUIDString())
+        if is_lifecycle and args[0] == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            self.shutdowns.notify_stopped(dom.UUIDString())
+        host.poller.notify_domain_event(dom, removed)
 
     def refresh_vm_list(self):
-        """Actualizar la lista de máquinas virtuales"""
-        if not self.conn:
-            return
-
-        try:
-            # Limpiar el tree
-            for item in self.vm_tree.get_children():
-                self.vm_tree.delete(item)
-
-            # Obtener todas las VMs (activas e inactivas)
-            active_vms = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
-            inactive_vms = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE)
+        """Actualizar la lista de máquinas virtuales (sondeo síncrono de cada host)"""
+        for host in self.hosts:
+            snapshot = self.collect_snapshot(host, None)
+            if snapshot is not None:
+                self.apply_snapshot(snapshot)
 
-            all_vms = active_vms + inactive_vms
+    def reconcile_vm_tree(self, host, records):
+        """
+        Aplicar al Treeview solo las diferencias con la lista anterior del host.
 
-            for vm in all_vms:
-                name = vm.name()
+        Las filas usan el UUID del dominio como iid, de modo que la selección
+        y el scroll se conservan. Devuelve el número de operaciones Tk hechas.
+        """
+        current = {record.uuid for record in records}
+        vanished = [uuid for uuid, owner in self._vm_hosts.items()
+                    if owner is host and uuid not in current]
+        return self.update_vm_rows(host, records, vanished)
 
-                # Obtener estado
-                state, reason = vm.state()
-                state_text = self.get_state_text(state)
+    def update_vm_rows(self, host, records, removed=()):
+        """
+        Insertar o actualizar bajo la fila de `host` las filas de `records` y
+        eliminar las de `removed`, sin tocar el resto. Devuelve el número de
+        operaciones Tk.
+        """
+        ops = 0
+
+        # Eliminar las VMs que ya no existen
+        for uuid in removed:
+            if self._vm_hosts.get(uuid) is not host:
+                continue  # ya aparece en otro host (migrada)
+            del self._vm_hosts[uuid]
+            if self._tree_snapshot.pop(uuid, None) is not None:
+                self.vm_tree.delete(uuid)
+                ops += 1
+
+        for record in records:
+            previous = self._tree_snapshot.get(record.uuid)
+            if previous is None:
+                self.vm_tree.insert(host.iid, 'end', iid=record.uuid, text=record.name,
+                                    values=self._tree_values(record))
+                ops += 1
+            elif self._vm_hosts.get(record.uuid) is not host:
+                # La VM se migró desde otro host
+                self.vm_tree.move(record.uuid, host.iid, 'end')
+                self.vm_tree.item(record.uuid, text=record.name, values=self._tree_values(record))
+                ops += 2
+            elif previous != record:
+                if previous.name != record.name:
+                    self.vm_tree.item(record.uuid, text=record.name)
+                    ops += 1
+                # Actualizar únicamente las celdas que cambiaron
+                for column, old, new in zip(TREE_COLUMNS, self._tree_values(previous),
+                                            self._tree_values(record)):
+                    if old != new:
+                        self.vm_tree.set(record.uuid, column, new)
+                        ops += 1
+            self._tree_snapshot[record.uuid] = record
+            self._vm_hosts[record.uuid] = host
+
+        return ops
+
+    def update_host_row(self, host):
+        """
+        Mostrar la salud y latencia del host en su fila si cambiaron. Si el
+        host no responde sus VMs se marcan como antiguas, con la hora de los
+        datos. Devuelve las operaciones Tk.
+        """
+        children = self.vm_tree.get_children(host.iid)
+        stale = host.health != 'ok' and host.last_ok is not None
+        if stale:
+            detail = f", datos de las {host.last_ok.strftime('%H:%M:%S')}"
+        else:
+            detail = f", {host.latency * 1000:.0f} ms" if host.latency is not None else ''
+        row = (f"{host.name} ({len(children)} VMs{detail})",
+               (HOST_HEALTH_LABELS[host.health], '', '', '', ''), stale)
+        previous = self._host_rows.get(host)
+        if previous == row:
+            return 0
+        self._host_rows[host] = row
+        self.vm_tree.item(host.iid, text=row[0], values=row[1])
+        ops = 1
+        if previous is None or previous[2] != stale:
+            for uuid in children:
+                self.vm_tree.item(uuid, tags=('stale',) if stale else ())
+            ops += len(children)
+        return ops
+
+    def _tree_values(self, record):
+        """Valores de las columnas del Treeview para una VM"""
+        cpu_percent = f"{record.cpu_percent:.1f}" if record.cpu_percent is not None else '-'
+        io_rate = format_rate(record.io_rate) if record.io_rate is not None else '-'
+        return (self.get_state_label(record.state), record.vcpus, record.max_mem,
+                cpu_percent, io_rate)
+
+    def sort_vm_tree_by(self, column):
+        """Ordenar por una columna; un segundo clic invierte el orden"""
+        if self._sort_column == column:
+            self._sort_descending = not self._sort_descending
+        else:
+            # Las columnas numéricas empiezan por el mayor (p. ej. top talkers de E/S)
+            self._sort_column = column
+            self._sort_descending = column not in ('#0', 'Estado')
+        self.apply_vm_tree_sort()
+
+    def apply_vm_tree_sort(self, hosts=None):
+        """
+        Mover solo las filas que no están en su posición dentro de cada host
+        (o solo de `hosts`). Devuelve las operaciones Tk.
+        """
+        if self._sort_column is None:
+            return 0
+        key = TREE_SORT_KEYS[self._sort_column]
+        ops = 0
+        for host in hosts or self.hosts:
+            current = list(self.vm_tree.get_children(host.iid))
+            desired = sorted((self._tree_snapshot[uuid] for uuid in current), key=key,
+                             reverse=self._sort_descending)
+            for index, record in enumerate(desired):
+                if current[index] != record.uuid:
+                    self.vm_tree.move(record.uuid, host.iid, index)
+                    current.remove(record.uuid)
+                    current.insert(index, record.uuid)
+                    ops += 1
+        return ops
+
+    def collect_domain_records(self, host, domains=None, running_only=False, objects=None):
+        """
+        Obtener estado, vCPUs, memoria y tiempo de CPU de todas las VMs del
+        host (o solo de `domains`, o solo de las que están en ejecución).
 
-                # Obtener información de la VM
-                info = vm.info()
-                max_mem = info[1] // 1024  # Convertir a MB
-                vcpus = info[3]
-
-                # Insertar en el tree
-                item_id = self.vm_tree.insert('', 'end', text=name,
-                                                values=(state_text, vcpus, max_mem))
-
-                # Cambiar color según el estado
-                if state == libvirt.VIR_DOMAIN_RUNNING:
-                    self.vm_tree.set(item_id, 'Estado', '🟢 Ejecutando')
-                elif state == libvirt.VIR_DOMAIN_SHUTOFF:
-                    self.vm_tree.set(item_id, 'Estado', '🔴 Apagada')
-                elif state == libvirt.VIR_DOMAIN_PAUSED:
-                    self.vm_tree.set(item_id, 'Estado', '🟡 Pausada')
+        Usa getAllDomainStats/domainListGetStats para resolverlo en una sola
+        llamada RPC; si el demonio no la soporta se recurre a listAllDomains +
+        info() por VM. Devuelve (registros, número de llamadas RPC realizadas).
+        Si se pasa `objects` se rellena con UUID -> dominio de la consulta.
+        """
+        conn = host.require()
+        if host.bulk_stats_supported:
+            try:
+                if domains is None:
+                    flags = libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING if running_only else 0
+                    stats = conn.getAllDomainStats(BULK_STATS, flags)
                 else:
-                    self.vm_tree.set(item_id, 'Estado', f'⚪ {state_text}')
-
-            self.status_label.config(text=f"Conectado - {len(all_vms)} VMs encontradas", fg='#27ae60')
-
-        except libvirt.libvirtError as e:
-            messagebox.showerror("Error", f"Error al listar VMs: {str(e)}")
-            self.status_label.config(text="Error de conexión", fg='#e74c3c')
+                    stats = conn.domainListGetStats(domains, BULK_STATS)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() not in (libvirt.VIR_ERR_NO_SUPPORT, libvirt.VIR_ERR_RPC):
+                    raise
+                print(f"getAllDomainStats no disponible en {host.name}, usando consulta por VM: {e}")
+                host.bulk_stats_supported = False
+            else:
+                records = [self._record_from_stats(vm, st) for vm, st in stats]
+                if objects is not None:
+                    objects.update((record.uuid, vm) for record, (vm, _) in zip(records, stats))
+                return self._sort_records(records), 1
+
+        # name() y UUIDString() no generan tráfico: vienen con el objeto dominio
+        if domains is None:
+            flags = libvirt.VIR_CONNECT_LIST_DOMAINS_RUNNING if running_only else 0
+            all_vms = conn.listAllDomains(flags)
+            rpc_count = len(all_vms) + 1
+        else:
+            all_vms = domains
+            rpc_count = len(all_vms)
+        records = []
+        for vm in all_vms:
+            try:
+                info = vm.info()
+                io = None
+                if is_active_state(info[0]):
+                    io, io_rpcs = self._collect_domain_io(vm)
+                    rpc_count += io_rpcs
+            except libvirt.libvirtError as e:
+                # Un dominio de la lista parcial pudo desaparecer entretanto
+                if domains is None or e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                continue
+            records.append(DomainRecord(vm.UUIDString(), vm.name(), info[0],
+                                        info[3], info[1] // 1024, info[4], io))
+            if objects is not None:
+                objects[records[-1].uuid] = vm
+        return self._sort_records(records), rpc_count
+
+    def _collect_domain_io(self, vm):
+        """
+        Contadores de E/S con blockStats/interfaceStats (demonios sin
+        estadísticas en bloque). Devuelve (DomainIO, número de llamadas RPC).
+        """
+        config = self.config_cache.get(vm, True)
+        blocks = []
+        for target in config.disk_targets:
+            rd_req, rd_bytes, wr_req, wr_bytes, _ = vm.blockStats(target)
+            blocks.append((target, rd_req, rd_bytes, wr_req, wr_bytes))
+        nets = []
+        for target in config.iface_targets:
+            stats = vm.interfaceStats(target)
+            nets.append((target, stats[0], stats[4]))
+        return DomainIO(tuple(blocks), tuple(nets)), len(blocks) + len(nets)
+
+    @staticmethod
+    def _record_from_stats(vm, stats):
+        """Construir un DomainRecord a partir de un resultado de getAllDomainStats"""
+        blocks = tuple((stats.get(f'block.{i}.name', str(i)),
+                        stats.get(f'block.{i}.rd.reqs', 0), stats.get(f'block.{i}.rd.bytes', 0),
+                        stats.get(f'block.{i}.wr.reqs', 0), stats.get(f'block.{i}.wr.bytes', 0))
+                       for i in range(stats.get('block.count', 0)))
+        nets = tuple((stats.get(f'net.{i}.name', str(i)),
+                      stats.get(f'net.{i}.rx.bytes', 0), stats.get(f'net.{i}.tx.bytes', 0))
+                     for i in range(stats.get('net.count', 0)))
+        return DomainRecord(vm.UUIDString(), vm.name(),
+                            stats.get('state.state', libvirt.VIR_DOMAIN_NOSTATE),
+                            stats.get('vcpu.current', 0),
+                            stats.get('balloon.maximum', 0) // 1024,
+                            stats.get('cpu.time', 0),
+                            DomainIO(blocks, nets))
+
+    @staticmethod
+    def _sort_records(records):
+        """Mostrar primero las VMs activas y luego las apagadas"""
+        return sorted(records, key=lambda r: r.state == libvirt.VIR_DOMAIN_SHUTOFF)
+
+    def get_state_label(self, state):
+        """Texto con indicador de color para la columna Estado"""
+        if state == libvirt.VIR_DOMAIN_RUNNING:
+            return '🟢 Ejecutando'
+        elif state == libvirt.VIR_DOMAIN_SHUTOFF:
+            return '🔴 Apagada'
+        elif state == libvirt.VIR_DOMAIN_PAUSED:
+            return '🟡 Pausada'
+        return f'⚪ {self.get_state_text(state)}'
 
     def get_state_text(self, state):
         """Convertir estado numérico a texto"""
@@ -240,9 +2296,49 @@ class VirtualizationClient:
             return
 
         item = selection[0]
+        host = self.hosts.by_iid(item)
+        if host is not None:
+            # Fila de un host: sus datos de conexión; las acciones irán a él
+            self.selected_host, self.selected_vm = host, None
+            self.render_host_details(host)
+            return
+
         vm_name = self.vm_tree.item(item, 'text')
+        self.selected_host = self._vm_hosts.get(item)
         self.selected_vm = vm_name
-        self.show_vm_details(vm_name)
+        self.info_text.delete(1.0, tk.END)
+        self.info_text.insert(1.0, f"Cargando detalles de '{vm_name}'...")
+        self.selected_host.poller.request_refresh(force=True)
+
+    def render_host_details(self, host):
+        """Mostrar en el panel de detalles la conexión y salud de un host"""
+        latency = f"{host.latency * 1000:.0f} ms" if host.latency is not None else 'N/A'
+        last_ok = host.last_ok.strftime('%H:%M:%S') if host.last_ok else 'N/A'
+        mode = "eventos" if host.events_enabled else "sondeo"
+        delay = host.reconnect_delay()
+        if delay is None:
+            reconnect = 'N/A'
+        else:
+            reconnect = f"intento {host.attempts + 1} en {delay:.0f} s"
+        text = f"""INFORMACIÓN DEL HOST
+═══════════════════════════════════════════════
+
+Host: {host.name}
+URI: {host.uri}
+Estado: {HOST_HEALTH_LABELS[host.health]}
+Actualización: {mode}
+Latencia del último inventario: {latency}
+Último sondeo correcto: {last_ok}
+Reconexión: {reconnect}
+Keepalive: cada {KEEPALIVE_INTERVAL} s, {KEEPALIVE_COUNT} sin respuesta
+Máquinas virtuales: {len(self.vm_tree.get_children(host.iid))}
+
+ÚLTIMO ERROR:
+─────────────────────────────────────────────────
+  {host.error or 'Ninguno'}
+"""
+        self.info_text.delete(1.0, tk.END)
+        self.info_text.insert(1.0, text)
 
     def show_vm_details(self, vm_name):
         """Mostrar detalles de la VM seleccionada"""
@@ -250,77 +2346,115 @@ class VirtualizationClient:
             return
 
         try:
-            vm = self.conn.lookupByName(vm_name)
-
-            # Información básica
-            info = vm.info()
-            state_text = self.get_state_text(info[0])
-
-            # XML de configuración
-            xml_desc = vm.XMLDesc(0)
-            root = ET.fromstring(xml_desc)
-
-            # Extraer información del XML
-            os_type_elem = root.find('.//os/type')
-            os_type = os_type_elem.text if os_type_elem is not None else 'Desconocido'
-            machine_type = os_type_elem.get('machine') if os_type_elem is not None else 'Desconocido'
-
-
-            memory_elem = root.find('memory')
-            memory = int(memory_elem.text) // 1024 if memory_elem is not None else 0
+            self.render_vm_details(self.collect_vm_details(self.selected_host or self.hosts.primary,
+                                                           vm_name))
+        except libvirt.libvirtError as e:
+            self.info_text.delete(1.0, tk.END)
+            self.info_text.insert(1.0, f"Error al obtener detalles: {str(e)}")
 
-            vcpu_elem = root.find('vcpu')
-            vcpus = vcpu_elem.text if vcpu_elem is not None else '0'
+    def collect_vm_details(self, host, vm_name):
+        """Obtener de libvirt los detalles de una VM del host (no toca la interfaz)"""
+        vm = host.require().lookupByName(vm_name)
+
+        # Información básica
+        info = vm.info()
+
+        # Configuración XML (desde la caché si no cambió)
+        config = self.config_cache.get(vm, is_active_state(info[0]))
+
+        return VMDetails(
+            name=vm_name,
+            uuid=vm.UUIDString(),
+            id=vm.ID() if info[0] == libvirt.VIR_DOMAIN_RUNNING else 'N/A',
+            state=info[0],
+            max_mem=info[1] // 1024,
+            cpu_time=info[4] // 1000000000,
+            config=config,
+            cpu=host.metrics.summary(vm.UUIDString()),
+            io=host.metrics.io_summary(vm.UUIDString()),
+            numa=self.collect_numa_usage(vm),
+        )
 
-            # Información de red
-            interfaces = root.findall('.//interface')
-            network_info = []
-            for iface in interfaces:
-                iface_type = iface.get('type', 'Desconocido')
-                source = iface.find('source')
-                if source is not None:
-                    network = source.get('network', source.get('bridge', 'Desconocido'))
-                    network_info.append(f"  - Tipo: {iface_type}, Red: {network}")
-
-            # Información de discos
-            disks = root.findall('.//disk[@device="disk"]')
-            disk_info = []
-            for disk in disks:
-                disk_type = disk.get('type', 'Desconocido')
-                source = disk.find('source')
-                if source is not None:
-                    file_path = source.get('file', source.get('dev', 'Desconocido'))
-                    disk_info.append(f"  - Tipo: {disk_type}, Archivo: {os.path.basename(file_path)}")
-            
-            # Información de CDROM
-            cdroms = root.findall('.//disk[@device="cdrom"]')
-            cdrom_info = []
-            for cdrom in cdroms:
-                source = cdrom.find('source')
-                if source is not None:
-                    file_path = source.get('file', 'No ISO')
-                    cdrom_info.append(f"  - Archivo ISO: {os.path.basename(file_path) if file_path != 'No ISO' else file_path}")
-
-
-            # Construir texto de información
-            details = f"""INFORMACIÓN DE LA MÁQUINA VIRTUAL
+    def collect_numa_usage(self, vm):
+        """Fijación de vCPUs y emulador de `vm` por nodo, con la memoria libre de cada nodo"""
+        try:
+            conn = vm.connect()
+            topology = host_topology(conn)
+            free_mb = node_free_memory_mb(conn, topology, NODE_MEMORY_INTERVAL)
+            vcpu_cpus, emulator_cpus = self.pinning_cache.get(vm)
+            vcpus = tuple((vcpu, format_cpuset(cpus), cpus_to_nodes(cpus, topology))
+                          for vcpu, cpus in enumerate(vcpu_cpus))
+        except libvirt.libvirtError as e:
+            print(f"No se pudo obtener la ubicación NUMA: {e}")
+            return None
+        nodes = tuple((node.id, format_cpuset(node.cpus), free, node.memory_mb)
+                      for node, free in zip(topology.nodes, free_mb))
+        return NumaUsage(nodes, vcpus, (format_cpuset(emulator_cpus),
+                                        cpus_to_nodes(emulator_cpus, topology)))
+
+    def render_vm_details(self, details):
+        """Mostrar en el panel de detalles la información ya obtenida"""
+        config = details.config
+        network_info = [f"  - Tipo: {iface_type}, Red: {network}"
+                        for iface_type, network in config.interfaces]
+        io_info = []
+        if details.io is not None:
+            for disk, rd_iops, rd_bps, wr_iops, wr_bps in details.io.blocks:
+                io_info.append(f"  - {disk}: lectura {rd_iops:.0f} IOPS / {format_rate(rd_bps)}, "
+                               f"escritura {wr_iops:.0f} IOPS / {format_rate(wr_bps)}")
+            for iface, rx_bps, tx_bps in details.io.nets:
+                io_info.append(f"  - {iface}: rx {format_rate(rx_bps)}, tx {format_rate(tx_bps)}")
+        disk_info = [f"  - Tipo: {disk_type}, Archivo: {os.path.basename(file_path)}"
+                     for disk_type, file_path in config.disks]
+        cdrom_info = [f"  - Archivo ISO: {os.path.basename(file_path) if file_path else 'No ISO'}"
+                      for file_path in config.cdroms]
+        cpu = details.cpu
+        if cpu is not None:
+            cpu_info = (f"Uso de CPU: {cpu.current:.1f}% (promedio {cpu.average:.1f}%, "
+                        f"pico {cpu.peak:.1f}%)\nHistorial CPU: {sparkline(cpu.history)}")
+        else:
+            cpu_info = "Uso de CPU: sin muestras"
+        numa_info = []
+        numa = details.numa
+        if numa is not None:
+            for node, cpuset, free_mb, total_mb in numa.nodes:
+                numa_info.append(f"  - Nodo {node}: CPUs {cpuset}, libre {free_mb} de {total_mb} MB")
+            used_nodes = set()
+            for vcpu, cpuset, nodes in numa.vcpus:
+                used_nodes.update(nodes)
+                numa_info.append(f"  - vCPU {vcpu} -> CPUs {cpuset} "
+                                 f"(nodo {','.join(map(str, nodes))})")
+            emulator_set, emulator_nodes = numa.emulator
+            used_nodes.update(emulator_nodes)
+            numa_info.append(f"  - Emulador -> CPUs {emulator_set} "
+                             f"(nodo {','.join(map(str, emulator_nodes))})")
+            if len(numa.nodes) > 1 and len(used_nodes) > 1:
+                numa_info.append("  ⚠ La VM usa CPUs de varios nodos NUMA")
+
+        # Construir texto de información
+        text = f"""INFORMACIÓN DE LA MÁQUINA VIRTUAL
 ═══════════════════════════════════════════════
 
-Nombre: {vm_name}
-Estado: {state_text}
-ID: {vm.ID() if info[0] == libvirt.VIR_DOMAIN_RUNNING else 'N/A'}
-UUID: {vm.UUIDString()}
+Nombre: {details.name}
+Estado: {self.get_state_text(details.state)}
+ID: {details.id}
+UUID: {details.uuid}
 
 RECURSOS:
 ─────────────────────────────────────────────────
-CPU Virtual: {vcpus} vCPUs
-Memoria RAM: {memory} MB
-Memoria Máxima: {info[1] // 1024} MB
-Tiempo de CPU: {info[4] // 1000000000} segundos
+CPU Virtual: {config.vcpus} vCPUs
+Memoria RAM: {config.memory} MB
+Memoria Máxima: {details.max_mem} MB
+Tiempo de CPU: {details.cpu_time} segundos
+{cpu_info}
+
+NUMA / FIJACIÓN DE CPU:
+─────────────────────────────────────────────────
+{chr(10).join(numa_info) if numa_info else '  - Sin información de topología'}
 
 SISTEMA OPERATIVO:
 ─────────────────────────────────────────────────
-Tipo: {os_type} (Máquina: {machine_type})
+Tipo: {config.os_type} (Máquina: {config.machine})
 
 REDES:
 ─────────────────────────────────────────────────
@@ -334,18 +2468,19 @@ CDROM:
 ─────────────────────────────────────────────────
 {chr(10).join(cdrom_info) if cdrom_info else '  - No hay CDROM configurado o ISO montado'}
 
+ACTIVIDAD DE E/S:
+─────────────────────────────────────────────────
+{chr(10).join(io_info) if io_info else '  - Sin datos de E/S (la VM debe estar en ejecución)'}
+
 
 ÚLTIMA ACTUALIZACIÓN:
 ─────────────────────────────────────────────────
 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+Caché de configuración: {self.config_cache.hits} aciertos, {self.config_cache.misses} fallos
 """
 
-            self.info_text.delete(1.0, tk.END)
-            self.info_text.insert(1.0, details)
-
-        except libvirt.libvirtError as e:
-            self.info_text.delete(1.0, tk.END)
-            self.info_text.insert(1.0, f"Error al obtener detalles: {str(e)}")
+        self.info_text.delete(1.0, tk.END)
+        self.info_text.insert(1.0, text)
 
     def start_vm(self):
         """Iniciar máquina virtual"""
@@ -354,272 +2489,1042 @@ CDROM:
             return
 
         try:
-            vm = self.conn.lookupByName(self.selected_vm)
+            vm = self.selected_domain()
             if vm.isActive():
                 messagebox.showinfo("Información", "La máquina virtual ya está ejecutándose")
                 return
 
             vm.create()
             messagebox.showinfo("Éxito", f"Máquina virtual '{self.selected_vm}' iniciada correctamente")
-            self.refresh_vm_list()
+            self.request_refresh()
 
         except libvirt.libvirtError as e:
             messagebox.showerror("Error", f"Error al iniciar VM: {str(e)}")
 
     def stop_vm(self):
-        """Detener máquina virtual"""
-        if not self.selected_vm:
+        """Apagar de forma ordenada las máquinas virtuales seleccionadas"""
+        targets = self.selected_vm_targets()
+        if not targets:
+            messagebox.showwarning("Advertencia", "Seleccione una máquina virtual")
+            return
+        self.shutdown_vms(targets)
+
+    def stop_all_vms(self):
+        """
+        Apagar todas las VMs en ejecución (p. ej. antes de un mantenimiento):
+        las de los hosts seleccionados en el tree, o las de todos si no hay
+        ninguna fila de host seleccionada.
+        """
+        hosts = {self.hosts.by_iid(item) for item in self.vm_tree.selection()} - {None}
+        targets = OrderedDict((self.vm_label(self._vm_hosts[uuid], record.name),
+                               (self._vm_hosts[uuid], record.name))
+                              for uuid, record in self._tree_snapshot.items()
+                              if is_active_state(record.state)
+                              and (not hosts or self._vm_hosts[uuid] in hosts))
+        if not targets:
+            messagebox.showinfo("Información", "No hay máquinas virtuales en ejecución")
+            return
+        self.shutdown_vms(targets)
+
+    def shutdown_vms(self, targets):
+        """Pedir plazo y política y lanzar el apagado en paralelo con una vista de progreso"""
+        labels = list(targets)
+        target = f"'{labels[0]}'" if len(labels) == 1 else f"{len(labels)} máquinas virtuales"
+        options = ShutdownOptionsDialog(self.root, f"Apagar {target}").result
+        if options is None:
+            return
+        deadline, policy = options
+
+        def task(label, report):
+            host, name = targets[label]
+            return self.shutdowns.shutdown(host.require(), name, deadline, policy,
+                                           host.events_enabled, report)
+
+        TaskProgressDialog(self.root, f"Apagado de {target}", labels, task,
+                           SHUTDOWN_WORKERS, self.request_refresh, reports=True)
+
+    def vm_label(self, host, name):
+        """Nombre de una VM en las vistas de progreso; con varios hosts incluye el suyo"""
+        return name if len(self.hosts) == 1 else f"{name} @ {host.name}"
+
+    def selected_vm_targets(self):
+        """
+        VMs seleccionadas en el tree (selección múltiple) como un diccionario
+        ordenado etiqueta -> (HostConnection, nombre). Las filas de host se ignoran.
+        """
+        targets = OrderedDict()
+        for item in self.vm_tree.selection():
+            host = self._vm_hosts.get(item)
+            if host is not None:
+                name = self.vm_tree.item(item, 'text')
+                targets[self.vm_label(host, name)] = (host, name)
+        return targets
+
+    def delete_vm(self):
+        """Eliminar en segundo plano las máquinas virtuales seleccionadas"""
+        targets = OrderedDict((label, target) for label, target in self.selected_vm_targets().items()
+                              if label not in self._deleting)
+        names = list(targets)
+        if not names:
             messagebox.showwarning("Advertencia", "Seleccione una máquina virtual")
             return
 
+        target = f"'{names[0]}'" if len(names) == 1 else f"{len(names)} máquinas virtuales"
         result = messagebox.askyesno("Confirmación",
-                                     f"¿Está seguro de detener '{self.selected_vm}'?")
+                                     f"¿Está seguro de eliminar {target}?\n"
+                                     "Esta acción no se puede deshacer y eliminará también sus discos, "
+                                     "instantáneas y NVRAM.")
         if not result:
             return
+        wipe = messagebox.askyesno("Borrado seguro",
+                                   "¿Sobrescribir el contenido de los discos antes de borrarlos?\n"
+                                   "Es más lento en discos grandes.", default=messagebox.NO)
 
-        try:
-            vm = self.conn.lookupByName(self.selected_vm)
-            if not vm.isActive():
-                messagebox.showinfo("Información", "La máquina virtual ya está detenida")
-                return
+        self._deleting.update(names)
+        if (self.selected_host, self.selected_vm) in targets.values():
+            self.selected_vm = None
+            self.info_text.delete(1.0, tk.END)
+
+        def finished():
+            self._deleting.difference_update(names)
+            self.request_refresh()
+
+        def task(label):
+            host, name = targets[label]
+            return delete_domain(host.require(), name, wipe)
+
+        TaskProgressDialog(self.root, "Eliminación de VMs", names, task, DELETE_WORKERS, finished)
+
+    def pin_vm_cpus(self):
+        """
+        Volver a fijar en vivo las vCPUs y el emulador de la VM seleccionada.
+        El estado y las vCPUs salen del tree; la topología y la memoria libre
+        del host se leen en un hilo de trabajo, igual que la fijación.
+        """
+        if not self.selected_vm:
+            messagebox.showwarning("Advertencia", "Seleccione una máquina virtual")
+            return
 
-            vm.shutdown() # Envía una señal ACPI de apagado
-            messagebox.showinfo("Éxito", f"Señal de apagado enviada a '{self.selected_vm}'")
-            self.refresh_vm_list()
+        host = self.selected_host or self.hosts.primary
+        record = next((record for uuid, record in self._tree_snapshot.items()
+                       if record.name == self.selected_vm and self._vm_hosts.get(uuid) is host),
+                      None)
+        if record is None or not is_active_state(record.state):
+            messagebox.showwarning("Advertencia", "La VM debe estar en ejecución para fijar sus vCPUs")
+            return
 
-            # Esperar un poco y luego intentar destruir si no se apaga
-            # Esto es un comportamiento más robusto
-            self.root.after(5000, lambda: self._check_and_destroy_vm(vm))
+        def read_host():
+            conn = host.require()
+            topology = host_topology(conn)
+            return topology, node_free_memory_mb(conn, topology, NODE_MEMORY_INTERVAL)
 
-        except libvirt.libvirtError as e:
-            messagebox.showerror("Error", f"Error al detener VM: {str(e)}")
+        self._ask_vcpu_pinning(self._host_info_executor.submit(read_host), host, record)
 
-    def _check_and_destroy_vm(self, vm):
-        """Verifica si la VM se apagó y la destruye si no."""
+    def _ask_vcpu_pinning(self, future, host, record):
+        """Con la topología ya leída, pedir las CPUs y fijarlas en un hilo de trabajo"""
+        if not future.done():
+            self.root.after(100, self._ask_vcpu_pinning, future, host, record)
+            return
         try:
-            state, reason = vm.state()
-            if state != libvirt.VIR_DOMAIN_SHUTOFF:
-                response = messagebox.askyesno(
-                    "Forzar apagado",
-                    f"La VM '{vm.name()}' no se apagó. ¿Desea forzar su apagado (destruir)? "
-                    "Esto puede causar pérdida de datos."
-                )
-                if response:
-                    vm.destroy()
-                    messagebox.showinfo("Éxito", f"VM '{vm.name()}' forzada a apagarse.")
-                    self.refresh_vm_list()
-            else:
-                self.refresh_vm_list() # Ya se apagó, solo refrescar
+            topology, free_mb = future.result()
         except libvirt.libvirtError as e:
-            print(f"Error en _check_and_destroy_vm: {e}")
-            self.refresh_vm_list() # Refrescar de todos modos
+            messagebox.showerror("Error", f"Error al leer la topología del host: {str(e)}")
+            return
 
+        vcpus = record.vcpus
+        nodes_text = "\n".join(f"Nodo {node.id}: CPUs {format_cpuset(node.cpus)}, {free} MB libres"
+                               for node, free in zip(topology.nodes, free_mb))
+        text = simpledialog.askstring(
+            "Fijar vCPUs",
+            f"{nodes_text}\n\nCPUs del host para las {vcpus} vCPUs de '{record.name}' "
+            "(p. ej. 0-3 o 0,2,4,6).\nCon tantas CPUs como vCPUs cada una se fija a una CPU:",
+            parent=self.root)
+        if not text:
+            return
+        try:
+            cpus = parse_cpuset(text)
+            if cpus[-1] >= topology.cpus:
+                raise ValueError(f"el host solo tiene {topology.cpus} CPUs")
+        except ValueError as e:
+            messagebox.showerror("Error", f"Conjunto de CPUs no válido: {e}")
+            return
 
-    def delete_vm(self):
-        """Eliminar máquina virtual"""
+        def task(name):
+            # Se aplica en vivo y en la configuración persistente
+            flags = libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG
+            vm = host.require().lookupByName(name)
+            try:
+                for vcpu, vcpu_cpus in enumerate(vcpu_pin_sets(cpus, vcpus)):
+                    vm.pinVcpuFlags(vcpu, cpus_to_cpumap(vcpu_cpus, topology.cpus), flags)
+                vm.pinEmulator(cpus_to_cpumap(cpus, topology.cpus), flags)
+            finally:
+                self.pinning_cache.invalidate(record.uuid)
+                self.config_cache.invalidate(record.uuid)
+            return f"Fijadas a las CPUs {format_cpuset(cpus)}"
+
+        TaskProgressDialog(self.root, "Fijar vCPUs", [record.name], task, 1,
+                           self.request_refresh)
+
+    def flatten_vm_disk(self):
+        """Desvincular en segundo plano los discos de la VM de sus imágenes base"""
         if not self.selected_vm:
             messagebox.showwarning("Advertencia", "Seleccione una máquina virtual")
             return
 
-        result = messagebox.askyesno("Confirmación",
-                                     f"¿Está seguro de eliminar '{self.selected_vm}'?\n"
-                                     "Esta acción no se puede deshacer y eliminará también el archivo de disco.")
-        if not result:
+        host = self.selected_host or self.hosts.primary
+        try:
+            vm = self.selected_domain()
+            active = bool(vm.isActive())
+            if not active and not host.local():
+                messagebox.showwarning(
+                    "Aplanar disco",
+                    f"Con la VM apagada el disco se aplana con qemu-img en esta máquina, pero "
+                    f"sus archivos están en el host remoto {host.hostname}.\n"
+                    "Inicie la VM para aplanarlo en vivo en el host.")
+                return
+            disks = backed_disks(vm, active)
+        except libvirt.libvirtError as e:
+            messagebox.showerror("Error", f"Error al leer la VM: {str(e)}")
+            return
+        if not disks:
+            messagebox.showinfo("Aplanar disco",
+                                f"Ningún disco de '{self.selected_vm}' depende de una imagen base")
             return
 
-        try:
-            vm = self.conn.lookupByName(self.selected_vm)
+        names = ', '.join(os.path.basename(path) for _, path in disks)
+        if not messagebox.askyesno("Aplanar disco",
+                                   f"Los discos {names} dejarán de depender de su imagen base "
+                                   "y ocuparán su tamaño completo.\n¿Desea continuar?"):
+            return
 
-            # Obtener la ruta del disco antes de indefinir la VM
-            disk_path = None
-            try:
-                xml_desc = vm.XMLDesc(0)
-                root = ET.fromstring(xml_desc)
-                disk_source = root.find('.//disk[@device="disk"]/source')
-                if disk_source is not None:
-                    disk_path = disk_source.get('file')
-            except Exception as xml_error:
-                print(f"Advertencia: No se pudo obtener la ruta del disco del XML: {xml_error}")
-
-            # Detener si está ejecutándose
-            if vm.isActive():
-                vm.destroy() # Forzar apagado para poder eliminar
-
-            # Eliminar definición
-            vm.undefine()
-            messagebox.showinfo("Éxito", f"Máquina virtual '{self.selected_vm}' eliminada.")
-            
-            # Eliminar el archivo de disco asociado (automático con la confirmación)
-            if disk_path and os.path.exists(disk_path):
-                try:
-                    os.remove(disk_path)
-                    messagebox.showinfo("Disco Eliminado", f"Archivo de disco '{disk_path}' eliminado.")
-                except OSError as e:
-                    messagebox.showerror("Error", f"No se pudo eliminar el archivo de disco '{disk_path}':\n{e}")
+        uuid = vm.UUIDString()
 
-            self.selected_vm = None
-            self.info_text.delete(1.0, tk.END)
-            self.refresh_vm_list()
+        def task(name):
+            try:
+                return flatten_disk(vm, disks, active)
+            finally:
+                self.config_cache.invalidate(uuid)
 
-        except libvirt.libvirtError as e:
-            messagebox.showerror("Error", f"Error al eliminar VM: {str(e)}")
+        TaskProgressDialog(self.root, "Aplanar disco", [self.selected_vm], task, 1,
+                           self.request_refresh)
 
     def connect_to_vm_display(self):
         """
-        Intenta conectar a la pantalla VNC de la VM seleccionada
-        lanzando un cliente VNC externo.
+        Conectar a la pantalla VNC de la VM seleccionada lanzando un cliente
+        VNC externo. El puerto sale de la tabla de pantallas que mantiene el
+        hilo de sondeo; si aún no está, se lee del XML en vivo por la misma
+        conexión de libvirt.
         """
         if not self.selected_vm:
             messagebox.showwarning("Advertencia", "Seleccione una máquina virtual para conectar.")
             return
 
-        try:
-            vm = self.conn.lookupByName(self.selected_vm)
-            if not vm.isActive():
-                messagebox.showwarning("Advertencia", f"La VM '{self.selected_vm}' no está en ejecución. Iníciela primero.")
+        host = self.selected_host or self.hosts.primary
+        endpoint = host.displays.get(self.selected_vm)
+        if endpoint is None:
+            try:
+                vm = self.selected_domain()
+                if not vm.isActive():
+                    messagebox.showwarning("Advertencia", f"La VM '{self.selected_vm}' no está en ejecución. Iníciela primero.")
+                    return
+                endpoint = display_endpoint(self.selected_vm, self.config_cache.get(vm, True))
+            except libvirt.libvirtError as e:
+                messagebox.showerror("Error", f"Error al obtener información de la VM para VNC: {str(e)}")
                 return
-
-            # --- NUEVA FORMA DE OBTENER LA DIRECCIÓN VNC DESDE EL XML Y virsh ---
-            xml_desc = vm.XMLDesc(0)
-            root = ET.fromstring(xml_desc)
-            
-            graphics_elem = root.find(".//graphics[@type='vnc']")
-            if graphics_elem is None:
-                messagebox.showerror("Error de VNC", "No se encontró configuración VNC en el XML de la VM.")
+            if endpoint is None:
+                messagebox.showerror("Error de VNC", "La VM no tiene una pantalla VNC con puerto asignado.")
                 return
-            
-            vnc_port_xml = graphics_elem.get('port') # Esto puede ser '-1'
-            vnc_listen_address = graphics_elem.get('listen', '127.0.0.1') # Por defecto a 127.0.0.1 si no está en el XML
 
-            vnc_port = None
-            if vnc_port_xml == "-1": # Puerto asignado dinámicamente (autoport='yes')
-                try:
-                    # Usar virsh vncdisplay para obtener el puerto asignado dinámicamente
-                    # Asegúrate de que virsh esté en el PATH o usa la ruta completa si es necesario
-                    virsh_cmd = ["virsh", "vncdisplay", self.selected_vm]
-                    virsh_result = subprocess.run(virsh_cmd, capture_output=True, text=True, check=True)
-                    virsh_output = virsh_result.stdout.strip()
-                    
-                    if not virsh_output:
-                        messagebox.showerror("Error VNC", "Virsh no devolvió información del display VNC.")
-                        return
-
-                    # Parsear la salida de virsh vncdisplay (ej. ':1' o '127.0.0.1:5901')
-                    if ":" in virsh_output:
-                        parts = virsh_output.split(':')
-                        if len(parts) == 2:
-                            if parts[0] == "": # Caso ':N' (ej. :1 -> 5901)
-                                try:
-                                    vnc_port = 5900 + int(parts[1])
-                                except ValueError:
-                                    messagebox.showerror("Error VNC", f"Formato de display VNC inválido desde virsh (puerto): {virsh_output}")
-                                    return
-                            else: # Caso 'IP:N' (ej. 127.0.0.1:5901)
-                                vnc_listen_address = parts[0] # Actualizar por si acaso
-                                try:
-                                    vnc_port = int(parts[1])
-                                except ValueError:
-                                    messagebox.showerror("Error VNC", f"Formato de display VNC inválido desde virsh (host:puerto): {virsh_output}")
-                                    return
-                        else:
-                            messagebox.showerror("Error VNC", f"Formato de display VNC desconocido desde virsh: {virsh_output}")
-                            return
-                    else:
-                         messagebox.showerror("Error VNC", f"Formato de display VNC inesperado desde virsh: {virsh_output}")
-                         return
-
-                except subprocess.CalledProcessError as e:
-                    messagebox.showerror("Error VNC", f"No se pudo obtener el display VNC de la VM (virsh vncdisplay falló):\n{e.stderr}")
-                    return
-                except Exception as e:
-                    messagebox.showerror("Error VNC", f"Error al parsear la salida de virsh vncdisplay: {e}")
-                    return
-            else: # Puerto fijo en el XML
-                try:
-                    vnc_port = int(vnc_port_xml)
-                except ValueError:
-                    messagebox.showerror("Error VNC", f"Puerto VNC inválido en el XML: {vnc_port_xml}")
-                    return
+        address, port, needs_tunnel = resolve_vnc_address(endpoint, host.hostname)
+        if not needs_tunnel:
+            self.launch_vnc_viewer(f"{address}:{port}")
+            return
 
-            if vnc_port is None:
-                messagebox.showerror("Error VNC", "No se pudo determinar el puerto VNC.")
-                return
+        # La pantalla solo escucha en loopback del host remoto: túnel SSH en segundo plano
+        host.tunnels.close_unused(host.displays.ports())
+        self.status_label.config(text=f"Abriendo túnel SSH hacia {host.hostname}...")
+        self._wait_for_tunnel(self._tunnel_executor.submit(host.tunnels.open, endpoint.port))
 
-            vnc_address = f"{vnc_listen_address}:{vnc_port}"
-            # --- FIN NUEVA FORMA ---
+    def _wait_for_tunnel(self, future):
+        """Esperar sin bloquear la interfaz a que el túnel esté listo y lanzar el visor"""
+        if not future.done():
+            self.root.after(100, self._wait_for_tunnel, future)
+            return
+        try:
+            local_port = future.result()
+        except TunnelError as e:
+            messagebox.showerror("Error de túnel SSH", str(e))
+            return
+        self.launch_vnc_viewer(f"127.0.0.1:{local_port}")
 
-            # Intentar lanzar Vinagre (Visor de Escritorios Remotos)
+    def launch_vnc_viewer(self, vnc_address):
+        """Lanzar Vinagre (o Remmina si no está instalado) hacia host:puerto"""
+        try:
+            subprocess.Popen(["vinagre", vnc_address])
+            messagebox.showinfo("Conectando...", f"Lanzando Vinagre para conectar a {vnc_address}")
+        except FileNotFoundError:
+            # Si Vinagre no se encuentra, intentar Remmina
             try:
-                subprocess.Popen(["vinagre", vnc_address])
-                messagebox.showinfo("Conectando...", f"Lanzando Vinagre para conectar a {vnc_address}")
+                subprocess.Popen(["remmina", f"vnc://{vnc_address}"])
+                messagebox.showinfo("Conectando...", f"Lanzando Remmina para conectar a {vnc_address}")
             except FileNotFoundError:
-                # Si Vinagre no se encuentra, intentar Remmina
-                try:
-                    subprocess.Popen(["remmina", f"vnc://{vnc_address}"])
-                    messagebox.showinfo("Conectando...", f"Lanzando Remmina para conectar a {vnc_address}")
-                except FileNotFoundError:
-                    messagebox.showerror("Error",
-                                         "No se encontraron clientes VNC (Vinagre o Remmina).\n"
-                                         "Por favor, instale uno: 'sudo apt install vinagre' o 'sudo apt install remmina remmina-plugin-vnc'")
-            except Exception as e:
-                messagebox.showerror("Error", f"Error al lanzar el cliente VNC: {str(e)}")
+                messagebox.showerror("Error",
+                                     "No se encontraron clientes VNC (Vinagre o Remmina).\n"
+                                     "Por favor, instale uno: 'sudo apt install vinagre' o 'sudo apt install remmina remmina-plugin-vnc'")
+        except Exception as e:
+            messagebox.showerror("Error", f"Error al lanzar el cliente VNC: {str(e)}")
+
+    def create_vm_dialog(self):
+        """
+        Diálogo para crear nueva VM en el host seleccionado (o el primero).
+        Los clones enlazados se crean con qemu-img en esta máquina, así que
+        el catálogo de imágenes base solo se ofrece para hosts locales.
+        """
+        host = self.selected_host or self.hosts.primary
+        if not self.conn:
+            messagebox.showwarning("Advertencia", f"Sin conexión con el host {host.name}")
+            return
+        dialog = VMCreationDialog(self.root, self.conn, self.request_refresh,
+                                  self.base_images if host.local() else None)
+
+    def request_refresh(self):
+        """Pedir a los hilos de fondo de todos los hosts un sondeo inmediato (lista y detalles)"""
+        for host in self.hosts:
+            host.poller.request_refresh(force=True)
 
+    def collect_snapshot(self, host, selected_vm):
+        """
+        Sondeo completo de un host; se ejecuta en su hilo InventoryPoller.
+        Abre la conexión si hace falta y registra la salud y la latencia.
+        Mientras se espera al siguiente intento de reconexión no llama a
+        libvirt: devuelve el error de la conexión perdida y la interfaz
+        conserva el inventario anterior.
+        """
+        if host.reconnect_delay():
+            return InventorySnapshot(host, (), 0, selected_vm, None, None,
+                                     host.error or "Reconectando", False, ())
+        try:
+            if host.ensure_connected():
+                self.host_connected(host)
+            started = time.monotonic()
+            objects = {}
+            records, rpc_count = self.collect_domain_records(host, objects=objects)
         except libvirt.libvirtError as e:
-            messagebox.showerror("Error", f"Error al obtener información de la VM para VNC: {str(e)}")
+            host.mark_down(str(e))
+            return InventorySnapshot(host, (), 0, selected_vm, None, None, str(e), False, ())
+        host.mark_ok(time.monotonic() - started)
+        records = host.metrics.sample(records, time.monotonic(), prune=True)
+        rpc_count += self.update_display_endpoints(host, records, objects)
 
+        details, details_error = self._collect_selected_details(host, selected_vm)
+        return InventorySnapshot(host, tuple(records), rpc_count, selected_vm,
+                                 details, details_error, None, False, ())
 
-    def create_vm_dialog(self):
-        """Diálogo para crear nueva VM"""
-        dialog = VMCreationDialog(self.root, self.conn, self.refresh_vm_list)
+    def collect_domain_update(self, host, changed, selected_vm):
+        """
+        Sondeo parcial tras eventos (hilo InventoryPoller del host). `changed`
+        asocia UUID -> dominio, o None si el dominio fue eliminado.
+        """
+        if not host.connected():
+            return None
 
-    def auto_refresh(self):
-        """Auto-actualizar la lista cada 5 segundos"""
-        self.time_label.config(text=datetime.now().strftime('%H:%M:%S'))
-        if self.selected_vm:
-            # Refresh details of the selected VM to show live status
-            # Solo si la VM seleccionada está activa para evitar errores si se elimina
+        domains = [dom for dom in changed.values() if dom is not None]
+        removed = tuple(uuid for uuid, dom in changed.items() if dom is None)
+        records, rpc_count = (), 0
+        if domains:
             try:
-                vm = self.conn.lookupByName(self.selected_vm)
-                if vm.isActive():
-                    self.show_vm_details(self.selected_vm)
-            except libvirt.libvirtError:
-                # VM ya no existe o no se puede encontrar
+                records, rpc_count = self.collect_domain_records(host, domains)
+            except libvirt.libvirtError as e:
+                host.mark_down(str(e))
+                return InventorySnapshot(host, (), 0, None, None, None, str(e), True, removed)
+            rpc_count += self.update_display_endpoints(
+                host, records, {dom.UUIDString(): dom for dom in domains}, changed=True)
+        for uuid in removed:
+            host.displays.discard(uuid)
+        return self._partial_snapshot(host, records, rpc_count, removed, selected_vm)
+
+    def update_display_endpoints(self, host, records, objects, changed=False):
+        """
+        Mantener la tabla de pantallas VNC del host (hilo InventoryPoller).
+        `objects` asocia UUID -> dominio de la misma consulta, así que no
+        hace falta buscarlos. Con eventos (`changed`) son los dominios que
+        arrancaron o se detuvieron y su pantalla se vuelve a leer. Solo se
+        consultan las VMs activas que no están en la tabla, como mucho
+        DISPLAY_BATCH por sondeo. Devuelve el número de llamadas RPC.
+        """
+        active = {record.uuid: record for record in records if is_active_state(record.state)}
+        if changed:
+            for uuid in objects:
+                host.displays.discard(uuid)
+        else:
+            host.displays.retain(active)
+
+        pending = [uuid for uuid in active if uuid not in host.displays][:DISPLAY_BATCH]
+        rpc_count = 0
+        for uuid in pending:
+            record = active[uuid]
+            try:
+                vm = objects.get(uuid)
+                if vm is None:
+                    vm = host.require().lookupByUUIDString(uuid)
+                    rpc_count += 1
+                misses = self.config_cache.misses
+                config = self.config_cache.get(vm, True)
+                rpc_count += self.config_cache.misses - misses
+            except libvirt.libvirtError as e:
+                print(f"No se pudo leer la pantalla VNC de '{record.name}': {e}")
+                continue
+            host.displays.set(uuid, display_endpoint(record.name, config))
+        return rpc_count
+
+    def collect_metrics_sample(self, host, selected_vm):
+        """Muestra de métricas en modo eventos: solo las VMs en ejecución del host"""
+        if not host.connected():
+            return None
+
+        try:
+            records, rpc_count = self.collect_domain_records(host, running_only=True)
+        except libvirt.libvirtError as e:
+            host.mark_down(str(e))
+            return InventorySnapshot(host, (), 0, None, None, None, str(e), True, ())
+        return self._partial_snapshot(host, records, rpc_count, (), selected_vm)
+
+    def _partial_snapshot(self, host, records, rpc_count, removed, selected_vm):
+        """Construir un InventorySnapshot parcial con métricas y detalles"""
+        records = host.metrics.sample(records, time.monotonic())
+
+        # Los detalles solo se recargan si la VM seleccionada cambió
+        if selected_vm not in {record.name for record in records}:
+            selected_vm = None
+        details, details_error = self._collect_selected_details(host, selected_vm)
+        return InventorySnapshot(host, tuple(records), rpc_count, selected_vm,
+                                 details, details_error, None, True, removed)
+
+    def _collect_selected_details(self, host, selected_vm):
+        """Devuelve (detalles, error) de la VM seleccionada, si la hay"""
+        if not selected_vm:
+            return None, None
+        try:
+            return self.collect_vm_details(host, selected_vm), None
+        except libvirt.libvirtError as e:
+            return None, str(e)
+
+    def process_snapshots(self):
+        """Revisar la cola de los hilos de fondo y aplicar los sondeos pendientes"""
+        pending = []
+        try:
+            while True:
+                pending.append(self.snapshots.get_nowait())
+        except queue.Empty:
+            pass
+        # Un sondeo completo de un host reemplaza a los anteriores de ese
+        # host; los parciales posteriores se aplican en orden
+        last_full = {}
+        for i, snapshot in enumerate(pending):
+            if not snapshot.partial:
+                last_full[snapshot.host] = i
+        for i, snapshot in enumerate(pending):
+            if i >= last_full.get(snapshot.host, 0):
+                self.root.after_idle(self.apply_snapshot, snapshot)
+        self.root.after(100, self.process_snapshots)
+
+    def apply_snapshot(self, snapshot):
+        """Aplicar en la interfaz un InventorySnapshot de un host (hilo principal)"""
+        with instrumentation.registry.timed('tk_update', snapshot.host.name):
+            self._apply_snapshot(snapshot)
+
+    def _apply_snapshot(self, snapshot):
+        host = snapshot.host
+        if snapshot.error:
+            # Las VMs del host se conservan; su fila indica que no responde
+            self.update_host_row(host)
+            self.update_status()
+            if self.selected_host is host and self.selected_vm is None:
+                self.render_host_details(host)
+            return
+
+        if snapshot.partial:
+            removed_names = {self._tree_snapshot[uuid].name for uuid in snapshot.removed
+                             if self._vm_hosts.get(uuid) is host}
+            self.last_tree_ops = self.update_vm_rows(host, snapshot.records, snapshot.removed)
+            if self.selected_host is host and self.selected_vm in removed_names:
                 self.selected_vm = None
                 self.info_text.delete(1.0, tk.END)
                 self.info_text.insert(1.0, "VM seleccionada ya no existe o no está disponible.")
+        else:
+            self.last_tree_ops = self.reconcile_vm_tree(host, snapshot.records)
+        self.last_tree_ops += self.apply_vm_tree_sort([host])
+        self.last_tree_ops += self.update_host_row(host)
+        self.last_refresh_rpcs = snapshot.rpc_count
+        self.update_status()
+
+        if self.selected_host is host and self.selected_vm is None:
+            self.render_host_details(host)
+        # Ignorar detalles de una selección que ya cambió
+        if (not self.selected_vm or self.selected_host is not host
+                or snapshot.selected != self.selected_vm):
+            return
+        if snapshot.details is not None:
+            self.render_vm_details(snapshot.details)
+        else:
+            # VM ya no existe o no se puede encontrar
+            self.selected_vm = None
+            self.info_text.delete(1.0, tk.END)
+            self.info_text.insert(1.0, "VM seleccionada ya no existe o no está disponible.")
+
+    def update_status(self):
+        """
+        Resumen de todos los hosts en la barra de estado: conectado, degradado
+        (algún host sin responder) o reconectando; nunca un diálogo modal.
+        """
+        online = sum(1 for host in self.hosts if host.health == 'ok')
+        pending = [host.name for host in self.hosts if host.health != 'ok']
+        mode = "eventos" if any(host.events_enabled for host in self.hosts) else "sondeo"
+        if not pending:
+            text = (f"Conectado ({mode}) a {len(self.hosts)} hosts - "
+                    f"{len(self._tree_snapshot)} VMs encontradas "
+                    f"({self.last_refresh_rpcs} RPC, {self.last_tree_ops} cambios)")
+            color = '#27ae60'
+        elif online:
+            text = (f"Degradado: {online} de {len(self.hosts)} hosts en línea, sin respuesta de "
+                    f"{', '.join(pending)} (sus VMs se muestran en caché)")
+            color = '#e67e22'
+        else:
+            text = f"Sin conexión - reconectando; {len(self._tree_snapshot)} VMs en caché"
+            color = '#e74c3c'
+        self.status_label.config(text=text, fg=color)
+        self.time_label.config(text=datetime.now().strftime('%H:%M:%S'))
 
-        self.refresh_vm_list() # Refresh the VM list in the treeview
-        self.root.after(5000, self.auto_refresh)
+    def auto_refresh(self):
+        """
+        Auto-actualizar la lista de cada host cada POLL_INTERVAL segundos; en
+        los hosts con eventos activos es solo una reconciliación cada
+        RECONCILE_INTERVAL segundos.
+        """
+        now = time.monotonic()
+        for host in self.hosts:
+            # Si el sondeo anterior del host sigue en curso (host lento) se omite este
+            if not host.events_enabled or now >= host.reconcile_due:
+                if host.poller.request_refresh():
+                    host.reconcile_due = now + RECONCILE_INTERVAL
+            host.tunnels.close_unused(host.displays.ports())
+        self.root.after(int(POLL_INTERVAL * 1000), self.auto_refresh)
+
+    def refresh_thumbnails(self):
+        """Actualizar la cuadrícula de miniaturas con las VMs en ejecución del tree"""
+        running = sorted(((uuid, record.name) for uuid, record in self._tree_snapshot.items()
+                          if is_active_state(record.state)), key=lambda vm: vm[1].lower())
+        self.thumbnails.set_vms(running)
+        self.thumbnails.update()
+        self.root.after(500, self.refresh_thumbnails)
+
+    def on_right_tab_changed(self, event):
+        selected = self.right_tabs.select()
+        self.thumbnails.shown = selected == str(self.thumbnails.frame)
+        self.thumbnails.update()
+        self.rpc_metrics.shown = selected == str(self.rpc_metrics.frame)
+        self.rpc_metrics.update()
+
+    def refresh_rpc_metrics(self):
+        """Actualizar cada segundo la pestaña de depuración (si está visible)"""
+        self.rpc_metrics.update()
+        self.root.after(1000, self.refresh_rpc_metrics)
+
+    def select_vm_by_uuid(self, uuid):
+        """Seleccionar en el tree la VM de una miniatura"""
+        if self.vm_tree.exists(uuid):
+            self.vm_tree.selection_set(uuid)
+            self.vm_tree.see(uuid)
+
+    def open_vm_display_by_uuid(self, uuid):
+        self.select_vm_by_uuid(uuid)
+        self.selected_vm = self.vm_tree.item(uuid, 'text') if self.vm_tree.exists(uuid) else None
+        self.selected_host = self._vm_hosts.get(uuid)
+        self.connect_to_vm_display()
+
+    def lookup_domain(self, uuid):
+        """Dominio de una VM del tree en la conexión de su host (cualquier hilo)"""
+        host = self._vm_hosts.get(uuid)
+        if host is None:
+            raise libvirt.libvirtError(f"VM desconocida: {uuid}")
+        return host.require().lookupByUUIDString(uuid)
+
+    def sample_metrics(self):
+        """Pedir una muestra de métricas cada METRICS_INTERVAL segundos a los hosts con eventos"""
+        for host in self.hosts:
+            if host.events_enabled:
+                host.poller.request_sample()
+        self.root.after(int(METRICS_INTERVAL * 1000), self.sample_metrics)
 
     def __del__(self):
-        """Cerrar conexión al destruir"""
-        if self.conn and self.conn.isAlive(): # Añadir isAlive para evitar error "invalid connection pointer"
+        """Cerrar las conexiones al destruir"""
+        self.hosts.close_all()
+
+
+class InventoryPoller:
+    """
+    Hilo dedicado a las llamadas periódicas a libvirt de un host.
+
+    Cada sondeo produce un InventorySnapshot inmutable que se publica en la
+    cola `snapshots`, común a todos los hosts; la interfaz lo consume desde
+    el hilo de Tk. Como cada host tiene su hilo, un host lento o caído no
+    retrasa los sondeos de los demás.
+    """
+
+    def __init__(self, client, host, snapshots):
+        self.client = client
+        self.host = host
+        self.snapshots = snapshots
+        self.skipped_polls = 0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._polling = threading.Event()
+        self._lock = threading.Lock()
+        self._full_requested = False
+        self._sample_requested = False
+        self._dirty = {}  # uuid -> dominio (None si fue eliminado)
+        self._thread = threading.Thread(target=self._run, name=f'libvirt-poller-{host.name}',
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def request_refresh(self, force=False):
+        """
+        Solicitar un sondeo. Si el anterior sigue en curso se omite; con
+        force=True queda pendiente uno solo, que se hará al terminar.
+        """
+        if self._polling.is_set() and not force:
+            self.skipped_polls += 1
+            return False
+        with self._lock:
+            self._full_requested = True
+        self._wakeup.set()
+        return True
+
+    def request_sample(self):
+        """Solicitar una muestra de métricas; se omite si hay un sondeo en curso"""
+        if self._polling.is_set():
+            self.skipped_polls += 1
+            return False
+        with self._lock:
+            self._sample_requested = True
+        self._wakeup.set()
+        return True
+
+    def notify_domain_event(self, dom, removed=False):
+        """Marcar un dominio como modificado (se llama desde el hilo de eventos)"""
+        with self._lock:
+            self._dirty[dom.UUIDString()] = None if removed else dom
+        self._wakeup.set()
+
+    def wake(self):
+        """Publicar el estado de la conexión (p. ej. tras el callback de cierre)"""
+        with self._lock:
+            self._full_requested = True
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            # Sin conexión el hilo despierta solo para cada intento de reconexión
+            self._wakeup.wait(self.host.reconnect_delay())
+            if self._stopped.is_set():
+                return
+            self._wakeup.clear()
+            with self._lock:
+                full, self._full_requested = self._full_requested, False
+                sample, self._sample_requested = self._sample_requested, False
+                dirty, self._dirty = self._dirty, {}
+            if self.host.reconnect_delay() == 0:
+                full = True
+            if not (full or sample or dirty):
+                continue
+            self._polling.set()
             try:
-                self.conn.close()
-            except libvirt.libvirtError as e:
-                print(f"Error al cerrar la conexión libvirt en __del__: {e}")
+                # Un sondeo completo ya cubre los dominios marcados por eventos
+                # y sirve también como muestra de métricas
+                selected_vm = self.client.selected_vm
+                if self.client.selected_host is not self.host:
+                    selected_vm = None
+                with instrumentation.registry.timed('refresh' if full else 'partial_refresh',
+                                                    self.host.name):
+                    if full:
+                        snapshots = [self.client.collect_snapshot(self.host, selected_vm)]
+                    else:
+                        snapshots = []
+                        if dirty:
+                            snapshots.append(self.client.collect_domain_update(self.host, dirty,
+                                                                               selected_vm))
+                        if sample:
+                            snapshots.append(self.client.collect_metrics_sample(self.host,
+                                                                                selected_vm))
+                for snapshot in snapshots:
+                    if snapshot is not None:
+                        self.snapshots.put(snapshot)
+            except Exception as e:
+                print(f"Error en el sondeo de libvirt de {self.host.name}: {e}")
+            finally:
+                self._polling.clear()
+
+
+class TokenBucket:
+    """Limitador de ritmo: `rate` operaciones por segundo (sin límite si es 0)"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Consumir un token; devuelve 0 si se pudo o los segundos que faltan para el siguiente"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class ScreenshotWorker:
+    """
+    Hilos que capturan las miniaturas de las VMs visibles en la cuadrícula,
+    uno por host: un host lento o caído solo retrasa sus propias
+    miniaturas. Las capturas contra cada host se limitan a SCREENSHOT_RATE
+    por segundo (host.screenshot_bucket) y cada miniatura visible se
+    renueva cada THUMBNAIL_INTERVAL segundos; las que no se ven no se
+    capturan. host_of(uuid) devuelve el host de la VM y lookup(uuid) su
+    dominio en la conexión de ese host.
+    """
+
+    def __init__(self, hosts, host_of, lookup, cache):
+        self.hosts = hosts
+        self.host_of = host_of
+        self.lookup = lookup
+        self.cache = cache
+        self.updated = queue.Queue()  # UUIDs con miniatura nueva
+        self.captures = 0
+        self._visible = {}  # uuid -> dominio (None hasta la primera captura)
+        self._lock = threading.Lock()
+        self._wakeups = {host: threading.Event() for host in hosts}
+        self._stopped = threading.Event()
+
+    def start(self):
+        for host in self.hosts:
+            threading.Thread(target=self._run, args=(host,), daemon=True,
+                             name=f'libvirt-screenshots-{host.name}').start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake_all()
+
+    def _wake_all(self):
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+
+    def set_visible(self, uuids):
+        """Miniaturas visibles ahora mismo (hilo de Tk)"""
+        with self._lock:
+            changed = set(uuids) != set(self._visible)
+            self._visible = {uuid: self._visible.get(uuid) for uuid in uuids}
+        if changed:
+            self._wake_all()
+
+    def _next_due(self, host):
+        """UUID visible de `host` con la miniatura más antigua y segundos que faltan para capturarla"""
+        with self._lock:
+            uuids = [uuid for uuid in self._visible if self.host_of(uuid) is host]
+        now = time.monotonic()
+        due, oldest = None, -1.0
+        for uuid in uuids:
+            thumbnail = self.cache.get(uuid)
+            age = now - thumbnail.taken_at if thumbnail is not None else float('inf')
+            if age > oldest:
+                due, oldest = uuid, age
+        return due, max(0.0, THUMBNAIL_INTERVAL - oldest)
+
+    def _run(self, host):
+        wakeup = self._wakeups[host]
+        while not self._stopped.is_set():
+            uuid, wait = self._next_due(host)
+            if uuid is not None and not wait:
+                if not host.connected():
+                    # Sin conexión se espera al siguiente intento de reconexión
+                    wait = host.reconnect_delay() or THUMBNAIL_INTERVAL
+                else:
+                    wait = host.screenshot_bucket.acquire()
+            if uuid is None or wait > 0:
+                # Sin miniaturas visibles se espera a que cambie la vista
+                wakeup.wait(None if uuid is None else wait)
+                wakeup.clear()
+                continue
+
+            with self._lock:
+                self.captures += 1
+            try:
+                with self._lock:
+                    vm = self._visible.get(uuid)
+                if vm is None:
+                    vm = self.lookup(uuid)
+                    with self._lock:
+                        if uuid in self._visible:
+                            self._visible[uuid] = vm
+                thumbnail = capture_thumbnail(vm.connect(), vm)
+            except (libvirt.libvirtError, ValueError) as e:
+                # El dominio se vuelve a buscar por si su host se reconectó
+                with self._lock:
+                    if uuid in self._visible:
+                        self._visible[uuid] = None
+                # Se conserva la última imagen buena junto con el error
+                previous = self.cache.get(uuid)
+                thumbnail = Thumbnail(previous.png if previous else None, time.monotonic(),
+                                      str(e).splitlines()[0] if str(e) else type(e).__name__)
+            self.cache.put(uuid, thumbnail)
+            self.updated.put(uuid)
+
+
+class RPCMetricsPanel:
+    """
+    Pestaña de depuración con instrumentation.registry: llamadas a libvirt
+    por método y host, de mayor a menor tiempo total, y los tiempos de los
+    sondeos y de las actualizaciones de la interfaz. Solo se redibuja con
+    la pestaña visible.
+    """
+
+    COLUMNS = ('Host', 'Llamadas', 'Errores', 'Media ms', 'p50 ms', 'p99 ms', 'Total s')
+    GROUPS = (('rpc', "Llamadas a libvirt"), ('timing', "Tiempos de la aplicación"))
+
+    def __init__(self, parent, registry):
+        self.registry = registry
+        self.shown = False
+
+        self.frame = tk.Frame(parent, bg='#2c3e50')
+        toolbar = tk.Frame(self.frame, bg='#2c3e50')
+        toolbar.pack(fill=tk.X, padx=10, pady=(10, 0))
+        self.summary = tk.Label(toolbar, fg='white', bg='#2c3e50', font=('Arial', 10), anchor='w')
+        self.summary.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(toolbar, text="Reiniciar", bg='#7f8c8d', fg='white', font=('Arial', 9, 'bold'),
+                  command=self.reset).pack(side=tk.RIGHT)
+
+        tree_frame = tk.Frame(self.frame, bg='#2c3e50')
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.tree = ttk.Treeview(tree_frame, columns=self.COLUMNS)
+        self.tree.heading('#0', text="Método / operación")
+        self.tree.column('#0', width=180)
+        for column in self.COLUMNS:
+            self.tree.heading(column, text=column)
+            self.tree.column(column, width=110 if column == 'Host' else 70,
+                             anchor=tk.W if column == 'Host' else tk.E)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        for group, label in self.GROUPS:
+            self.tree.insert('', 'end', iid=group, text=label, open=True)
+
+    def reset(self):
+        self.registry.reset()
+        for group, _ in self.GROUPS:
+            self.tree.delete(*self.tree.get_children(group))
+        self.update()
+
+    def update(self):
+        if not self.shown:
+            return
+        rpcs, timings = self.registry.snapshot()
+        for (group, _), series in zip(self.GROUPS, (rpcs, timings)):
+            ordered = sorted(series.items(), key=lambda item: item[1].total, reverse=True)
+            for index, ((name, host), histogram) in enumerate(ordered):
+                iid = f"{group}:{name}@{host}"
+                values = (host, histogram.count, histogram.errors,
+                          f"{histogram.total / histogram.count * 1000:.1f}",
+                          self._format_ms(histogram.quantile(0.5)),
+                          self._format_ms(histogram.quantile(0.99)), f"{histogram.total:.2f}")
+                if self.tree.exists(iid):
+                    self.tree.item(iid, values=values)
+                    self.tree.move(iid, group, index)
+                else:
+                    self.tree.insert(group, index, iid=iid, text=name, values=values)
+
+        if not instrumentation.ENABLED:
+            text = "Instrumentación desactivada (LIBVIRT_METRICS=0)"
+        else:
+            text = (f"{sum(h.count for h in rpcs.values())} llamadas a libvirt, "
+                    f"{sum(h.errors for h in rpcs.values())} con error")
+        self.summary.config(text=text)
+
+    @staticmethod
+    def _format_ms(seconds):
+        return f"{seconds * 1000:.1f}" if seconds is not None else '-'
+
+
+class ThumbnailGrid:
+    """
+    Cuadrícula de miniaturas de las VMs en ejecución sobre un Canvas con
+    scroll. Solo las miniaturas dentro del área visible, con la pestaña
+    abierta, se piden al ScreenshotWorker.
+    """
+
+    PAD = 10
+    LABEL_HEIGHT = 20
+
+    def __init__(self, parent, worker, cache, on_select, on_open):
+        self.worker = worker
+        self.cache = cache
+        self.on_select = on_select
+        self.on_open = on_open
+        self.shown = False
+        self._vms = []  # [(uuid, nombre)] en el orden de la cuadrícula
+        self._tiles = {}  # uuid -> (item imagen, item texto, nombre, y)
+        self._images = {}  # uuid -> PhotoImage mostrada
+
+        self.frame = tk.Frame(parent, bg='#2c3e50')
+        self.canvas = tk.Canvas(self.frame, bg='#2c3e50', highlightthickness=0)
+        scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=scrollbar.set)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.bind('<Configure>', lambda event: self.layout())
+        self.canvas.bind('<MouseWheel>', lambda event: self.canvas.yview_scroll(-event.delta // 120, 'units'))
+        self.canvas.bind('<Button-4>', lambda event: self.canvas.yview_scroll(-1, 'units'))
+        self.canvas.bind('<Button-5>', lambda event: self.canvas.yview_scroll(1, 'units'))
+
+    def set_vms(self, vms):
+        """VMs en ejecución como [(uuid, nombre)]; solo se redibuja si cambian"""
+        if vms == self._vms:
+            return
+        for uuid in set(self._images) - {uuid for uuid, _ in vms}:
+            del self._images[uuid]
+            self.cache.discard(uuid)
+        self._vms = vms
+        self.layout()
+
+    def layout(self):
+        self.canvas.delete('all')
+        self._tiles = {}
+        width, height = THUMBNAIL_SIZE
+        tile_width = width + self.PAD
+        tile_height = height + self.LABEL_HEIGHT + self.PAD
+        columns = max(1, (self.canvas.winfo_width() - self.PAD) // tile_width)
+        for i, (uuid, name) in enumerate(self._vms):
+            x = self.PAD + (i % columns) * tile_width
+            y = self.PAD + (i // columns) * tile_height
+            tag = f"vm:{uuid}"
+            self.canvas.create_rectangle(x, y, x + width, y + height, fill='#34495e',
+                                         outline='#7f8c8d', tags=(tag,))
+            image_item = self.canvas.create_image(x + width // 2, y + height // 2,
+                                                  image=self._images.get(uuid, ''), tags=(tag,))
+            text_item = self.canvas.create_text(x + width // 2, y + height + self.LABEL_HEIGHT // 2,
+                                                fill='white', font=('Arial', 9), width=width, tags=(tag,))
+            self.canvas.tag_bind(tag, '<Button-1>', lambda event, u=uuid: self.on_select(u))
+            self.canvas.tag_bind(tag, '<Double-Button-1>', lambda event, u=uuid: self.on_open(u))
+            self._tiles[uuid] = (image_item, text_item, name, y)
+            self._set_caption(uuid)
+        rows = -(-len(self._vms) // columns)
+        self.canvas.configure(scrollregion=(0, 0, columns * tile_width + self.PAD,
+                                            rows * tile_height + self.PAD))
+
+    def _set_caption(self, uuid):
+        _, text_item, name, _ = self._tiles[uuid]
+        thumbnail = self.cache.get(uuid)
+        if thumbnail is None:
+            caption = f"{name} (capturando...)"
+        elif thumbnail.error:
+            caption = f"{name} ({thumbnail.error[:40]})"
+        else:
+            caption = name
+        self.canvas.itemconfigure(text_item, text=caption)
+
+    def _show(self, uuid):
+        """Mostrar la miniatura recién capturada de `uuid`"""
+        thumbnail = self.cache.get(uuid)
+        if thumbnail is not None and thumbnail.png and thumbnail.error is None:
+            photo = tk.PhotoImage(data=base64.b64encode(thumbnail.png).decode('ascii'), format='png')
+            self._images[uuid] = photo
+            self.canvas.itemconfigure(self._tiles[uuid][0], image=photo)
+        self._set_caption(uuid)
+
+    def visible_uuids(self):
+        if not self.shown:
+            return []
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        return [uuid for uuid, (_, _, _, y) in self._tiles.items()
+                if y < bottom and y + THUMBNAIL_SIZE[1] > top]
+
+    def update(self):
+        """Aplicar las miniaturas nuevas y pasar al worker las visibles (hilo de Tk)"""
+        try:
+            while True:
+                uuid = self.worker.updated.get_nowait()
+                if uuid in self._tiles:
+                    self._show(uuid)
+        except queue.Empty:
+            pass
+        self.worker.set_visible(self.visible_uuids())
 
 
 class VMCreationDialog:
-    def __init__(self, parent, conn, refresh_callback):
+    NO_BASE_IMAGE = "(ninguna - disco vacío)"
+    NUMA_NONE = "Sin fijar (el host decide)"
+    NUMA_AUTO = "Automática (nodo con más memoria libre)"
+
+    def __init__(self, parent, conn, refresh_callback, base_images=None):
         self.conn = conn
         self.refresh_callback = refresh_callback
+        self.base_images = base_images
 
         # Crear ventana
         self.dialog = tk.Toplevel(parent)
         self.dialog.title("Crear Nueva Máquina Virtual")
-        self.dialog.geometry("600x550") # Aumentado un poco para mejor layout
+        self.dialog.geometry("600x920") # Aumentado un poco para mejor layout
         self.dialog.configure(bg='#2c3e50')
         self.dialog.transient(parent)
         self.dialog.grab_set()
 
         # Variables
         self.vm_name = tk.StringVar()
+        self.vm_count = tk.StringVar(value="1") # Más de 1 (o un patrón {01..N}) = modo lote
         self.os_type = tk.StringVar(value="linux")
         self.memory = tk.StringVar(value="1024")
         self.vcpus = tk.StringVar(value="1")
         self.disk_size = tk.StringVar(value="10") # Tamaño en GB
         self.iso_path = tk.StringVar()
+        self.base_image = tk.StringVar(value=self.NO_BASE_IMAGE)
+        self.engine = detect_engine(conn)
+        self.profile = tk.StringVar(value=PERFORMANCE_PROFILES[DEFAULT_PROFILE].label)
+        self.hugepages = tk.BooleanVar(value=PERFORMANCE_PROFILES[DEFAULT_PROFILE].hugepages)
+        self.headless = tk.BooleanVar(value=PERFORMANCE_PROFILES[DEFAULT_PROFILE].headless)
+        self.profiles_by_label = {profile.label: profile for profile in PERFORMANCE_PROFILES.values()}
+
+        # Topología NUMA del host (en caché por conexión)
+        try:
+            self.topology = host_topology(conn)
+        except libvirt.libvirtError as e:
+            print(f"No se pudo leer la topología del host: {e}")
+            self.topology = None
+        self.numa_nodes = {}  # etiqueta del combobox -> id de nodo
+        if self.topology is not None:
+            self.numa_nodes = {f"Nodo {node.id} (CPUs {format_cpuset(node.cpus)}, {node.memory_mb} MB)": node.id
+                               for node in self.topology.nodes}
+        self.numa_mode = tk.StringVar(value=self.NUMA_NONE)
+        self.numa_cpus = tk.StringVar()
+
+        # Etiqueta del combobox -> BaseImage, desde el catálogo en caché
+        images = base_images.images() if base_images is not None else []
+        self.base_image_choices = {
+            f"{image.name} ({image.virtual_gb} GB, {image.size_mb} MB en disco)": image
+            for image in images
+        }
 
         self.setup_dialog()
 
@@ -630,13 +3535,24 @@ class VMCreationDialog:
                          font=('Arial', 18, 'bold'), fg='white', bg='#2c3e50')
         title.pack(pady=20)
 
+        # Motor de virtualización elegido según las capacidades del host
+        engine = self.engine
+        engine_text = "KVM" if engine.domain_type == 'kvm' else "QEMU (TCG)"
+        if engine.cpu_mode:
+            engine_text += f", CPU {engine.cpu_mode}"
+        engine_label = tk.Label(self.dialog, text=f"Motor: {engine_text} - {engine.reason}",
+                                fg='#27ae60' if engine.domain_type == 'kvm' else '#f39c12',
+                                bg='#2c3e50', font=('Arial', 10), wraplength=540)
+        engine_label.pack()
+
         # Frame principal
         main_frame = tk.Frame(self.dialog, bg='#34495e', padx=20, pady=20)
         main_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
 
         # Configuraciones
         configs = [
-            ("Nombre de la VM:", self.vm_name),
+            ("Nombre de la VM (o patrón, p. ej. web-{01..40}):", self.vm_name),
+            ("Cantidad de VMs:", self.vm_count),
             ("Memoria RAM (MB):", self.memory),
             ("CPUs Virtuales:", self.vcpus),
             ("Tamaño del disco (GB):", self.disk_size),
@@ -665,6 +3581,62 @@ class VMCreationDialog:
                                 values=['linux', 'windows', 'other'], state='readonly')
         os_combo.pack(fill=tk.X, pady=5)
 
+        # Imagen base (clon enlazado)
+        base_frame = tk.Frame(main_frame, bg='#34495e')
+        base_frame.pack(fill=tk.X, pady=10)
+
+        base_text = ("Imagen base (clon enlazado, opcional):" if self.base_images is not None
+                     else "Imagen base (clon enlazado, solo en hosts locales):")
+        base_label = tk.Label(base_frame, text=base_text,
+                              fg='white', bg='#34495e', font=('Arial', 12))
+        base_label.pack(anchor=tk.W)
+
+        base_combo = ttk.Combobox(base_frame, textvariable=self.base_image,
+                                  state='readonly' if self.base_images is not None else 'disabled',
+                                  values=[self.NO_BASE_IMAGE] + list(self.base_image_choices))
+        base_combo.pack(fill=tk.X, pady=5)
+
+        # Perfil de rendimiento
+        profile_frame = tk.Frame(main_frame, bg='#34495e')
+        profile_frame.pack(fill=tk.X, pady=10)
+
+        profile_label = tk.Label(profile_frame, text="Perfil de rendimiento:",
+                                 fg='white', bg='#34495e', font=('Arial', 12))
+        profile_label.pack(anchor=tk.W)
+
+        profile_combo = ttk.Combobox(profile_frame, textvariable=self.profile, state='readonly',
+                                     values=list(self.profiles_by_label))
+        profile_combo.pack(fill=tk.X, pady=5)
+        profile_combo.bind('<<ComboboxSelected>>', self.on_profile_selected)
+
+        check_style = {'fg': 'white', 'bg': '#34495e', 'selectcolor': '#2c3e50',
+                       'activebackground': '#34495e', 'font': ('Arial', 11)}
+        tk.Checkbutton(profile_frame, text="Memoria con hugepages", variable=self.hugepages,
+                       **check_style).pack(side=tk.LEFT)
+        tk.Checkbutton(profile_frame, text="Sin pantalla (headless)", variable=self.headless,
+                       **check_style).pack(side=tk.LEFT, padx=(20, 0))
+
+        # Ubicación NUMA
+        numa_frame = tk.Frame(main_frame, bg='#34495e')
+        numa_frame.pack(fill=tk.X, pady=10)
+
+        numa_label = tk.Label(numa_frame, text="Ubicación NUMA (fijación de vCPUs y memoria):",
+                              fg='white', bg='#34495e', font=('Arial', 12))
+        numa_label.pack(anchor=tk.W)
+
+        numa_combo = ttk.Combobox(numa_frame, textvariable=self.numa_mode, state='readonly',
+                                  values=[self.NUMA_NONE, self.NUMA_AUTO] + list(self.numa_nodes))
+        numa_combo.pack(fill=tk.X, pady=5)
+        if self.topology is None:
+            numa_combo.config(state='disabled')
+
+        cpus_frame = tk.Frame(numa_frame, bg='#34495e')
+        cpus_frame.pack(fill=tk.X)
+        tk.Label(cpus_frame, text="CPUs manuales (opcional, p. ej. 0-3):", fg='white', bg='#34495e',
+                 font=('Arial', 11)).pack(side=tk.LEFT)
+        tk.Entry(cpus_frame, textvariable=self.numa_cpus, font=('Arial', 11),
+                 width=16).pack(side=tk.LEFT, padx=(5, 0))
+
         # ISO Path
         iso_frame = tk.Frame(main_frame, bg='#34495e')
         iso_frame.pack(fill=tk.X, pady=10)
@@ -698,6 +3670,12 @@ class VMCreationDialog:
                                width=15)
         cancel_btn.pack(side=tk.RIGHT)
 
+    def on_profile_selected(self, event=None):
+        """Ajustar las casillas a los valores del perfil elegido"""
+        profile = self.profiles_by_label[self.profile.get()]
+        self.hugepages.set(profile.hugepages)
+        self.headless.set(profile.headless)
+
     def browse_iso(self):
         """Examinar archivo ISO"""
         filename = filedialog.askopenfilename(
@@ -708,58 +3686,140 @@ class VMCreationDialog:
         if filename:
             self.iso_path.set(filename)
 
-    def create_qcow2_disk(self, disk_path, disk_size_gb):
-        """Crea el archivo de disco QCOW2."""
+    def create_qcow2_disk(self, disk_path, disk_size_gb, backing=None):
+        """Crea el archivo de disco QCOW2 (o un overlay sobre una imagen base)."""
         try:
-            disk_dir = os.path.dirname(disk_path)
-            if not os.path.exists(disk_dir):
-                os.makedirs(disk_dir, exist_ok=True)
-
-            command = ["qemu-img", "create", "-f", "qcow2", disk_path, f"{disk_size_gb}G"]
-            
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            print(f"Comando ejecutado para crear disco: {' '.join(command)}")
-            print(f"Salida de qemu-img: {result.stdout}")
+            make_qcow2_disk(disk_path, disk_size_gb, backing)
             messagebox.showinfo("Disco Creado", f"Archivo de disco QCOW2 creado: {disk_path}")
             return True
-        except FileNotFoundError:
-            messagebox.showerror("Error", "El comando 'qemu-img' no fue encontrado.\n"
-                                          "Asegúrese de que QEMU esté instalado (sudo apt install qemu-utils).")
-            return False
-        except subprocess.CalledProcessError as e:
-            messagebox.showerror("Error al crear disco", f"Fallo al crear el disco QCOW2:\n{e.stderr}")
-            return False
-        except Exception as e:
-            messagebox.showerror("Error al crear disco", f"Ocurrió un error inesperado al crear el disco:\n{e}")
+        except DiskCreationError as e:
+            messagebox.showerror("Error al crear disco", str(e))
             return False
 
-    def create_vm(self):
-        """Crear la máquina virtual"""
+    def read_specs(self):
+        """Leer y validar el formulario; devuelve una VMSpec por VM a crear, o None"""
         if not self.vm_name.get().strip():
             messagebox.showerror("Error", "El nombre de la VM es requerido.")
-            return
+            return None
 
         try:
             memory_mb = int(self.memory.get())
             vcpu_count = int(self.vcpus.get())
             disk_gb = int(self.disk_size.get())
+            count = int(self.vm_count.get() or 1)
         except ValueError:
-            messagebox.showerror("Error", "Los valores numéricos de memoria, CPU y disco deben ser enteros válidos.")
+            messagebox.showerror("Error", "Los valores numéricos de memoria, CPU, disco y cantidad deben ser enteros válidos.")
+            return None
+
+        names = expand_name_pattern(self.vm_name.get().strip(), count)
+        if len(set(names)) != len(names):
+            messagebox.showerror("Error", "El patrón de nombres genera nombres repetidos.")
+            return None
+
+        # Con imagen base el overlay solo se agranda si se pide más que la base
+        backing = self.base_image_choices.get(self.base_image.get())
+        if backing is not None and disk_gb <= backing.virtual_gb:
+            disk_gb = None
+
+        profile = self.profiles_by_label[self.profile.get()]._replace(
+            hugepages=self.hugepages.get(), headless=self.headless.get())
+        if profile.hugepages and not self.hugepages_available(memory_mb * len(names)):
+            if not messagebox.askyesno(
+                    "Hugepages", "¿Crear las VMs sin hugepages?", parent=self.dialog):
+                return None
+            profile = profile._replace(hugepages=False)
+
+        placements = self.read_placements(len(names), memory_mb, vcpu_count)
+        if placements is None:
+            return None
+
+        iso_path_val = self.iso_path.get().strip()
+        return [VMSpec(name, memory_mb, vcpu_count, disk_gb, self.os_type.get(),
+                       iso_path_val, f"{IMAGES_DIR}/{name}.qcow2", backing, profile, placement)
+                for name, placement in zip(names, placements)]
+
+    def hugepages_available(self, needed_mb):
+        """
+        Indica si el host tiene needed_mb en hugepages libres; si no, lo
+        explica al usuario (una VM con hugepages sin reservar no arranca)
+        """
+        try:
+            free_mb = free_hugepages_mb(self.conn, self.topology)
+        except libvirt.libvirtError as e:
+            messagebox.showwarning("Hugepages", f"No se pudieron consultar las hugepages libres "
+                                                f"del host: {e}", parent=self.dialog)
+            return False
+        if free_mb < needed_mb:
+            messagebox.showwarning("Hugepages", f"El host solo tiene {free_mb} MB libres en "
+                                                f"hugepages y las VMs necesitan {needed_mb} MB.",
+                                   parent=self.dialog)
+            return False
+        return True
+
+    def read_placements(self, count, memory_mb, vcpus):
+        """NumaPlacement de cada VM a crear (None = sin fijar); None si hay un error"""
+        topology = self.topology
+        manual = self.numa_cpus.get().strip()
+        mode = self.numa_mode.get()
+        if topology is None or (mode == self.NUMA_NONE and not manual):
+            return [None] * count
+
+        # Las CPUs manuales tienen prioridad sobre el nodo elegido
+        if manual:
+            try:
+                cpus = parse_cpuset(manual)
+                if cpus[-1] >= topology.cpus:
+                    raise ValueError(f"el host solo tiene {topology.cpus} CPUs")
+            except ValueError as e:
+                messagebox.showerror("Error", f"CPUs manuales no válidas: {e}")
+                return None
+            nodes = cpus_to_nodes(cpus, topology)
+            placement = NumaPlacement(nodes[0] if len(nodes) == 1 else None,
+                                      tuple(map(format_cpuset, vcpu_pin_sets(cpus, vcpus))),
+                                      format_cpuset(cpus))
+            return [placement] * count
+
+        if mode == self.NUMA_AUTO:
+            try:
+                free_mb = node_free_memory_mb(self.conn, topology)
+            except libvirt.libvirtError as e:
+                messagebox.showerror("Error", f"No se pudo leer la memoria libre por nodo: {e}")
+                return None
+            node_ids = choose_numa_nodes(topology, free_mb, [(memory_mb, vcpus)] * count)
+            if None in node_ids:
+                messagebox.showerror("Error", "Ningún nodo NUMA tiene memoria y CPUs suficientes "
+                                              f"para {node_ids.count(None)} de las VMs.")
+                return None
+        else:
+            node_ids = [self.numa_nodes[mode]] * count
+
+        node_cpus = {node.id: format_cpuset(node.cpus) for node in topology.nodes}
+        return [NumaPlacement(node_id, (node_cpus[node_id],) * vcpus, node_cpus[node_id])
+                for node_id in node_ids]
+
+    def create_vm(self):
+        """Crear la máquina virtual (o varias, en modo lote)"""
+        specs = self.read_specs()
+        if not specs:
+            return
+        if len(specs) > 1:
+            self.create_vms_batch(specs)
             return
 
-        vm_name_cleaned = self.vm_name.get().strip()
-        disk_path = f"/var/lib/libvirt/images/{vm_name_cleaned}.qcow2"
+        spec = specs[0]
+        vm_name_cleaned = spec.name
+        disk_path = spec.disk_path
 
         # *** Paso crucial: Crear el archivo de disco ANTES de definir la VM ***
-        if not self.create_qcow2_disk(disk_path, disk_gb):
+        if not self.create_qcow2_disk(disk_path, spec.disk_gb, spec.backing):
             return # Si la creación del disco falla, abortar la creación de la VM
 
         # Crear XML de configuración
-        vm_xml = self.generate_vm_xml()
+        vm_xml = self.generate_vm_xml(spec)
 
         try:
             # Definir la VM
-            self.conn.defineXML(vm_xml)
+            define_domain(self.conn, vm_xml)
             messagebox.showinfo("Éxito", f"Máquina virtual '{vm_name_cleaned}' creada correctamente.")
             self.refresh_callback()
             self.dialog.destroy()
@@ -780,130 +3840,193 @@ class VMCreationDialog:
                     except OSError as ose:
                         messagebox.showerror("Error de limpieza", f"No se pudo eliminar el disco: {ose}")
 
-    def generate_vm_xml(self):
+    def create_vms_batch(self, specs):
+        """Crear varias VMs en paralelo mostrando un único avance y un resumen final"""
+        if not messagebox.askyesno("Modo lote",
+                                   f"Se crearán {len(specs)} VMs ({specs[0].name} ... {specs[-1].name}). "
+                                   "¿Desea continuar?", parent=self.dialog):
+            return
+
+        # El XML se genera aquí: los hilos de trabajo no deben leer variables de Tk
+        jobs = {spec.name: (spec, self.generate_vm_xml(spec)) for spec in specs}
+        conn = self.conn
+        parent = self.dialog.master
+        self.dialog.destroy()
+        TaskProgressDialog(parent, "Creación de VMs en lote", list(jobs),
+                           lambda name: provision_vm(conn, *jobs[name]),
+                           PROVISION_WORKERS, self.refresh_callback)
+
+    def generate_vm_xml(self, spec):
         """Generar XML de configuración de la VM"""
-        name = self.vm_name.get().strip()
-        memory_kb = int(self.memory.get()) * 1024
-        vcpus = self.vcpus.get()
-        os_type = self.os_type.get()
-        disk_path = f"/var/lib/libvirt/images/{name}.qcow2"
-        iso_path_val = self.iso_path.get().strip()
+        return build_vm_xml(spec, self.engine)
 
-        # XML básico
-        xml = f"""<domain type='qemu'>
-  <name>{name}</name>
-  <memory unit='KiB'>{memory_kb}</memory>
-  <currentMemory unit='KiB'>{memory_kb}</currentMemory>
-  <vcpu placement='static'>{vcpus}</vcpu>
-  <os>
-    <type arch='x86_64' machine='q35'>hvm</type>
-    <boot dev='hd'/>
-    <boot dev='cdrom'/>
-  </os>
-  <features>
-    <acpi/>
-    <apic/>
-  </features>
-  <cpu mode='host-model' check='partial'/>
-  <clock offset='utc'/>
-  <on_poweroff>destroy</on_poweroff>
-  <on_reboot>restart</on_reboot>
-  <on_crash>restart</on_crash>
-  <devices>
-    <emulator>/usr/bin/qemu-system-x86_64</emulator>
-    <disk type='file' device='disk'>
-      <driver name='qemu' type='qcow2'/>
-      <source file='{disk_path}'/>
-      <target dev='vda' bus='virtio'/>
-      <address type='pci' domain='0x0000' bus='0x04' slot='0x00' function='0x0'/>
-    </disk>"""
+class ShutdownOptionsDialog:
+    """Diálogo modal con el plazo por VM y la política de escalado; result es (plazo, política) o None"""
 
-        # Agregar CDROM si hay ISO
-        if iso_path_val:
-            xml += f"""
-    <disk type='file' device='cdrom'>
-      <driver name='qemu' type='raw'/>
-      <source file='{iso_path_val}'/>
-      <target dev='sdb' bus='sata'/>
-      <readonly/>
-      <address type='drive' controller='0' bus='0' target='0' unit='0'/>
-    </disk>"""
+    def __init__(self, parent, title):
+        self.result = None
+        self.deadline = tk.StringVar(value=f"{SHUTDOWN_DEADLINE:.0f}")
+        self.policy = tk.StringVar(value=SHUTDOWN_POLICIES.get(SHUTDOWN_POLICY, SHUTDOWN_POLICIES['retry']))
 
-        # Continuar con el resto de la configuración
-        xml += f"""
-    <controller type='usb' index='0' model='qemu-xhci' ports='15'>
-      <address type='pci' domain='0x0000' bus='0x02' slot='0x00' function='0x0'/>
-    </controller>
-    <controller type='sata' index='0'>
-      <address type='pci' domain='0x0000' bus='0x00' slot='0x1f' function='0x2'/>
-    </controller>
-    <controller type='pci' index='0' model='pcie-root'/>
-    <controller type='pci' index='1' model='pcie-root-port'>
-      <model name='pcie-root-port'/>
-      <target chassis='1' port='0x10'/>
-      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x0' multifunction='on'/>
-    </controller>
-    <controller type='pci' index='2' model='pcie-root-port'>
-      <model name='pcie-root-port'/>
-      <target chassis='2' port='0x11'/>
-      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x1'/>
-    </controller>
-    <controller type='pci' index='3' model='pcie-root-port'>
-      <model name='pcie-root-port'/>
-      <target chassis='3' port='0x12'/>
-      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x2'/>
-    </controller>
-    <controller type='pci' index='4' model='pcie-root-port'>
-      <model name='pcie-root-port'/>
-      <target chassis='4' port='0x13'/>
-      <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x3'/>
-    </controller>
-    <controller type='virtio-serial' index='0'>
-      <address type='pci' domain='0x0000' bus='0x03' slot='0x00' function='0x0'/>
-    </controller>
-    <interface type='network'>
-      <source network='default'/>
-      <model type='virtio'/>
-      <address type='pci' domain='0x0000' bus='0x01' slot='0x00' function='0x0'/>
-    </interface>
-    <serial type='pty'>
-      <target type='isa-serial' port='0'>
-        <model name='isa-serial'/>
-      </target>
-    </serial>
-    <console type='pty'>
-      <target type='serial' port='0'/>
-    </console>
-    <channel type='unix'>
-      <target type='virtio' name='org.qemu.guest_agent.0'/>
-      <address type='virtio-serial' controller='0' bus='0' port='1'/>
-    </channel>
-    <input type='tablet' bus='usb'>
-      <address type='usb' bus='0' port='1'/>
-    </input>
-    <input type='mouse' bus='ps2'/>
-    <input type='keyboard' bus='ps2'/>
-    <graphics type='vnc' port='-1' autoport='yes' listen='127.0.0.1'>
-      <listen type='address' address='127.0.0.1'/>
-    </graphics>
-    <sound model='ich9'>
-      <address type='pci' domain='0x0000' bus='0x00' slot='0x1b' function='0x0'/>
-    </sound>
-    <video>
-      <model type='qxl' ram='65536' vram='65536' vgamem='16384' heads='1' primary='yes'/>
-      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x0'/>
-    </video>
-    <memballoon model='virtio'>
-      <address type='pci' domain='0x0000' bus='0x05' slot='0x00' function='0x0'/>
-    </memballoon>
-    <rng model='virtio'>
-      <backend model='random'>/dev/urandom</backend>
-      <address type='pci' domain='0x0000' bus='0x06' slot='0x00' function='0x0'/>
-    </rng>
-  </devices>
-</domain>"""
+        self.dialog = tk.Toplevel(parent)
+        self.dialog.title(title)
+        self.dialog.configure(bg='#2c3e50')
+        self.dialog.transient(parent)
+
+        frame = tk.Frame(self.dialog, bg='#34495e', padx=20, pady=15)
+        frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        tk.Label(frame, text=title, font=('Arial', 13, 'bold'), fg='white',
+                 bg='#34495e').pack(anchor=tk.W, pady=(0, 10))
+        tk.Label(frame, text="Plazo total por VM antes de escalar (segundos):", fg='white',
+                 bg='#34495e', font=('Arial', 11)).pack(anchor=tk.W)
+        tk.Spinbox(frame, from_=5, to=3600, increment=5, textvariable=self.deadline,
+                   font=('Arial', 11), width=10).pack(anchor=tk.W, pady=5)
+        tk.Label(frame, text="Si no se apaga a tiempo:", fg='white', bg='#34495e',
+                 font=('Arial', 11)).pack(anchor=tk.W)
+        ttk.Combobox(frame, textvariable=self.policy, values=list(SHUTDOWN_POLICIES.values()),
+                     state='readonly', width=52).pack(anchor=tk.W, pady=5)
+
+        buttons = tk.Frame(frame, bg='#34495e')
+        buttons.pack(fill=tk.X, pady=(10, 0))
+        tk.Button(buttons, text="Apagar", command=self.accept, bg='#e74c3c', fg='white',
+                  font=('Arial', 11, 'bold'), width=12).pack(side=tk.LEFT)
+        tk.Button(buttons, text="Cancelar", command=self.dialog.destroy, bg='#7f8c8d', fg='white',
+                  font=('Arial', 11, 'bold'), width=12).pack(side=tk.RIGHT)
+
+        self.dialog.grab_set()
+        self.dialog.wait_window()
+
+    def accept(self):
+        try:
+            deadline = float(self.deadline.get())
+            if deadline <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error", "El plazo debe ser un número de segundos positivo.",
+                                 parent=self.dialog)
+            return
+        policy = next(key for key, label in SHUTDOWN_POLICIES.items() if label == self.policy.get())
+        self.result = (deadline, policy)
+        self.dialog.destroy()
+
+
+class TaskProgressDialog:
+    """
+    Ventana no modal que ejecuta task(elemento) para cada elemento en un pool
+    de hilos y muestra el estado de cada uno. Al terminar muestra un único
+    resumen y llama a on_finished. task devuelve un texto de estado o lanza
+    una excepción si falla. Si se cierra la ventana antes de terminar solo
+    se oculta: los resultados se siguen recogiendo y on_finished se llama. Con reports=True se llama task(elemento, report)
+    y la tarea puede mostrar su fase intermedia con report(texto).
+    """
+
+    def __init__(self, parent, title, items, task, workers, on_finished=None, reports=False):
+        self.items = list(items)
+        self.on_finished = on_finished
+        self.reports = reports
+        self.results = queue.Queue()
+        self.done = 0
+        self.failures = []
+        self.hidden = False
+
+        self.window = tk.Toplevel(parent)
+        self.window.title(title)
+        self.window.geometry("520x420")
+        self.window.configure(bg='#2c3e50')
+        self.window.transient(parent)
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.summary_label = tk.Label(self.window, text=f"0 de {len(self.items)} completadas",
+                                      font=('Arial', 12, 'bold'), fg='white', bg='#2c3e50')
+        self.summary_label.pack(pady=(15, 5))
+
+        self.progress = ttk.Progressbar(self.window, maximum=len(self.items), length=460)
+        self.progress.pack(padx=20, pady=5)
+
+        tree_frame = tk.Frame(self.window, bg='#2c3e50')
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
+        self.tree = ttk.Treeview(tree_frame, columns=('Estado', 'Tiempo'), show='tree headings')
+        self.tree.heading('#0', text='Elemento')
+        self.tree.heading('Estado', text='Estado')
+        self.tree.heading('Tiempo', text='Tiempo (s)')
+        self.tree.column('#0', width=160)
+        self.tree.column('Estado', width=220)
+        self.tree.column('Tiempo', width=70)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        for item in self.items:
+            self.tree.insert('', 'end', iid=item, text=item, values=('En cola', ''))
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(self.items))),
+                                      thread_name_prefix='task')
+        for item in self.items:
+            executor.submit(self._run_task, task, item)
+        executor.shutdown(wait=False)
+        self.window.after(100, self.poll_results)
+
+    def close(self):
+        """Cerrar la ventana; con tareas pendientes solo se oculta hasta el resumen"""
+        if self.done < len(self.items):
+            self.hidden = True
+            self.window.withdraw()
+        else:
+            self.window.destroy()
+
+    def _run_task(self, task, item):
+        started = time.monotonic()
+        self.results.put((item, None, 'En curso', None))
+        try:
+            if self.reports:
+                ok, message = True, task(item, lambda text: self.results.put((item, None, text, None)))
+            else:
+                ok, message = True, task(item)
+        except Exception as e:
+            ok, message = False, str(e).splitlines()[0] if str(e) else type(e).__name__
+        self.results.put((item, ok, message, time.monotonic() - started))
+
+    def poll_results(self):
+        """Aplicar en la ventana los resultados recibidos de los hilos"""
+        try:
+            while True:
+                item, ok, message, elapsed = self.results.get_nowait()
+                if ok is None:
+                    self.tree.set(item, 'Estado', message)
+                    continue
+                self.done += 1
+                if not ok:
+                    self.failures.append((item, message))
+                self.tree.set(item, 'Estado', ('✔ ' if ok else '✖ ') + message)
+                self.tree.set(item, 'Tiempo', f"{elapsed:.1f}")
+        except queue.Empty:
+            pass
+
+        self.progress['value'] = self.done
+        self.summary_label.config(text=f"{self.done} de {len(self.items)} completadas"
+                                       f" ({len(self.failures)} con error)")
+        if self.done < len(self.items):
+            self.window.after(100, self.poll_results)
+            return
+
+        if self.on_finished:
+            self.on_finished()
+        # Con la ventana oculta el resumen sale sobre la ventana principal
+        parent = self.window.master if self.hidden else self.window
+        succeeded = len(self.items) - len(self.failures)
+        if self.failures:
+            detail = "\n".join(f"- {item}: {message}" for item, message in self.failures[:10])
+            if len(self.failures) > 10:
+                detail += f"\n... y {len(self.failures) - 10} más"
+            messagebox.showwarning("Resumen", f"{succeeded} de {len(self.items)} completadas.\n"
+                                              f"Fallaron:\n{detail}", parent=parent)
+        else:
+            messagebox.showinfo("Resumen", f"{succeeded} de {len(self.items)} completadas correctamente.",
+                                parent=parent)
+        if self.hidden:
+            self.window.destroy()
 
-        return xml
 
 def main():
     # Verificar si libvirt está disponible
@@ -923,8 +4046,8 @@ def main():
     except KeyboardInterrupt:
         print("\nAplicación cerrada por el usuario")
     finally:
-        if hasattr(app, 'conn') and app.conn:
-            app.conn.close()
+        app.screenshots.stop()
+        app.hosts.close_all()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Comparar el tiempo de arranque de VMs creadas con cada perfil de rendimiento
+
+Uso:
+    python3 bench_profiles.py
+    python3 bench_profiles.py --uri qemu:///system --image /var/lib/libvirt/images/base/debian.qcow2
+
+Con el driver de pruebas de libvirt (test:///default) solo se mide el coste
+de definir y arrancar el dominio. Con qemu cada VM arranca sobre un overlay
+de la imagen base y se mide hasta que responde el agente invitado (la imagen
+debe traer qemu-guest-agent).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+import libvirt
+
+from app2 import (DEFAULT_EMULATOR, IMAGES_DIR, PERFORMANCE_PROFILES, BaseImage, EngineInfo,
+                  VMSpec, build_vm_xml, define_domain, detect_engine, make_qcow2_disk)
+
+
+def wait_until_ready(conn, dom, timeout):
+    """Esperar a que el invitado esté listo; devuelve False si se agota el tiempo"""
+    if conn.getType() == 'Test':
+        return dom.state()[0] == libvirt.VIR_DOMAIN_RUNNING
+
+    import libvirt_qemu
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            libvirt_qemu.qemuAgentCommand(dom, '{"execute": "guest-ping"}', 1, 0)
+            return True
+        except libvirt.libvirtError:
+            time.sleep(0.2)
+    return False
+
+
+def boot_once(conn, engine, profile_name, run, args):
+    """Crear, arrancar y eliminar una VM; devuelve los segundos hasta estar lista o None"""
+    name = f"bench-{profile_name}-{run}"
+    disk_path = os.path.join(IMAGES_DIR, f"{name}.qcow2")
+    spec = VMSpec(name, args.memory, args.vcpus, None, 'linux', '', disk_path,
+                  profile=PERFORMANCE_PROFILES[profile_name])
+    if args.image:
+        make_qcow2_disk(disk_path, None, BaseImage(name, args.image, 'qcow2', None, None))
+
+    dom = define_domain(conn, build_vm_xml(spec, engine))
+    try:
+        started = time.monotonic()
+        dom.create()
+        ready = wait_until_ready(conn, dom, args.timeout)
+        return time.monotonic() - started if ready else None
+    finally:
+        if dom.isActive():
+            dom.destroy()
+        dom.undefine()
+        if os.path.exists(disk_path):
+            os.remove(disk_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiempo de arranque por perfil de rendimiento")
+    parser.add_argument('--uri', default='test:///default')
+    parser.add_argument('--image', help="imagen base qcow2 (necesaria con qemu)")
+    parser.add_argument('--profiles', nargs='+', default=list(PERFORMANCE_PROFILES),
+                        choices=list(PERFORMANCE_PROFILES))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--memory', type=int, default=1024, help="MB por VM")
+    parser.add_argument('--vcpus', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', action='store_true', help="salida en JSON")
+    args = parser.parse_args()
+
+    conn = libvirt.open(args.uri)
+    if conn.getType() == 'Test':
+        engine = EngineInfo('test', None, DEFAULT_EMULATOR, "driver de pruebas")
+    elif not args.image:
+        parser.error("--image es necesario para arrancar VMs reales")
+    else:
+        engine = detect_engine(conn)
+
+    results = {}
+    try:
+        for profile_name in args.profiles:
+            times = [boot_once(conn, engine, profile_name, run, args) for run in range(args.runs)]
+            ok = [t for t in times if t is not None]
+            results[profile_name] = {
+                'runs': len(times),
+                'timeouts': len(times) - len(ok),
+                'median_s': statistics.median(ok) if ok else None,
+                'min_s': min(ok) if ok else None,
+                'max_s': max(ok) if ok else None,
+            }
+    finally:
+        conn.close()
+
+    if args.json:
+        print(json.dumps({'uri': args.uri, 'engine': engine.domain_type, 'results': results}, indent=2))
+        return
+
+    print(f"URI: {args.uri}  motor: {engine.domain_type}  ejecuciones: {args.runs}")
+    print(f"{'perfil':<12}{'mediana':>10}{'mín':>10}{'máx':>10}{'timeouts':>10}")
+    for profile_name, result in results.items():
+        cells = [f"{result[key]:.3f}" if result[key] is not None else '-'
+                 for key in ('median_s', 'min_s', 'max_s')]
+        print(f"{profile_name:<12}{cells[0]:>10}{cells[1]:>10}{cells[2]:>10}{result['timeouts']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Medir cómo escalan el cliente y la API con el número de VMs
+
+Uso:
+    python3 bench_scale.py
+    python3 bench_scale.py --sizes 10 1000 --latency-ms 2 --json > actual.json
+    python3 bench_scale.py --baseline base.json   # código 1 si hay regresiones
+
+Genera un XML del driver de pruebas de libvirt (test:///ruta.xml) con 10,
+100, 1000 y 5000 dominios, la mitad apagados, y mide sin pantalla:
+
+    refresh      VirtualizationClient.refresh_vm_list
+    details      VirtualizationClient.show_vm_details
+    list_vms     GET /vms (Cache-Control: no-cache, fuerza el escaneo)
+    start_vm     POST /vms/<nombre>/start
+    stop_vm      POST /vms/<nombre>/stop
+
+El cliente usa una vista en memoria en lugar de Tk y la API el cliente de
+pruebas de Flask. Cada llamada a libvirt espera --latency-ms para simular
+un host remoto. Cada operación se mide en un proceso propio, de modo que
+el pico de RSS es el de esa operación con ese número de dominios.
+"""
+
+import argparse
+import json
+import math
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from xml.sax.saxutils import escape
+
+import libvirt
+
+import instrumentation
+
+OPERATIONS = ('refresh', 'details', 'list_vms', 'start_vm', 'stop_vm')
+CLIENT_OPERATIONS = ('refresh', 'details')
+DEFAULT_SIZES = (10, 100, 1000, 5000)
+
+TEST_NS = 'http://libvirt.org/schemas/domain/test'
+
+
+def write_node_xml(directory, size):
+    """XML del driver de pruebas con `size` dominios; devuelve la URI test:///"""
+    domains = []
+    for i in range(size):
+        name = f"bench-{i:05d}"
+        # Los impares quedan apagados (5 = VIR_DOMAIN_SHUTOFF) para poder arrancarlos
+        runstate = '<test:runstate>5</test:runstate>' if i % 2 else ''
+        domains.append(f"""
+  <domain type='test' xmlns:test='{TEST_NS}'>
+    <name>{escape(name)}</name>
+    <uuid>{uuid.uuid5(uuid.NAMESPACE_DNS, name)}</uuid>
+    <memory unit='MiB'>{512 * (1 + i % 4)}</memory>
+    <vcpu>{1 + i % 4}</vcpu>
+    <os><type arch='x86_64'>hvm</type></os>
+    <devices>
+      <disk type='file' device='disk'>
+        <source file='/var/lib/libvirt/images/{name}.qcow2'/>
+        <target dev='vda' bus='virtio'/>
+      </disk>
+      <interface type='network'><source network='default'/></interface>
+      <graphics type='vnc' port='{5900 + i}' listen='127.0.0.1'/>
+    </devices>
+    {runstate}
+  </domain>""")
+
+    path = os.path.join(directory, f"node-{size}.xml")
+    with open(path, 'w') as f:
+        f.write(f"""<node>
+  <network>
+    <name>default</name>
+    <bridge name='virbr0'/>
+    <forward/>
+    <ip address='192.168.122.1' netmask='255.255.255.0'/>
+  </network>{''.join(domains)}
+</node>
+""")
+    return f"test://{path}"
+
+
+class RPCRecorder:
+    """Añade la latencia simulada a cada llamada y cuenta las del hilo medido"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.count = 0
+        self._thread = threading.get_ident()
+
+    def record(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if threading.get_ident() == self._thread:
+            self.count += 1
+
+
+class BenchObject(instrumentation.InstrumentedObject):
+    """
+    Envoltorio de instrumentation con el RPCRecorder del banco: las llamadas
+    que se medirían (no las de LOCAL_METHODS) esperan la latencia simulada y
+    se cuentan. La conexión se comparte por URI, así que close() no la cierra.
+    """
+
+    recorder = None  # lo asigna patch_open_connection
+
+    def _invoke(self, attr, method, args, kwargs):
+        self.recorder.record()
+        if not instrumentation.ENABLED:
+            return method(*args, **kwargs)
+        return super()._invoke(attr, method, args, kwargs)
+
+    def close(self):
+        return 0
+
+
+def patch_open_connection(recorder):
+    """
+    Hacer que instrumentation.open_connection devuelva envoltorios de una
+    sola conexión por URI: cada apertura del driver de pruebas con un XML
+    propio crearía un host independiente, y la API abre varias (pool y
+    eventos).
+    """
+    BenchObject.recorder = recorder
+    shared = {}
+
+    def bench_open(uri, host=''):
+        if uri not in shared:
+            shared[uri] = libvirt.open(uri)
+        return BenchObject(shared[uri], host)
+
+    instrumentation.open_connection = bench_open
+    return shared
+
+
+def percentile(samples, q):
+    """Percentil por rango más cercano (q entre 0 y 1)"""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class HeadlessTree:
+    """Subconjunto de ttk.Treeview en memoria que usa VirtualizationClient"""
+
+    def __init__(self, columns):
+        self.ops = 0
+        self._columns = columns
+        self._items = {'': {'text': '', 'values': (), 'tags': ()}}
+        self._children = {'': []}
+        self._parents = {}
+
+    def insert(self, parent, index, iid=None, text='', values=(), tags=(), **options):
+        self.ops += 1
+        self._items[iid] = {'text': text, 'values': tuple(values), 'tags': tuple(tags)}
+        self._children[iid] = []
+        self._parents[iid] = parent
+        siblings = self._children[parent]
+        siblings.insert(len(siblings) if index == 'end' else index, iid)
+        return iid
+
+    def item(self, iid, option=None, **options):
+        if option is not None:
+            return self._items[iid][option]
+        if not options:
+            return dict(self._items[iid])
+        self.ops += 1
+        for key, value in options.items():
+            self._items[iid][key] = tuple(value) if key in ('values', 'tags') else value
+
+    def set(self, iid, column, value):
+        self.ops += 1
+        values = list(self._items[iid]['values'])
+        values[self._columns.index(column)] = value
+        self._items[iid]['values'] = tuple(values)
+
+    def delete(self, *iids):
+        for iid in iids:
+            self.ops += 1
+            self._children[self._parents[iid]].remove(iid)
+            self._forget(iid)
+
+    def _forget(self, iid):
+        for child in self._children.pop(iid):
+            self._forget(child)
+        del self._parents[iid], self._items[iid]
+
+    def move(self, iid, parent, index):
+        self.ops += 1
+        self._children[self._parents[iid]].remove(iid)
+        siblings = self._children[parent]
+        siblings.insert(len(siblings) if index == 'end' else index, iid)
+        self._parents[iid] = parent
+
+    def get_children(self, iid=''):
+        return tuple(self._children.get(iid, ()))
+
+    def exists(self, iid):
+        return iid in self._items
+
+    def selection(self):
+        return ()
+
+    def tag_configure(self, *args, **options):
+        pass
+
+
+class HeadlessWidget:
+    """Sustituto de tk.Label/tk.Text que conserva el último texto"""
+
+    def __init__(self):
+        self.text = ''
+
+    def config(self, text=None, **options):
+        if text is not None:
+            self.text = text
+
+    configure = config
+
+    def delete(self, *args):
+        self.text = ''
+
+    def insert(self, index, text, *tags):
+        self.text += text
+
+
+def make_headless_client(uri):
+    """VirtualizationClient con su estado real y una vista en memoria"""
+    from app2 import TREE_COLUMNS, ConnectionManager, VirtualizationClient, start_libvirt_event_loop
+
+    start_libvirt_event_loop()
+    client = VirtualizationClient.__new__(VirtualizationClient)
+    client.hosts = ConnectionManager([uri])
+    client.init_state()
+    client.vm_tree = HeadlessTree(TREE_COLUMNS)
+    client.info_text = HeadlessWidget()
+    client.status_label = HeadlessWidget()
+    client.time_label = HeadlessWidget()
+    for host in client.hosts:
+        client.vm_tree.insert('', 'end', iid=host.iid, text=host.name, open=True)
+    return client
+
+
+def domain_names(uri):
+    """(encendidos, apagados) del host, sin contar como RPC de la operación"""
+    conn = libvirt.open(uri)
+    running, stopped = [], []
+    for dom in conn.listAllDomains(0):
+        (running if dom.isActive() else stopped).append(dom.name())
+    return sorted(running), sorted(stopped)
+
+
+def run_operation(args):
+    """Proceso hijo: medir una operación y devolver su resultado como dict"""
+    # Sin hilos de fondo que compitan con la operación medida
+    os.environ['VM_CLIENT_EVENTS'] = '0'
+    os.environ['INVENTORY_INTERVAL'] = '3600'
+    os.environ['LIBVIRT_URIS'] = args.uri
+
+    running, stopped = domain_names(args.uri)
+    recorder = RPCRecorder(args.latency_ms / 1000)
+    patch_open_connection(recorder)
+
+    if args.child in CLIENT_OPERATIONS:
+        client = make_headless_client(args.uri)
+        client.refresh_vm_list()  # conexión y filas iniciales
+        if args.child == 'refresh':
+            targets = [None] * args.iterations
+            operation = lambda target: client.refresh_vm_list()
+        else:
+            targets = [running[i % len(running)] for i in range(args.iterations)] if running else []
+            operation = client.show_vm_details
+    else:
+        import app
+        http = app.app.test_client()
+        http.get('/vms')  # pool, suscripción e inventario inicial
+        if args.child == 'list_vms':
+            targets = [None] * args.iterations
+            operation = lambda target: http.get('/vms', headers={'Cache-Control': 'no-cache'})
+        else:
+            action = args.child.split('_')[0]
+            candidates = stopped if action == 'start' else running
+            targets = candidates[:args.iterations]
+            operation = lambda target: http.post(f'/vms/{target}/{action}')
+
+    rss_setup = peak_rss_mb()
+    samples, rpcs = [], []
+    for target in targets:
+        recorder.count = 0
+        started = time.perf_counter()
+        response = operation(target)
+        samples.append((time.perf_counter() - started) * 1000)
+        rpcs.append(recorder.count)
+        if response is not None and response.status_code >= 400:
+            raise RuntimeError(f"{args.child} {target}: HTTP {response.status_code}")
+
+    result = {
+        'operation': args.child,
+        'domains': len(running) + len(stopped),
+        'latency_ms': args.latency_ms,
+        'iterations': len(samples),
+        'p50_ms': round(percentile(samples, 0.50), 3) if samples else None,
+        'p99_ms': round(percentile(samples, 0.99), 3) if samples else None,
+        'mean_ms': round(statistics.mean(samples), 3) if samples else None,
+        'rpc_per_op': round(statistics.mean(rpcs), 1) if rpcs else None,
+        'rss_setup_mb': round(rss_setup, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    if args.child in CLIENT_OPERATIONS:
+        result['tree_ops'] = client.vm_tree.ops
+    return result
+
+
+def run_child(uri, operation, args):
+    """Lanzar la medición de una operación en un proceso nuevo"""
+    command = [sys.executable, os.path.abspath(__file__), '--child', operation, '--uri', uri,
+               '--iterations', str(args.iterations), '--latency-ms', str(args.latency_ms)]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def find_regressions(results, baseline, tolerance):
+    """Operaciones más lentas (p50/p99) o con más RPC que la línea base"""
+    previous = {(r['operation'], r['domains'], r['latency_ms']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = previous.get((result['operation'], result['domains'], result['latency_ms']))
+        if base is None:
+            continue
+        for key in ('p50_ms', 'p99_ms', 'rpc_per_op'):
+            if base[key] and result[key] is not None and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{result['operation']} ({result['domains']} VMs): "
+                                   f"{key} {base[key]} -> {result[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia, RPC y memoria según el número de VMs")
+    parser.add_argument('--uri', help="host existente en lugar de generar uno (ignora --sizes)")
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(DEFAULT_SIZES))
+    parser.add_argument('--operations', nargs='+', default=list(OPERATIONS), choices=OPERATIONS)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="latencia añadida a cada llamada a libvirt")
+    parser.add_argument('--baseline', help="JSON de una ejecución anterior para comparar")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="empeoramiento admitido frente a la línea base (0.25 = 25%%)")
+    parser.add_argument('--json', action='store_true', help="salida en JSON")
+    parser.add_argument('--child', choices=OPERATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_operation(args)))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-scale-') as directory:
+        uris = [args.uri] if args.uri else [write_node_xml(directory, size) for size in args.sizes]
+        for uri in uris:
+            for operation in args.operations:
+                results.append(run_child(uri, operation, args))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+
+    if args.json:
+        print(json.dumps({'latency_ms': args.latency_ms, 'iterations': args.iterations,
+                          'results': results, 'regressions': regressions}, indent=2))
+    else:
+        print(f"Latencia por RPC: {args.latency_ms} ms  iteraciones: {args.iterations}")
+        print(f"{'operación':<10}{'VMs':>7}{'p50 ms':>10}{'p99 ms':>10}{'RPC':>8}{'RSS MB':>9}")
+        for r in results:
+            cells = [f"{r[key]:.1f}" if r[key] is not None else '-'
+                     for key in ('p50_ms', 'p99_ms', 'rpc_per_op', 'peak_rss_mb')]
+            print(f"{r['operation']:<10}{r['domains']:>7}{cells[0]:>10}{cells[1]:>10}"
+                  f"{cells[2]:>8}{cells[3]:>9}")
+        for regression in regressions:
+            print(f"REGRESIÓN: {regression}")
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
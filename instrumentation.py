@@ -0,0 +1,246 @@
+"""
+Instrumentación de las llamadas a libvirt
+
+open_connection() devuelve la conexión envuelta en un objeto que mide cada
+llamada (número, errores e histograma de latencia por método y host). Los
+dominios, volúmenes, flujos y snapshots que devuelve se envuelven igual,
+y las callbacks de eventos y de cierre reciben los envoltorios, de modo que
+el resto del código no cambia. registry.timed() mide además operaciones de la
+aplicación, como un ciclo de sondeo o una actualización de la interfaz.
+
+Con LIBVIRT_METRICS=0 no se envuelve nada: las conexiones son las de
+libvirt y timed() solo comprueba la opción.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import libvirt
+
+ENABLED = os.environ.get('LIBVIRT_METRICS', '1') != '0'
+
+# Límites superiores (segundos) de los buckets del histograma, como en Prometheus
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Objetos de libvirt que se envuelven al devolverlos: sus métodos también hacen RPC
+# (volúmenes al borrar, flujos de las capturas de pantalla, snapshots)
+WRAPPED_TYPES = (libvirt.virDomain, libvirt.virStorageVol, libvirt.virStream,
+                 libvirt.virDomainSnapshot)
+
+# Métodos que libvirt-python resuelve sin llamar al demonio: no se miden
+LOCAL_METHODS = frozenset({'name', 'UUID', 'UUIDString', 'ID', 'isAlive', 'c_pointer'})
+
+
+class Histogram:
+    """Número de llamadas, errores, suma y buckets de latencia de una serie"""
+
+    __slots__ = ('count', 'errors', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # el último es +Inf
+
+    def observe(self, seconds, failed=False):
+        self.count += 1
+        self.total += seconds
+        if failed:
+            self.errors += 1
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.count, histogram.errors, histogram.total = self.count, self.errors, self.total
+        histogram.buckets = list(self.buckets)
+        return histogram
+
+    def quantile(self, q):
+        """Estimación del cuantil q interpolando dentro de su bucket (None sin muestras)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for upper, n in zip(LATENCY_BUCKETS, self.buckets):
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return lower  # bucket +Inf: el límite conocido más alto
+
+
+class MetricsRegistry:
+    """
+    Histogramas por (método, host) de las llamadas a libvirt y por
+    (operación, host) de los tiempos de la aplicación. Seguro entre hilos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rpcs = {}
+        self._timings = {}
+
+    def observe_rpc(self, method, host, seconds, failed=False):
+        self._observe(self._rpcs, (method, host), seconds, failed)
+
+    def observe(self, operation, seconds, host=''):
+        self._observe(self._timings, (operation, host), seconds, False)
+
+    def _observe(self, family, key, seconds, failed):
+        with self._lock:
+            histogram = family.get(key)
+            if histogram is None:
+                histogram = family[key] = Histogram()
+            histogram.observe(seconds, failed)
+
+    @contextmanager
+    def timed(self, operation, host=''):
+        """Medir el bloque como `operation` (no hace nada con las métricas desactivadas)"""
+        if not ENABLED:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - started, host)
+
+    def snapshot(self):
+        """Copias de ({(método, host): Histogram}, {(operación, host): Histogram})"""
+        with self._lock:
+            return ({key: h.copy() for key, h in self._rpcs.items()},
+                    {key: h.copy() for key, h in self._timings.items()})
+
+    def reset(self):
+        with self._lock:
+            self._rpcs.clear()
+            self._timings.clear()
+
+    def prometheus_text(self):
+        """Todas las series en el formato de texto de Prometheus (0.0.4)"""
+        rpcs, timings = self.snapshot()
+        lines = ['# HELP libvirt_metrics_enabled 1 si las llamadas a libvirt se miden',
+                 '# TYPE libvirt_metrics_enabled gauge',
+                 f'libvirt_metrics_enabled {int(ENABLED)}']
+        lines += _histogram_lines('libvirt_rpc_duration_seconds',
+                                  'Latencia de las llamadas a libvirt', 'method', rpcs)
+        lines += ['# HELP libvirt_rpc_errors_total Llamadas a libvirt que lanzaron libvirtError',
+                  '# TYPE libvirt_rpc_errors_total counter']
+        for (method, host), histogram in sorted(rpcs.items()):
+            lines.append(f'libvirt_rpc_errors_total{_labels(method=method, host=host)} '
+                         f'{histogram.errors}')
+        lines += _histogram_lines('vm_operation_duration_seconds',
+                                  'Duración de las operaciones de la aplicación', 'operation',
+                                  timings)
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def _histogram_lines(name, help_text, label, series):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for (key, host), histogram in sorted(series.items()):
+        cumulative = 0
+        for upper, n in zip(LATENCY_BUCKETS + ('+Inf',), histogram.buckets):
+            cumulative += n
+            labels = _labels(**{label: key}, host=host, le=upper)
+            lines.append(f'{name}_bucket{labels} {cumulative}')
+        labels = _labels(**{label: key}, host=host)
+        lines.append(f'{name}_sum{labels} {histogram.total:.6f}')
+        lines.append(f'{name}_count{labels} {histogram.count}')
+    return lines
+
+
+registry = MetricsRegistry()
+
+
+class InstrumentedObject:
+    """
+    Envoltorio de virConnect/virDomain (y de los volúmenes, flujos y
+    snapshots que devuelven): cada método pasa por el registro de
+    métricas. Los atributos que no son métodos (como `_o`) se devuelven tal
+    cual, de modo que los envoltorios sirven donde libvirt espera el objeto
+    original; los argumentos se desenvuelven antes de cada llamada. Las
+    subclases (como la de bench_scale) amplían _invoke y envuelven los
+    dominios con su propia clase.
+    """
+
+    def __init__(self, target, host, conn=None):
+        self._target = target
+        self._host = host
+        self._conn = conn  # envoltorio de la conexión, para connect() de los objetos hijos
+
+    def __getattr__(self, attr):
+        method = getattr(self._target, attr)
+        if not callable(method) or attr in LOCAL_METHODS:
+            return method
+        if attr == 'connect' and self._conn is not None:
+            def call():
+                return self._conn
+        elif attr == 'registerCloseCallback':
+            def call(callback, opaque):
+                return method(lambda conn, reason, opaque: callback(self, reason, opaque), opaque)
+        elif attr == 'domainEventRegisterAny':
+            def call(dom, event_id, callback, opaque):
+                return method(unwrap(dom), event_id,
+                              lambda conn, dom, *args: callback(self, self._wrap(dom), *args),
+                              opaque)
+        else:
+            def call(*args, **kwargs):
+                if args:
+                    args = [unwrap(arg) for arg in args]
+                return self._wrap(self._invoke(attr, method, args, kwargs))
+        # Las siguientes búsquedas del método ya no pasan por __getattr__
+        self.__dict__[attr] = call
+        return call
+
+    def _invoke(self, attr, method, args, kwargs):
+        """Llamada a libvirt medida en el registro"""
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except libvirt.libvirtError:
+            registry.observe_rpc(attr, self._host, time.perf_counter() - started, True)
+            raise
+        registry.observe_rpc(attr, self._host, time.perf_counter() - started)
+        return result
+
+    def _wrap(self, result):
+        if isinstance(result, WRAPPED_TYPES):
+            return type(self)(result, self._host, self._conn or self)
+        if isinstance(result, list) and result and isinstance(result[0], WRAPPED_TYPES + (tuple,)):
+            return [self._wrap(item) for item in result]  # listAllDomains, getAllDomainStats...
+        if isinstance(result, tuple) and result and isinstance(result[0], WRAPPED_TYPES):
+            return (self._wrap(result[0]),) + result[1:]
+        return result
+
+
+def unwrap(value):
+    """Objeto de libvirt original de un envoltorio (o de una lista de ellos)"""
+    if isinstance(value, InstrumentedObject):
+        return value._target
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    return value
+
+
+def open_connection(uri, host=''):
+    """libvirt.open(uri) medido como 'open' y, si las métricas están activas, envuelto"""
+    if not ENABLED:
+        return libvirt.open(uri)
+    started = time.perf_counter()
+    try:
+        conn = libvirt.open(uri)
+    except libvirt.libvirtError:
+        registry.observe_rpc('open', host, time.perf_counter() - started, True)
+        raise
+    registry.observe_rpc('open', host, time.perf_counter() - started)
+    return InstrumentedObject(conn, host)